@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+'''
+Adaptive parameter sweep: successive halving over the configurations of a make_gnina_cmds.py sweep.
+
+Instead of docking every system for every value, each rung docks a growing random subset of the
+systems (spread evenly over the pockets with --stratify) for the configurations still alive, scores
+the poses with rmsd_engine.py and computes TopN with paired bootstrap intervals (topn.py). A
+configuration is dropped as soon as another one is better with the --ci confidence, and with --eta
+only the best 1/eta are kept after each rung. Subsets are nested, so each rung only docks the new systems.
+
+Input:
+        the make_gnina_cmds.py options of the sweep (-i pairs file, --exhaustiveness 4 8 16, --mode grid ...)
+        start          -- systems docked in the first rung
+        growth         -- factor the subset grows by per rung, the last rung is the full set
+        top            -- N of the TopN used to compare configurations
+        threshold      -- RMSD threshold of a good pose
+
+Output:
+        <name>.cmds     -- every command run, usable with obrms_calc.py/coalescer.py as usual
+        <name>.journal  -- run_gnina_cmds.py journal of the sweep
+        <name>.json     -- per rung survivors, the final ranking and the compute saved
+'''
+
+import argparse, json, math, os, random
+import make_gnina_cmds
+from gnina_jobs import get_option, parse_command
+from obrms_calc import rmsd_lines
+from rmsd_engine import RMSDCalculator
+from run_gnina_cmds import default_workers, load_journal, output_complete, prepare, run_commands
+
+
+def stratified_order(todock, stratify, rng):
+    '''
+    Order of the systems such that every prefix is a random sample, spread evenly over the
+    pockets (receptor directories) if stratify.
+    '''
+
+    if not stratify:
+        order = list(range(len(todock)))
+        rng.shuffle(order)
+        return order
+    pockets = {}
+    for i, (rec, _, _, _) in enumerate(todock):
+        pockets.setdefault(os.path.dirname(rec), []).append(i)
+    groups = list(pockets.values())
+    for group in groups:
+        rng.shuffle(group)
+    rng.shuffle(groups)
+    order = []
+    for k in range(max(len(g) for g in groups)):
+        order += [g[k] for g in groups if k < len(g)]
+    return order
+
+
+def rung_sizes(nsystems, start, growth):
+    '''
+    Number of systems of every rung, from start growing by growth up to nsystems.
+    '''
+
+    if start < 1 or growth <= 1:
+        raise ValueError(f'need start >= 1 and growth > 1, got start={start} growth={growth}')
+    sizes = [min(start, nsystems)]
+    while sizes[-1] < nsystems:
+        sizes.append(min(nsystems, int(math.ceil(sizes[-1]*growth))))
+    return sizes
+
+
+def pose_rmsds(cmd, calculators):
+    '''
+    RMSD of every pose of a finished command (empty if it failed), writing the .rmsds file as obrms_calc.py does.
+    '''
+
+    job = parse_command(cmd)
+    if not output_complete(job.out):
+        return []
+    rmsds = job.out.split('.sdf')[0]+'.rmsds'
+    if not os.path.isfile(rmsds) or os.path.getmtime(rmsds) < os.path.getmtime(job.out):
+        lig = get_option(job.tokens, '-l', '--ligand')
+        if lig not in calculators:
+            calculators[lig] = RMSDCalculator(lig)
+        with open(rmsds, 'w') as outfile:
+            for line in rmsd_lines(calculators[lig], job.out):
+                outfile.write(line+'\n')
+    with open(rmsds) as infile:
+        return [float(line.split()[2]) for line in infile if line.strip()]
+
+
+def evaluate(alive, systems, commands, todock, calculators, args):
+    '''
+    bootstrap_topn of the alive configurations over the systems docked so far, and the number of
+    failed commands of each.
+
+    A command that failed (or gave no poses) counts as a system without a good pose instead of
+    leaving the denominator, so a configuration that crashes cannot win a rung.
+    '''
+
+    import pandas as pd
+    from topn import bootstrap_topn
+
+    rows = []
+    failed = {}
+    for c in alive:
+        for i in systems:
+            rmsds = pose_rmsds(commands[c][i], calculators)
+            if not rmsds:
+                failed[c] = failed.get(c, 0)+1
+                rmsds = [math.inf]
+            for rmsd in rmsds:
+                rows.append((c, i, os.path.dirname(todock[i][0]), rmsd))
+    df = pd.DataFrame(rows, columns=['tag', 'system', 'pocket', 'rmsd'])
+    # a pocket with a single system in the subset has no spread to resample, so only stratify once they all have more
+    stratify = args.stratify and df.groupby('pocket')['system'].nunique().min() > 1
+    result = bootstrap_topn(df, 'system', 'tag', thresholds=(args.threshold,), max_n=args.top, nboot=args.nboot,
+                            strata_key='pocket' if stratify else None, ci=args.ci, seed=args.subset_seed)
+    return result, failed
+
+
+def dominated(result, n):
+    '''
+    Tags (of the result) that some other tag beats at TopN n with the result's confidence.
+    '''
+
+    from topn import compare_tags
+
+    out = set()
+    for a in range(len(result.tags)):
+        for b in range(len(result.tags)):
+            if a != b and compare_tags(result, a, b)[1][n-1, 0] > 0:
+                out.add(result.tags[b])
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Successive halving over a make_gnina_cmds.py sweep: dock growing subsets and drop configurations that are clearly worse.',
+                                     epilog='All other options (-i, --exhaustiveness, --mode, --cnn, ...) are passed to make_gnina_cmds.py to define the configurations.')
+    parser.add_argument('--name', default='adaptive_sweep', help='Prefix of the command, journal and report files (default: %(default)s)')
+    parser.add_argument('--start', type=int, default=200, help='Systems docked per configuration in the first rung (default: %(default)d)')
+    parser.add_argument('--growth', type=float, default=2, help='Factor the subset grows by each rung (default: %(default)g)')
+    parser.add_argument('--eta', type=float, default=0, help='If >1, also keep only the best 1/eta of the configurations after each rung (default: only drop dominated ones)')
+    parser.add_argument('--top', type=int, default=1, help='N of the TopN compared (default: %(default)d)')
+    parser.add_argument('--threshold', type=float, default=2, help='RMSD threshold of a good pose (default: %(default)g)')
+    parser.add_argument('--nboot', type=int, default=1000, help='Bootstrap replicates (default: %(default)d)')
+    parser.add_argument('--ci', type=float, default=95, help='Confidence (percent) needed to drop a configuration (default: %(default)g)')
+    parser.add_argument('--stratify', action='store_true', help='Flag to spread subsets and bootstrap draws evenly over pockets (receptor directories), for cross-docking.')
+    parser.add_argument('--subset_seed', type=int, default=0, help='Seed of the subset order and bootstrap (default: %(default)d)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of gnina commands to run at once. Defaults to the number of cores divided by --cpu_per_job.')
+    parser.add_argument('--cpu_per_job', type=int, default=None, help='Value to set for the --cpu option of every command.')
+    parser.add_argument('--gnina', default=None, help='gnina executable to run in place of the one in the commands.')
+    args, rest = parser.parse_known_args(argv)
+    if args.start < 1:
+        parser.error('--start must be at least 1')
+    if args.growth <= 1:
+        parser.error('--growth must be more than 1')
+    gargs = make_gnina_cmds.check_args(make_gnina_cmds.make_parser().parse_args(rest))
+
+    todock = make_gnina_cmds.read_pairs(gargs.input)
+    configs = make_gnina_cmds.make_configs(gargs)
+    labels = ['_'.join(arg+val for arg, val in config) if config else 'defaults' for config in configs]
+    commands = [[make_gnina_cmds.make_command(gargs, r, l, box, prefix, config) for r, l, box, prefix in todock] for config in configs]
+    order = stratified_order(todock, args.stratify, random.Random(args.subset_seed))
+    journal = args.name+'.journal'
+    nworkers = args.jobs if args.jobs else default_workers(args.cpu_per_job)
+    calculators = {}
+
+    alive = list(range(len(configs)))
+    dropped = {}
+    rungs = []
+    result = None
+    for size in rung_sizes(len(todock), args.start, args.growth):
+        systems = order[:size]
+        todo = [parse_command(commands[c][i]) for c in alive for i in systems]
+        done = load_journal(journal)
+        todo = [job for job in todo if not output_complete(job.out) and done.get(job.out, {}).get('status') != 'failed']
+        print(f'rung of {size} systems: {len(alive)} configurations, {len(todo)} commands to run')
+        with open(args.name+'.cmds', 'a') as outfile:
+            outfile.write(''.join(job.line+'\n' for job in todo))
+        if todo:
+            run_commands(prepare(todo, args.gnina, args.cpu_per_job), nworkers, journal, verbose=False)
+
+        result, failed = evaluate(alive, systems, commands, todock, calculators, args)
+        if failed:
+            print(f'  failed commands, counted as misses: {", ".join(f"{labels[c]} {n}" for c, n in failed.items())}')
+        stats = {int(t): {f'top{args.top}': result.topn[k, args.top-1, 0], 'lower': result.lower[k, args.top-1, 0],
+                          'upper': result.upper[k, args.top-1, 0], 'systems': int(result.nsystems[k])} for k, t in enumerate(result.tags)}
+        score = {c: stats[c][f'top{args.top}'] if c in stats else -1 for c in alive}
+        lose = dominated(result, args.top) if size < len(todock) else set()
+        keep = [c for c in alive if c not in lose]
+        if args.eta > 1 and size < len(todock):
+            keep = sorted(keep, key=lambda c: -score[c])[:max(1, int(math.ceil(len(alive)/args.eta)))]
+        for c in alive:
+            if c not in keep:
+                dropped[c] = dict(stats.get(c, {}), dropped_at=size)
+        rungs.append({'systems': size, 'configs': [labels[c] for c in alive], 'dropped': [labels[c] for c in alive if c not in keep],
+                      'failed': {labels[c]: n for c, n in failed.items()}})
+        print(f'  dropped: {", ".join(labels[c] for c in alive if c not in keep) or "none"}')
+        alive = [c for c in alive if c in keep]
+
+    # accounting over every command of the sweep that has run, in this or earlier invocations
+    recs = load_journal(journal)
+    all_outs = [parse_command(cmd).out for cmds in commands for cmd in cmds]
+    ran = [recs[out] for out in all_outs if out in recs]
+    docked = len(ran)
+    elapsed = sum(rec['elapsed'] for rec in ran)
+    full = len(all_outs)
+    # survivors by their full-set TopN, then the dropped configurations, latest dropped first
+    final = {int(t): {f'top{args.top}': result.topn[k, args.top-1, 0], 'lower': result.lower[k, args.top-1, 0],
+                      'upper': result.upper[k, args.top-1, 0], 'systems': int(result.nsystems[k])} for k, t in enumerate(result.tags)}
+    ranking = [dict(final[c], config=labels[c]) for c in sorted(final, key=lambda c: -final[c][f'top{args.top}'])]
+    ranking += [dict(dropped[c], config=labels[c]) for c in sorted(dropped, key=lambda c: (-dropped[c]['dropped_at'], -dropped[c].get(f'top{args.top}', -1)))]
+    report = {
+        'rungs': rungs,
+        'ranking': ranking,
+        'commands_run': docked,
+        'commands_full_sweep': full,
+        'fraction_saved': 1-docked/full if full else 0,
+        'elapsed_run': elapsed,
+        'elapsed_full_sweep_estimate': elapsed/docked*full if docked else None,
+    }
+    with open(args.name+'.json', 'w') as outfile:
+        json.dump(report, outfile, indent=1, default=float)
+
+    print(f'ran {docked} of {full} commands ({report["fraction_saved"]*100:.1f}% saved)')
+    for rank in ranking:
+        if f'top{args.top}' not in rank:
+            print(f"{rank['config']:<40} no successful runs, dropped after {rank['dropped_at']} systems")
+            continue
+        note = f", dropped after {rank['dropped_at']} systems" if 'dropped_at' in rank else ''
+        print(f"{rank['config']:<40} top{args.top} {rank[f'top{args.top}']:6.2f} [{rank['lower']:6.2f}, {rank['upper']:6.2f}] over {rank['systems']} systems{note}")
+
+
+if __name__ == '__main__':
+    main()
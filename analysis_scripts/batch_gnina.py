@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+'''
+Batches gnina commands that only differ in their ligand into one multi-ligand gnina run.
+
+Every command from make_gnina_cmds.py is its own gnina process, which reads and grids the receptor
+and loads every CNN model of the ensemble before docking a single ligand. For cross-docking many
+ligands share a receptor and box, and for short rescore-only runs that startup is much of the cost.
+
+plan groups the commands by everything but --ligand/--out (receptor, autobox ligand, CNN models,
+sweep options), concatenates the ligands of a group into one sdf whose titles are prefixed with
+the index of their command, and writes one gnina command per group. Those run like any other
+command file (run_gnina_cmds.py, job_scheduler.py). split then cuts each batched output back into
+the per-pair .sdf.gz files named in the original commands, with the original titles, so
+obrms_calc.py and coalescer.py work on the original command file as before.
+
+Commands with finished outputs are left out, commands that can not be batched (non-sdf ligand,
+--out_flex, no other command to group with) are copied unchanged, and pairs a batch did not
+produce poses for (e.g. the batch failed) are written by split to <input>.fallback to run alone.
+
+gnina seeds its random number generator once per run, so with the fixed --seed of make_gnina_cmds.py
+a batched ligand docks differently than on its own, and differently in another batch. split writes
+the batch of every output to <output>.batch (gnina_jobs.write_batch_membership): result_cache.py
+keys such outputs with their batch and make_gnina_cmds.py --registry does not reuse them for the
+command run on its own.
+
+Usage:
+        python batch_gnina.py plan -i cd_sweep.txt -o cd_sweep_batched.txt --batch_dir batches
+        python run_gnina_cmds.py -i cd_sweep_batched.txt
+        python batch_gnina.py split -i cd_sweep_batched.txt
+'''
+
+import argparse, gzip, json, os
+from gnina_jobs import ALIASES, parse_command, read_commands, write_batch_membership
+from run_gnina_cmds import output_complete, partial_name
+from sdf_stream import blocks
+
+MARK = '|'  # titles in a batch are '<index>|<original title>'
+PER_PAIR = {'--ligand', '--out'}
+UNBATCHABLE = {'--out_flex', '--log'}
+
+
+def batch_key(tokens):
+    '''
+    The command without its ligand and output, or None if it can not be batched.
+    '''
+
+    key = []
+    skip = False
+    for tok in tokens:
+        flag = ALIASES.get(tok, tok)
+        if skip:
+            skip = False
+        elif flag in UNBATCHABLE:
+            return None
+        elif flag in PER_PAIR:
+            skip = True
+        else:
+            key.append(tok)
+    return tuple(key)
+
+
+def open_out(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt')
+    return open(path, 'w')
+
+
+def ligand_of(job):
+    for flag, val in zip(job.tokens, job.tokens[1:]):
+        if ALIASES.get(flag, flag) == '--ligand':
+            return val
+    return None
+
+
+def write_ligands(jobs, filename):
+    '''
+    Concatenate the ligand files of jobs into filename, tagging every title with the job's index in the batch.
+    '''
+
+    with open(filename, 'w') as outfile:
+        for i, job in enumerate(jobs):
+            for block in blocks(ligand_of(job)):
+                outfile.write(f'{i}{MARK}{block[0]}\n')
+                outfile.write(''.join(line+'\n' for line in block[1:]))
+                outfile.write('$$$$\n')
+
+
+def plan(jobs, batch_dir, max_ligands):
+    '''
+    (command lines, manifest) of the batched run. The manifest maps every batch output to the
+    original commands in it.
+    '''
+
+    groups = {}
+    lines = []
+    for job in jobs:
+        if job.out and output_complete(job.out):
+            continue
+        key = batch_key(job.tokens)
+        lig = ligand_of(job)
+        if key is None or job.out is None or lig is None or not lig.split('.gz')[0].endswith('.sdf'):
+            lines.append(job.line)
+        else:
+            groups.setdefault(key, []).append(job)
+
+    os.makedirs(batch_dir, exist_ok=True)
+    manifest = {}
+    n = 0
+    for key, group in groups.items():
+        for start in range(0, len(group), max_ligands):
+            chunk = group[start:start+max_ligands]
+            if len(chunk) == 1:
+                lines.append(chunk[0].line)
+                continue
+            name = os.path.join(batch_dir, f'batch{n:05d}')
+            n += 1
+            write_ligands(chunk, name+'.lig.sdf')
+            out = name+'.sdf.gz'
+            lines.append(' '.join(list(key)+['-l', name+'.lig.sdf', '--out', out]))
+            manifest[out] = [job.line for job in chunk]
+    return lines, manifest
+
+
+def split_output(batch_out, outs, members=None):
+    '''
+    Write the poses of a batched output to the outputs of its commands (in batch order), restoring
+    the titles, and record the batch (the command lines members) of each. Returns the number of
+    poses written to each.
+    '''
+
+    counts = [0]*len(outs)
+    files = {}
+    try:
+        for block in blocks(batch_out):
+            index, _, title = block[0].partition(MARK)
+            i = int(index)
+            if i not in files:
+                files[i] = open_out(partial_name(outs[i]))
+            files[i].write(title+'\n'+''.join(line+'\n' for line in block[1:])+'$$$$\n')
+            counts[i] += 1
+    finally:
+        for f in files.values():
+            f.close()
+    for i in files:
+        os.replace(partial_name(outs[i]), outs[i])
+        if members is not None:
+            write_batch_membership(outs[i], members, i)
+    return counts
+
+
+def split(manifest, clean=False):
+    '''
+    Split every finished batch of the manifest, returning the original commands still without output.
+    '''
+
+    missing = []
+    for batch_out, cmds in manifest.items():
+        jobs = [parse_command(line) for line in cmds]
+        if not output_complete(batch_out):
+            missing += [job.line for job in jobs if not output_complete(job.out)]
+            continue
+        counts = split_output(batch_out, [job.out for job in jobs], cmds)
+        missing += [job.line for job, count in zip(jobs, counts) if count == 0]
+        if clean:
+            os.remove(batch_out)
+    return missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run gnina commands that share a receptor and settings as one multi-ligand command, then split the outputs back per pair.')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    p = sub.add_parser('plan', help='Write the batched command file.')
+    p.add_argument('-i', '--input', required=True, help='Command file from make_gnina_cmds.py.')
+    p.add_argument('-o', '--output', required=True, help='Batched command file to write, its manifest goes to <output>.manifest')
+    p.add_argument('--batch_dir', default='gnina_batches', help='Directory for the batch ligand files and outputs (default: %(default)s)')
+    p.add_argument('--max_ligands', type=int, default=32, help='Most ligands per gnina run, so one bad ligand does not fail a whole receptor (default: %(default)d)')
+    s = sub.add_parser('split', help='Split finished batched outputs into the per-pair outputs.')
+    s.add_argument('-i', '--input', required=True, help='Batched command file written by plan.')
+    s.add_argument('--clean', action='store_true', help='Flag to remove the batched outputs once they are split.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'plan':
+        jobs = read_commands(args.input)
+        lines, manifest = plan(jobs, args.batch_dir, args.max_ligands)
+        with open(args.output, 'w') as outfile:
+            outfile.write(''.join(line+'\n' for line in lines))
+        with open(args.output+'.manifest', 'w') as outfile:
+            json.dump(manifest, outfile, indent=1)
+        batched = sum(len(cmds) for cmds in manifest.values())
+        print(f'{len(jobs)} commands: {batched} in {len(manifest)} batches, {len(lines)-len(manifest)} run alone')
+    else:
+        with open(args.input+'.manifest') as infile:
+            manifest = json.load(infile)
+        missing = split(manifest, args.clean)
+        with open(args.input+'.fallback', 'w') as outfile:
+            outfile.write(''.join(line+'\n' for line in missing))
+        print(f'split {len(manifest)} batches, {len(missing)} commands without poses written to {args.input}.fallback')
+
+
+if __name__ == '__main__':
+    main()
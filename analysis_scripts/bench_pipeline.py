@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+'''
+End-to-end benchmark of the analysis pipeline on synthetic docking outputs.
+
+Generates a production sized data set offline (no gnina, obrms or network needed): pockets of
+related receptors, reference ligands, docked .sdf.gz files with --poses poses per system and the
+CNNscore/CNNaffinity/minimizedAffinity tags for every sweep value, plus the command, pairs and
+dirs files the scripts take. Then every stage is run as the nightly refresh runs it, each in a
+fresh interpreter, and timed:
+        scores      -- reading the score tags of every pose (sdf_stream.py)
+        rmsd        -- obrms_calc.py --getscores, writing the .rmsds files
+        coalesce    -- coalescer.py --rebuild into one master table
+        topn        -- generate_RMSD_graphs.getPlottingDataFrame on the master table
+        plot        -- generate_RMSD_graphs.py line and bar graphs
+        pocketdiff  -- pocketdiff.py on --pocket_pairs pairs (needs prody and openbabel)
+For each stage the wall time, user/system CPU and peak RSS of the process (from wait4) and the
+throughput are reported, as a table or JSON (--json) to compare between versions.
+
+Input:
+        systems        -- docked systems, 4260 for the redocking set, 7970 for cross-docking
+        poses          -- poses per docked output
+        tags           -- sweep values per system (each one is a docked output)
+        workdir        -- where to generate the data, reused if it already holds the same data set
+
+Output:
+        a table on stdout, or JSON with --json
+'''
+
+import argparse, gzip, json, os, shutil, statistics, subprocess, sys, tempfile, time
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['scores', 'rmsd', 'coalesce', 'topn', 'plot', 'pocketdiff']
+SUFFIX = 'default_ensemble_rescore_exhaustiveness'
+RESIDUES = ['ALA', 'SER', 'LEU', 'VAL', 'THR', 'ASP', 'GLU', 'LYS', 'ARG', 'PHE', 'ILE', 'ASN']
+ELEMENTS = ['C']*6+['N', 'O']
+
+SCORES_SNIPPET = '''
+import glob
+from sdf_stream import records, tag_values
+n = 0
+for path in sorted(glob.glob('root/*/*.sdf.gz')):
+    for rec in records(path):
+        tag_values(rec, ['CNNscore', 'CNNaffinity', 'minimizedAffinity'])
+        n += 1
+print(n)
+'''
+
+TOPN_SNIPPET = '''
+import sys
+from generate_RMSD_graphs import getPlottingDataFrame
+tags = sys.argv[3:]
+getPlottingDataFrame(sys.argv[1], tags, ['tag', 'rmsd', 'rec'], 'infer', ',', [0, 2, 7], ['rec', 'tag'], int(sys.argv[2]))
+'''
+
+
+def random_ligand(rng, center):
+    '''
+    (elements, coords, bonds) of a random tree shaped molecule of 15-40 heavy atoms around center.
+    '''
+
+    natoms = int(rng.integers(15, 41))
+    coords = np.empty((natoms, 3))
+    coords[0] = center
+    bonds = []
+    for i in range(1, natoms):
+        j = int(rng.integers(max(0, i-4), i))
+        step = rng.normal(size=3)
+        coords[i] = coords[j]+1.5*step/np.linalg.norm(step)
+        bonds.append((j, i))
+    elements = [ELEMENTS[k] for k in rng.integers(0, len(ELEMENTS), natoms)]
+    return elements, coords, bonds
+
+
+def molblock(title, elements, coords, bonds, tags=()):
+    '''
+    One V2000 sdf record with the given SD tags, terminator included.
+    '''
+
+    lines = [title, '  bench_pipeline', '', f'{len(elements):3d}{len(bonds):3d}  0  0  0  0  0  0  0  0999 V2000']
+    lines += [f'{x:10.4f}{y:10.4f}{z:10.4f} {e:<3} 0  0  0  0  0  0  0  0  0  0  0  0' for e, (x, y, z) in zip(elements, coords)]
+    lines += [f'{a+1:3d}{b+1:3d}  1  0  0  0  0' for a, b in bonds]
+    lines.append('M  END')
+    for name, value in tags:
+        lines += [f'> <{name}>', value, '']
+    lines.append('$$$$')
+    return '\n'.join(lines)+'\n'
+
+
+def protein(rng, sequence):
+    '''
+    Backbone and CB coordinates of a random walk chain, one (names, coords) per residue.
+    '''
+
+    residues = []
+    ca = np.zeros(3)
+    for _ in sequence:
+        step = rng.normal(size=3)
+        ca = ca+3.8*step/np.linalg.norm(step)
+        offsets = rng.normal(scale=0.8, size=(5, 3))
+        offsets[1] = 0
+        residues.append((['N', 'CA', 'C', 'O', 'CB'], ca+offsets))
+    return residues
+
+
+def pdb_text(sequence, residues, noise, rng):
+    lines = []
+    serial = 1
+    for resnum, (resname, (names, coords)) in enumerate(zip(sequence, residues), 1):
+        for name, (x, y, z) in zip(names, coords+rng.normal(scale=noise, size=coords.shape)):
+            lines.append(f'ATOM  {serial:5d}  {name:<3} {resname} A{resnum:4d}    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00           {name[0]}')
+            serial += 1
+    return '\n'.join(lines+['END'])+'\n'
+
+
+def generate(workdir, systems, poses, ntags, per_pocket, seed):
+    '''
+    Write the synthetic data set to workdir. Returns its description (also saved as dataset.json).
+    '''
+
+    rng = np.random.default_rng(seed)
+    tags = [str(4*2**k) for k in range(ntags)]
+    root = os.path.join(workdir, 'root')
+    cmds, pairs, dirs = [], [], []
+    nsystems = 0
+    pocket = 0
+    recs = set()
+    while nsystems < systems:
+        pname = f'P{pocket:04d}'
+        pdir = os.path.join(root, pname)
+        os.makedirs(pdir, exist_ok=True)
+        dirs.append(pname+'/')
+        codes = [f'{pocket % 1000:03d}{chr(65+k)}' for k in range(per_pocket)]
+        sequence = [RESIDUES[k] for k in rng.integers(0, len(RESIDUES), 60)]
+        residues = protein(rng, sequence)
+        ligands = {}
+        for code in codes:
+            with open(os.path.join(pdir, code+'_PRO.pdb'), 'w') as outfile:
+                outfile.write(pdb_text(sequence, residues, 0.3, rng))
+            center = residues[int(rng.integers(len(residues)))][1][1]+rng.normal(scale=1.0, size=3)
+            ligands[code] = random_ligand(rng, center)
+            with open(os.path.join(pdir, code+'_LIG_aligned.sdf'), 'w') as outfile:
+                outfile.write(molblock(code, *ligands[code]))
+        for r in codes:
+            for l in codes:
+                if r == l or nsystems >= systems:
+                    continue
+                nsystems += 1
+                recs.add(pname+r)
+                rec = f'root/{pname}/{r}_PRO.pdb'
+                lig = f'root/{pname}/{l}_LIG_aligned.sdf'
+                box = f'root/{pname}/{r}_LIG_aligned.sdf'
+                prefix = f'root/{pname}/{r}_PRO_{l}_LIG_aligned_v2_'
+                pairs.append(f'{rec} {lig} {box} {prefix}')
+                elements, coords, bonds = ligands[l]
+                for tag in tags:
+                    out = prefix+SUFFIX+tag+'.sdf.gz'
+                    cmds.append(f'gnina -r {rec} -l {lig} --autobox_ligand {box} --cnn_scoring rescore --cpu 1 --seed 420 --out {out} --exhaustiveness {tag}')
+                    with gzip.open(os.path.join(workdir, out), 'wt', compresslevel=6) as outfile:
+                        for k in range(poses):
+                            moved = coords+rng.normal(scale=rng.uniform(0.2, 3.0), size=coords.shape)
+                            scores = (('minimizedAffinity', f'{rng.normal(-7, 1.5):.5f}'), ('CNNscore', f'{rng.uniform():.5f}'),
+                                      ('CNNaffinity', f'{rng.normal(6, 1):.5f}'))
+                            outfile.write(molblock(l, elements, moved, bonds, scores))
+        pocket += 1
+
+    for name, lines in (('cmds.txt', cmds), ('pairs.txt', pairs), ('dirs.txt', dirs)):
+        with open(os.path.join(workdir, name), 'w') as outfile:
+            outfile.write(''.join(line+'\n' for line in lines))
+    return {'systems': nsystems, 'receptors': len(recs), 'pockets': pocket, 'poses': poses, 'tags': tags,
+            'outputs': len(cmds), 'total_poses': len(cmds)*poses}
+
+
+def run_stage(cmd, workdir, before=None):
+    '''
+    Run one stage command in workdir. Returns (returncode, wall seconds, rusage, stderr).
+    '''
+
+    if before:
+        before()
+    env = dict(os.environ, PYTHONPATH=HERE+os.pathsep+os.environ.get('PYTHONPATH', ''), MPLBACKEND='Agg')
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    err = proc.stderr.read()
+    proc.stderr.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, time.perf_counter()-start, usage, err
+
+
+def stage_commands(workdir, data, pocket_pairs, processes):
+    '''
+    {stage: (command, units of work, unit name, setup function or None)} for the data set.
+    '''
+
+    py = sys.executable
+    tags = [SUFFIX+tag for tag in data['tags']]
+
+    def fresh_pocketdiff():
+        for name in ('pocketdiff.csv', 'pocketdiff.csv.progress'):
+            if os.path.exists(os.path.join(workdir, name)):
+                os.remove(os.path.join(workdir, name))
+
+    return {
+        'scores': ([py, '-c', SCORES_SNIPPET], data['total_poses'], 'poses', None),
+        'rmsd': ([py, os.path.join(HERE, 'obrms_calc.py'), '-i', 'cmds.txt', '-d', 'root', '--getscores'], data['total_poses'], 'poses', None),
+        'coalesce': ([py, os.path.join(HERE, 'coalescer.py'), '-s', SUFFIX, '-v']+data['tags']+['-r', 'root', '-o', 'master.csv', '-d', 'dirs.txt', '--getscores', '--rebuild'],
+                     data['total_poses'], 'rows', None),
+        'topn': ([py, '-c', TOPN_SNIPPET, 'master.csv', str(data['receptors'])]+tags, data['total_poses'], 'rows', None),
+        'plot': ([py, os.path.join(HERE, 'generate_RMSD_graphs.py'), '-C', 'master.csv', '-N']+tags+['-U', str(data['receptors']), '-F', 'bench', '--line_graph', '--bar_graph'],
+                 data['total_poses'], 'rows', None),
+        'pocketdiff': ([py, os.path.join(HERE, 'pocketdiff.py'), '-i', 'pocket_pairs.txt', '-r', '.', '-o', 'pocketdiff.csv', '--strip', '', '-j', str(processes)],
+                       pocket_pairs, 'pairs', fresh_pocketdiff),
+    }
+
+
+def importable(module):
+    import importlib.util
+    return importlib.util.find_spec(module) is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every stage of the analysis pipeline on a synthetic, production sized data set.')
+    parser.add_argument('--systems', type=int, default=4260, help='Number of docked systems, 7970 for the cross-docking set (default: %(default)d)')
+    parser.add_argument('--poses', type=int, default=9, help='Poses per docked output (default: %(default)d)')
+    parser.add_argument('--tags', type=int, default=3, help='Sweep values, each one a docked output per system (default: %(default)d)')
+    parser.add_argument('--per_pocket', type=int, default=10, help='Receptor structures per pocket, systems are their cross-docking pairs (default: %(default)d)')
+    parser.add_argument('--pocket_pairs', type=int, default=200, help='Pairs given to pocketdiff.py (default: %(default)d)')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='Processes for pocketdiff.py (default: %(default)d)')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='Stages to time, in order (default: all). Each stage reads what the one before it wrote, so timing a later stage alone needs a --workdir that has been through the earlier ones')
+    parser.add_argument('-n', '--repeats', type=int, default=1, help='Runs of each stage, the median is reported (default: %(default)d)')
+    parser.add_argument('--workdir', default=None, help='Directory for the data set, kept and reused by later runs with the same data options. Defaults to a temporary directory')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the data set (default: %(default)d)')
+    parser.add_argument('--label', default='', help='Name of this run in the JSON, e.g. the version being benchmarked.')
+    parser.add_argument('--json', action='store_true', help='Flag to print the results as JSON.')
+    args = parser.parse_args()
+    assert 2 <= args.per_pocket <= 26, 'per_pocket must be between 2 and 26'
+
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='bench_pipeline_')
+    os.makedirs(workdir, exist_ok=True)
+    params = {'systems': args.systems, 'poses': args.poses, 'tags': args.tags, 'per_pocket': args.per_pocket, 'seed': args.seed}
+    described = os.path.join(workdir, 'dataset.json')
+    data = None
+    if os.path.isfile(described):
+        with open(described) as infile:
+            saved = json.load(infile)
+        if saved['params'] == params:
+            data = saved['data']
+    gen_seconds = 0
+    if data is None:
+        start = time.perf_counter()
+        data = generate(workdir, args.systems, args.poses, args.tags, args.per_pocket, args.seed)
+        gen_seconds = time.perf_counter()-start
+        with open(described, 'w') as outfile:
+            json.dump({'params': params, 'data': data}, outfile, indent=1)
+    with open(os.path.join(workdir, 'pairs.txt')) as infile:
+        with open(os.path.join(workdir, 'pocket_pairs.txt'), 'w') as outfile:
+            outfile.writelines(infile.readlines()[:args.pocket_pairs])
+    pocket_pairs = min(args.pocket_pairs, data['systems'])
+
+    stages = stage_commands(workdir, data, pocket_pairs, args.processes)
+    results = {'label': args.label, 'python': sys.executable, 'params': params, 'data': data,
+               'generate_seconds': gen_seconds, 'stages': {}}
+    for name in args.stages:
+        cmd, units, unit, before = stages[name]
+        if name == 'pocketdiff' and not all(importable(m) for m in ('prody', 'openbabel', 'scipy')):
+            results['stages'][name] = {'skipped': 'needs prody, openbabel and scipy'}
+            continue
+        runs = []
+        for _ in range(args.repeats):
+            returncode, seconds, usage, err = run_stage(cmd, workdir, before)
+            if returncode != 0:
+                runs = None
+                results['stages'][name] = {'returncode': returncode, 'stderr': err[-2000:]}
+                break
+            runs.append((seconds, usage))
+        if runs is None:
+            continue
+        seconds = [s for s, _ in runs]
+        median = statistics.median(seconds)
+        results['stages'][name] = {
+            'seconds': median, 'min': min(seconds),
+            'user': statistics.median(u.ru_utime for _, u in runs), 'sys': statistics.median(u.ru_stime for _, u in runs),
+            'maxrss_kb': max(u.ru_maxrss for _, u in runs),
+            'units': units, 'unit': unit, 'per_second': units/median if median else None,
+        }
+
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+
+    print(f"{data['systems']} systems ({data['receptors']} receptors, {data['pockets']} pockets), {data['outputs']} outputs, {data['total_poses']} poses")
+    if gen_seconds:
+        print(f'generated in {gen_seconds:.1f} s')
+    print(f"{'stage':<12}{'wall s':>9}{'cpu s':>9}{'peak MiB':>10}{'throughput':>22}")
+    for name, res in results['stages'].items():
+        if 'skipped' in res:
+            print(f"{name:<12}  skipped, {res['skipped']}")
+        elif 'seconds' not in res:
+            print(f"{name:<12}  failed ({res['returncode']}): {res['stderr'].strip().splitlines()[-1] if res['stderr'].strip() else ''}")
+        else:
+            rate = f"{res['per_second']:.0f} {res['unit']}/s"
+            print(f"{name:<12}{res['seconds']:9.2f}{res['user']+res['sys']:9.2f}{res['maxrss_kb']/1024:10.0f}{rate:>22}")
+
+
+if __name__ == '__main__':
+    main()
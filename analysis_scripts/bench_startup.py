@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+'''
+Cold-start benchmark of the analysis commands.
+
+Workflow engines call these scripts thousands of times, so the cost of starting the interpreter and
+importing a script matters as much as the work it does. For every command this times, in fresh
+interpreters, `python <script> --help` (argument parsing, what every call pays) and a bare import of
+the module (what a notebook or another script pays), and reports the median and best of the repeats.
+With --profile the slowest imports of each command are listed, from python -X importtime.
+
+Input:
+        commands       -- scripts to time, defaults to every command in this directory
+        repeats        -- number of fresh interpreters per measurement
+
+Output:
+        a table on stdout, or JSON with --json
+'''
+
+import argparse, json, os, statistics, subprocess, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMMANDS = ['coalescer.py', 'generate_RMSD_graphs.py', 'job_scheduler.py', 'make_gnina_cmds.py',
+            'obrms_calc.py', 'pocketdiff.py', 'rmsd_engine.py', 'run_gnina_cmds.py', 'topn.py']
+
+
+def time_call(cmd, repeats):
+    '''
+    Wall times (s) of repeats runs of cmd, None if it fails.
+    '''
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter()-start)
+        if proc.returncode != 0:
+            return None
+    return times
+
+
+def slowest_imports(module, top=5):
+    '''
+    The top cumulative import times (us, package) of the modules imported directly by module, from -X importtime.
+    '''
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=HERE,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    found = []
+    children = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name)-len(name.lstrip()))//2
+        if depth == 0:
+            # importtime lists a module after everything it imported
+            if name.strip() == module:
+                found = children
+            children = []
+        elif depth == 1:
+            children.append((int(cumulative), name.strip()))
+    return sorted(found, reverse=True)[:top]
+
+
+def bench(commands, repeats, profile=False):
+    baseline = time_call([sys.executable, '-c', 'pass'], repeats)
+    results = {'python': sys.executable, 'repeats': repeats, 'interpreter': min(baseline), 'commands': {}}
+    for script in commands:
+        module = os.path.splitext(os.path.basename(script))[0]
+        res = {}
+        for kind, cmd in (('help', [sys.executable, script, '--help']), ('import', [sys.executable, '-c', f'import {module}'])):
+            times = time_call(cmd, repeats)
+            res[kind] = None if times is None else {'median': statistics.median(times), 'min': min(times)}
+        if profile:
+            res['slowest_imports'] = slowest_imports(module)
+        results['commands'][script] = res
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the cold start (--help and import) of the analysis commands.')
+    parser.add_argument('commands', nargs='*', default=COMMANDS, help='Scripts to time. Defaults to all of the commands.')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='Number of runs of each measurement. Defaults to 5')
+    parser.add_argument('--profile', action='store_true', help='Flag to also list the slowest imports made by each command.')
+    parser.add_argument('--json', action='store_true', help='Flag to print the results as JSON.')
+    args = parser.parse_args()
+
+    results = bench(args.commands, args.repeats, args.profile)
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+
+    def fmt(res):
+        return '  failed' if res is None else f"{res['median']*1000:8.1f}"
+
+    print(f"bare interpreter: {results['interpreter']*1000:.1f} ms (best of {args.repeats})")
+    print(f"{'command':<26}{'--help ms':>10}{'import ms':>10}")
+    for script, res in results['commands'].items():
+        print(f"{script:<26}{fmt(res['help']):>10}{fmt(res['import']):>10}")
+        for us, name in res.get('slowest_imports', []):
+            print(f"    {name:<30}{us/1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,433 @@
 #!/usr/bin/env python3
 
 '''
-Script to merge all of the *.rmsds files from obrms_calc.py into 1 master csv.
-'''
+Script to merge all of the *.rmsds files from obrms_calc.py into 1 master table.
+
+The merge is incremental: a manifest (<outfilename>.manifest.json) records the path, mtime and size
+of every .rmsds file already ingested, and each run only reads files that are new or changed.
+	csv     -- new files are appended to the csv. If a file changed or disappeared the csv is rebuilt.
+	           The manifest holds the size of the csv, so rows appended by a run that died before
+	           saving its manifest are cut off by the next one.
+	parquet -- typed columnar output partitioned by tag (<outfilename>/tag=<TAG>/part-*.parquet)
+	feather    with rec, lig, pocket and tag stored as dictionary-encoded categoricals. Only the parts
+	           holding changed files are rewritten.
 
-import argparse, glob, re
+--index_tags adds more SD tags of the docked poses as columns, read from the sdf_index.py index of
+each docked output so the sdf files themselves are not decompressed again.
 
-parser=argparse.ArgumentParser(description='Merge OBRMS output files into 1 file')
-parser.add_argument('-s','--suffix',type=str, required=True, help='Suffix of files to stick together. Assumes filenames are *<SUFFIX><VALUE>.rmsds')
-parser.add_argument('-v','--values',type=str, default="",nargs='+',help='Values to be searched combined with suffix. Defaults to empty string. Accepts any number of arguments.')
-parser.add_argument('-r','--dataroot',type=str,required=True, help='Root of directories to search')
-parser.add_argument('-o','--outfilename',type=str,required=True, help='Name of output file')
-parser.add_argument('-d','--dirlist',type=str,required=True, help='File containing directory names to work on.')
-parser.add_argument('--getscores',action='store_true',help='Flag to expect CNNscore, CNNaffinity, and minimizedAffinity data fields in the .rmsds file.')
+iter_master reads any of these back in bounded chunks, for aggregations like topn.stream_topn.
+
+With --journals the run_gnina_cmds.py journals of the runs are turned into <outfilename>.costs.csv,
+one row per docking with its wall time, CPU time and peak memory, keyed by the same (tag, rec, lig)
+as the RMSD table so accuracy can be set against cost (generate_RMSD_graphs.py --cost_graph).
+'''
 
-args=parser.parse_args()
+import argparse, glob, json, os, re, time
+from fnmatch import fnmatch
+from urllib.parse import quote, unquote
 
-if args.dataroot[-1]!='/':
-	root=args.dataroot+'/'
-else:
-	root=args.dataroot
+COLUMNS=['tag','molids','rmsd','pocket','rec','lig']
+SCORE_COLUMNS=['tag','molids','rmsd','cnnscore','cnnaffinity','minimizedAffinity','pocket','rec','lig']
+FLOAT_COLUMNS=['rmsd','cnnscore','cnnaffinity','minimizedAffinity']
+CATEGORY_COLUMNS=['tag','pocket','rec','lig','source']
+COST_COLUMNS=['tag','pocket','rec','lig','status','returncode','elapsed','user','sys','maxrss_kb']
 
-dirs=[x.rstrip() for x in open(args.dirlist).readlines()]
+def rec_lig_from_path(item):
+	'''
+	Receptor and ligand names for a .rmsds file.
 
-with open(args.outfilename, 'w') as outfile:
-	if args.getscores:
-		outfile.write('tag,molids,rmsd,cnnscore,cnnaffinity,minimizedAffinity,pocket,rec,lig\n')
+	If the _PRO_..._LIG match fails, we assume that redocking is happening
+	  So the first 4 characters of the filename are the corresponding PDB code
+	'''
+
+	m=re.search(r'(\S+)_PRO_(\S+)_LIG',item)
+	if m is None:
+		rec=item.split('/')[-1][:4]
+		lig=item.split('/')[-1][:4]
 	else:
-		outfile.write('tag,molids,rmsd,pocket,rec,lig\n')
+		rec=m.group(1)
+		lig=m.group(2)
+	return rec,lig
+
+def find_rmsds(root, dirs, suffix, values):
+	'''
+	Yield (pocket, value, filename) for every *<SUFFIX><VALUE>.rmsds file, in the same order as
+	globbing every pocket/value pair, but with one directory listing per pocket.
+	'''
+
 	for pocket in dirs:
-		print(pocket)
-		for val in args.values:
-			todo=glob.glob(root+pocket+'*'+args.suffix+val+'.rmsds')
-
-			for item in todo:
-				lines2write=[x.rstrip() for x in open(item).readlines()]
-
-				for line in lines2write:
-
-					if line:
-						if args.getscores:
-							tag,molids,rmsd,cnnscore,cnnaff,vina=line.rstrip().split()
-						else:
-							tag,molids,rmsd=line.rstrip().split()
-						if val!="":
-							tag=val
-						m=re.search(r'(\S+)_PRO_(\S+)_LIG',item)
-
-						#if the match fails, we assume that redocking is happening
-						#   So the first 4 characters of the filename are the corresponding PDB code
-						if m is None:
-							rec=item.split('/')[-1][:4]
-							lig=item.split('/')[-1][:4]
-						else:
-							rec=m.group(1)
-							lig=m.group(2)
-
-						if args.getscores:
-							newline=f"{tag},{molids},{rmsd},{cnnscore},{cnnaff},{vina},{pocket},{rec},{lig}\n"#line.replace(' ',',').rstrip()+','+','.join([pocket,rec,lig])+'\n'
-						else:
-							newline=f"{tag},{molids},{rmsd},{pocket},{rec},{lig}\n"#line.replace(' ',',').rstrip()+','+','.join([pocket,rec,lig])+'\n'
-
-						outfile.write(newline)
+		found=glob.glob(root+pocket+'*'+suffix+'*.rmsds')
+		for val in values:
+			pattern=root+pocket+'*'+suffix+val+'.rmsds'
+			for item in found:
+				if fnmatch(item,pattern):
+					yield pocket,val,item
+
+def docked_tags(item, names):
+	'''
+	Values of the SD tags in names for every pose of the docked output of a .rmsds file, read from
+	its sdf_index.py index (built if missing) instead of the sdf.
+	'''
+
+	from sdf_index import load_or_build
+
+	base=item[:-len('.rmsds')]
+	for path in (base+'.sdf.gz',base+'.sdf'):
+		if os.path.exists(path):
+			index=load_or_build(path)
+			return list(zip(*[index.column(name) for name in names]))
+	return []
+
+def read_rmsds(item, pocket, val, getscores, index_tags=[]):
+	'''
+	Rows (tuples of strings, in the column order of the master table) of one .rmsds file.
+	index_tags are appended from the docked output's index, 'nan' where a pose lacks them.
+	'''
+
+	rec,lig=rec_lig_from_path(item)
+	extra=docked_tags(item,index_tags) if index_tags else []
+	missing=('nan',)*len(index_tags)
+	rows=[]
+	with open(item) as infile:
+		for line in infile:
+			fields=line.split()
+			if not fields:
+				continue
+			if val!="":
+				fields[0]=val
+			if getscores:
+				tag,molids,rmsd,cnnscore,cnnaff,vina=fields
+				row=(tag,molids,rmsd,cnnscore,cnnaff,vina,pocket,rec,lig)
+			else:
+				tag,molids,rmsd=fields
+				row=(tag,molids,rmsd,pocket,rec,lig)
+			if index_tags:
+				row+=extra[len(rows)] if len(rows)<len(extra) else missing
+			rows.append(row)
+	return rows
+
+def file_state(item):
+	st=os.stat(item)
+	return [st.st_mtime,st.st_size]
+
+def load_manifest(filename):
+	if os.path.isfile(filename):
+		with open(filename) as infile:
+			return json.load(infile)
+	return None
+
+def save_manifest(filename, manifest):
+	tmp=filename+'.tmp'
+	with open(tmp,'w') as outfile:
+		json.dump(manifest,outfile)
+	os.replace(tmp,filename)
+
+def write_csv(outfilename, rows, header, append):
+	'''
+	Append rows to a csv, or write a new one (through a temporary file, so a crash leaves the old
+	one in place). Returns the size of the csv in bytes.
+	'''
+
+	name=outfilename if append else outfilename+'.tmp'
+	with open(name, 'a' if append else 'w') as outfile:
+		if not append:
+			outfile.write(','.join(header)+'\n')
+		outfile.write(''.join(','.join(row)+'\n' for row in rows))
+		size=outfile.tell()
+	if not append:
+		os.replace(name,outfilename)
+	return size
+
+def rows_to_frame(rows, header, sources, float_columns=FLOAT_COLUMNS):
+	'''
+	Typed DataFrame of rows, with a source column naming the .rmsds file of each row.
+	'''
+
+	import pandas as pd
+
+	df=pd.DataFrame.from_records(rows,columns=header)
+	df['source']=sources
+	for col in header+['source']:
+		if col in float_columns:
+			df[col]=pd.to_numeric(df[col],errors='coerce')
+		elif col in CATEGORY_COLUMNS:
+			df[col]=df[col].astype('category')
+	return df
+
+def _part_path(outdir, tag, fmt, stamp):
+	return os.path.join(outdir,f'tag={quote(tag,safe="")}',f'part-{stamp}.{fmt}')
+
+def write_parts(outdir, df, fmt, stamp):
+	'''
+	Write one part file per tag of df. Returns {part path: [sources in it]}.
+	'''
+
+	parts={}
+	for tag,group in df.groupby('tag',observed=True,sort=False):
+		path=_part_path(outdir,tag,fmt,stamp)
+		os.makedirs(os.path.dirname(path),exist_ok=True)
+		group=group.drop(columns='tag').reset_index(drop=True)
+		for col in CATEGORY_COLUMNS:
+			if col in group:
+				group[col]=group[col].cat.remove_unused_categories()
+		if fmt=='parquet':
+			group.to_parquet(path,index=False)
+		else:
+			group.to_feather(path)
+		parts[path]=sorted(group['source'].unique().tolist())
+	return parts
+
+def drop_sources(parts, fmt, stale):
+	'''
+	Rewrite the part files holding rows of the stale .rmsds files without those rows.
+	'''
+
+	import pandas as pd
+
+	for path in list(parts):
+		if not stale.intersection(parts[path]):
+			continue
+		if not os.path.exists(path):
+			#emptied and removed by a run that died before saving its manifest
+			del parts[path]
+			continue
+		df=pd.read_parquet(path) if fmt=='parquet' else pd.read_feather(path)
+		df=df[~df['source'].isin(stale)]
+		keep=[s for s in parts[path] if s not in stale]
+		if len(df)==0:
+			os.remove(path)
+			del parts[path]
+			continue
+		tmp=path+'.tmp'
+		if fmt=='parquet':
+			df.to_parquet(tmp,index=False)
+		else:
+			df.reset_index(drop=True).to_feather(tmp)
+		os.replace(tmp,path)
+		parts[path]=keep
+
+def tag_dirs(path):
+	'''
+	(directory, tag) of every tag partition of a parquet/feather master table, in directory order.
+
+	Tags are typed the way read_csv types the tag column of the csv master: numbers if every tag
+	parses as one, so they sort the same whichever format the table is in.
+	'''
+
+	import pandas as pd
+
+	dirs=sorted(d for d in os.listdir(path) if d.startswith('tag='))
+	tags=[unquote(d[len('tag='):]) for d in dirs]
+	try:
+		tags=pd.to_numeric(pd.Series(tags,dtype=object)).tolist()
+	except (ValueError,TypeError):
+		pass
+	return list(zip(dirs,tags))
+
+def read_master(path):
+	'''
+	Load a master table written by this script, either the csv or a partitioned parquet/feather directory.
+	'''
+
+	import pandas as pd
+
+	if not os.path.isdir(path):
+		return pd.read_csv(path)
+	frames=[]
+	for tagdir,tag in tag_dirs(path):
+		for part in sorted(os.listdir(os.path.join(path,tagdir))):
+			fname=os.path.join(path,tagdir,part)
+			if part.endswith('.parquet'):
+				df=pd.read_parquet(fname)
+			elif part.endswith('.feather'):
+				df=pd.read_feather(fname)
+			else:
+				continue
+			df.insert(0,'tag',tag)
+			frames.append(df)
+	df=pd.concat(frames,ignore_index=True)
+	for col in CATEGORY_COLUMNS:
+		if col in df:
+			df[col]=df[col].astype('category')
+	return df
+
+def iter_master(path, columns=None, chunksize=1000000):
+	'''
+	Yield a master table written by this script as DataFrames of at most chunksize rows, reading only
+	columns (all if None), so a table too big for memory can be aggregated in one pass. Rows come in
+	the same order as read_master gives them.
+	'''
+
+	import pandas as pd
+
+	if not os.path.isdir(path):
+		yield from pd.read_csv(path,usecols=columns,chunksize=chunksize)
+		return
+	want=None if columns is None else [c for c in columns if c!='tag']
+	addtag=columns is None or 'tag' in columns
+	for tagdir,tag in tag_dirs(path):
+		for part in sorted(os.listdir(os.path.join(path,tagdir))):
+			fname=os.path.join(path,tagdir,part)
+			if part.endswith('.parquet'):
+				import pyarrow.parquet as pq
+				for batch in pq.ParquetFile(fname).iter_batches(batch_size=chunksize,columns=want):
+					df=batch.to_pandas()
+					if addtag:
+						df.insert(0,'tag',tag)
+					yield df
+			elif part.endswith('.feather'):
+				#feather parts are read whole, they hold one coalescer run of one tag
+				df=pd.read_feather(fname,columns=want)
+				if addtag:
+					df.insert(0,'tag',tag)
+				for i in range(0,len(df),chunksize):
+					yield df.iloc[i:i+chunksize]
+
+def journal_costs(journals, root, dirs, suffix, values):
+	'''
+	Rows of the cost table from run_gnina_cmds.py journals: the last record of every output named
+	<DIR>*<SUFFIX><VALUE>.sdf for a directory in dirs, with the tag, pocket, rec and lig that
+	read_rmsds gives its .rmsds file (whatever path the commands were run with).
+	'''
+
+	import pandas as pd
+
+	last={}
+	for journal in journals:
+		with open(journal) as infile:
+			for line in infile:
+				try:
+					rec=json.loads(line)
+				except ValueError:
+					continue
+				if rec.get('out'):
+					last[rec['out']]=rec
+	rows=[]
+	for out,rec in last.items():
+		outdir=os.path.dirname(out)+'/'
+		pocket=next((p for p in dirs if ('/'+outdir).endswith('/'+p.lstrip('/'))),None)
+		stem=os.path.basename(out).split('.sdf')[0]
+		if pocket is None:
+			continue
+		for val in values:
+			if stem.endswith(suffix+val):
+				#with no values the tag in the RMSD table is the first field of the obrms line
+				tag=val if val!='' else 'RMSD'
+				rec_name,lig=rec_lig_from_path(root+pocket+stem+'.rmsds')
+				rows.append([tag,pocket,rec_name,lig]+[rec.get(col) for col in COST_COLUMNS[4:]])
+				break
+	return pd.DataFrame(rows,columns=COST_COLUMNS)
+
+def filter_csv(subset_file, remove_files=['2017_general.INDEX','Crossdock2020_Lig.txt','Crossdock2020_Prot.txt'], new_suffix="no2017_noCD2020"):
+	'''
+	Write a copy of a master csv without the rows whose receptor or ligand PDB id is listed in any of remove_files.
+
+	Returns the name of the new csv, <subset_file stem>_<new_suffix>.csv. The TopN helpers take
+	exclude=remove_files (exclusions.py) to do the same without writing the copy.
+	'''
+
+	import pandas as pd
+	from exclusions import apply_exclusions
+
+	subset_csv=apply_exclusions(pd.read_csv(subset_file,sep=','),remove_files)
+
+	subset_name=f"{subset_file.split('.')[0]}_{new_suffix}.csv"
+	subset_csv.to_csv(subset_name,sep=',',index=False)
+	return subset_name
+
+def main(argv=None):
+	parser=argparse.ArgumentParser(description='Merge OBRMS output files into 1 file')
+	parser.add_argument('-s','--suffix',type=str, required=True, help='Suffix of files to stick together. Assumes filenames are *<SUFFIX><VALUE>.rmsds')
+	parser.add_argument('-v','--values',type=str, default=[""],nargs='+',help='Values to be searched combined with suffix. Defaults to empty string. Accepts any number of arguments.')
+	parser.add_argument('-r','--dataroot',type=str,required=True, help='Root of directories to search')
+	parser.add_argument('-o','--outfilename',type=str,required=True, help='Name of output file (a directory for parquet/feather)')
+	parser.add_argument('-d','--dirlist',type=str,required=True, help='File containing directory names to work on.')
+	parser.add_argument('--getscores',action='store_true',help='Flag to expect CNNscore, CNNaffinity, and minimizedAffinity data fields in the .rmsds file.')
+	parser.add_argument('--format',default='csv',choices=['csv','parquet','feather'],help='Output format. Defaults to csv')
+	parser.add_argument('--manifest',default=None,help='Manifest of ingested files. Defaults to <outfilename>.manifest.json')
+	parser.add_argument('--rebuild',action='store_true',help='Flag to ignore the manifest and rebuild the output from scratch.')
+	parser.add_argument('--index_tags',nargs='+',default=[],help='Extra SD tags of the docked poses to add as columns, read from the sdf_index.py index of each docked output (built if missing).')
+	parser.add_argument('--journals',nargs='+',default=[],help='run_gnina_cmds.py journals of the runs, written to <outfilename>.costs.csv as a table of per-docking costs.')
+
+	args=parser.parse_args(argv)
+
+	if args.dataroot[-1]!='/':
+		root=args.dataroot+'/'
+	else:
+		root=args.dataroot
+
+	dirs=[x.rstrip() for x in open(args.dirlist).readlines()]
+	header=(SCORE_COLUMNS if args.getscores else COLUMNS)+args.index_tags
+	manifest_name=args.manifest if args.manifest else args.outfilename.rstrip('/')+'.manifest.json'
+
+	manifest=None if args.rebuild else load_manifest(manifest_name)
+	if manifest is not None and (manifest['format']!=args.format or manifest['header']!=header or not os.path.exists(args.outfilename)):
+		manifest=None
+	if manifest is not None and args.format=='csv':
+		#rows appended by a run that died before saving its manifest are cut off again
+		size=os.path.getsize(args.outfilename)
+		if manifest.get('size') is None or size<manifest['size']:
+			manifest=None
+		elif size>manifest['size']:
+			os.truncate(args.outfilename,manifest['size'])
+	if manifest is None:
+		manifest={'format':args.format,'header':header,'files':{},'parts':{}}
+	if args.format!='csv' and os.path.isdir(args.outfilename):
+		#parts not in the manifest are left over from a rebuild or from a run that died before saving it
+		known=set(os.path.normpath(part) for part in manifest['parts'])
+		for old in glob.glob(os.path.join(args.outfilename,'tag=*','part-*')):
+			if os.path.normpath(old) not in known:
+				os.remove(old)
+
+	seen=set()
+	todo=[]
+	lastpocket=None
+	for pocket,val,item in find_rmsds(root,dirs,args.suffix,args.values):
+		if pocket!=lastpocket:
+			print(pocket)
+			lastpocket=pocket
+		seen.add(item)
+		if manifest['files'].get(item)!=file_state(item):
+			todo.append((pocket,val,item))
+	changed=set(item for _,_,item in todo)
+	stale=set(item for item in manifest['files'] if item not in seen or item in changed)
+	print(f'{len(todo)} new or changed files, {len(stale)} to replace or remove')
+
+	if args.format=='csv':
+		if stale:
+			#rows of changed files can't be pulled out of the csv, so start over
+			todo=[x for x in find_rmsds(root,dirs,args.suffix,args.values)]
+			manifest['files']={}
+		append=bool(manifest['files'])
+		if not append and os.path.exists(manifest_name):
+			#the old manifest does not describe the csv being rewritten
+			os.remove(manifest_name)
+		rows=[]
+		for pocket,val,item in todo:
+			rows+=read_rmsds(item,pocket,val,args.getscores,args.index_tags)
+			manifest['files'][item]=file_state(item)
+		manifest['size']=write_csv(args.outfilename,rows,header,append)
+	else:
+		drop_sources(manifest['parts'],args.format,stale)
+		for item in stale:
+			del manifest['files'][item]
+		rows=[]
+		sources=[]
+		for pocket,val,item in todo:
+			new=read_rmsds(item,pocket,val,args.getscores,args.index_tags)
+			rows+=new
+			sources+=[item]*len(new)
+			manifest['files'][item]=file_state(item)
+		if rows:
+			stamp=f'{time.time_ns()}-{os.getpid()}'
+			manifest['parts'].update(write_parts(args.outfilename,rows_to_frame(rows,header,sources,FLOAT_COLUMNS+args.index_tags),args.format,stamp))
+
+	save_manifest(manifest_name,manifest)
+
+	if args.journals:
+		costs=journal_costs(args.journals,root,dirs,args.suffix,args.values)
+		costs.to_csv(args.outfilename.rstrip('/')+'.costs.csv',index=False)
+		print(f'{len(costs)} dockings in the cost table')
+
+if __name__=='__main__':
+	main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+'''
+Named exclusion lists (e.g. the overlap with a model's training set) applied to coalesced tables
+as they are read, instead of writing a filtered copy of every table (coalescer.filter_csv).
+
+A list is a file with one id per line. Ids match as they always did in coalescer.filter_csv: the
+whole stripped line in upper case, against the last path component of rec and against lig, both
+as they are written in the table. Each file is parsed once per process and cached until it changes.
+Lists are named in EXCLUSION_SETS or given by path, and any combination of them is one set of ids.
+
+A table is filtered by computing the id of every category instead of every row, so keep_mask is
+one vectorized isin over the categories and an index into them. The filter is given to the TopN code as exclude=[names] (topn.topn_table, topn.make_dict,
+topn.getTopN, generate_RMSD_graphs.py --exclude, rerank.py --exclude).
+
+Files are looked for in the working directory, then in $GNINA_EXCLUSIONS.
+
+Usage (ids of a combination and the rows they remove from a table):
+        python exclusions.py 2017general cd2020 --table crossdock_master.csv
+'''
+
+import argparse, os
+from functools import lru_cache
+import numpy as np
+
+EXCLUSION_SETS = {
+    '2017general': ('2017_general.INDEX',),
+    'cd2020': ('Crossdock2020_Lig.txt', 'Crossdock2020_Prot.txt'),
+}
+# what coalescer.filter_csv has always removed ("no2017_noCD2020")
+NO2017_NOCD2020 = ('2017general', 'cd2020')
+
+
+def find_file(name):
+    for path in (name, os.path.join(os.environ.get('GNINA_EXCLUSIONS', ''), name)):
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f'exclusion list {name} not found (looked in . and $GNINA_EXCLUSIONS)')
+
+
+@lru_cache(maxsize=None)
+def _read_ids(path, state):
+    with open(path) as infile:
+        return frozenset(line.strip().upper() for line in infile if line.strip())
+
+
+def read_ids(path):
+    '''
+    Upper case ids (whole lines) of one list file, cached until the file's mtime or size changes.
+    '''
+
+    st = os.stat(path)
+    return _read_ids(os.path.abspath(path), (st.st_mtime_ns, st.st_size))
+
+
+def list_files(names):
+    '''
+    Files of a combination of list names and paths.
+    '''
+
+    if isinstance(names, str):
+        names = [names]
+    return [find_file(f) for name in names for f in EXCLUSION_SETS.get(name, (name,))]
+
+
+def exclusion_ids(names):
+    '''
+    Union of the ids of a combination of list names and paths.
+    '''
+
+    ids = set()
+    for path in list_files(names):
+        ids |= read_ids(path)
+    return frozenset(ids)
+
+
+def pdb_ids(values, last_component=True):
+    '''
+    (codes, ids): the category code of every value and the id of every category (its last path
+    component if last_component, as for rec), so per-id work is done once per category.
+    '''
+
+    import pandas as pd
+
+    cat = values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype('category')
+    ids = pd.Index(cat.cat.categories.astype(str))
+    if last_component:
+        ids = ids.str.split('/').str[-1]
+    return cat.cat.codes.to_numpy(), ids
+
+
+def keep_mask(df, names, columns=('rec', 'lig')):
+    '''
+    Boolean array, False for the rows whose id in any of columns is in the lists of names.
+    '''
+
+    present = [col for col in columns if col in df]
+    if not present:
+        raise ValueError(f'excluding ids needs one of the columns {", ".join(columns)}')
+    excluded = exclusion_ids(names)
+    drop = np.zeros(len(df), dtype=bool)
+    for col in present:
+        codes, ids = pdb_ids(df[col], col == 'rec')
+        bad = np.append(ids.isin(excluded), False)  # code -1 (missing) indexes the False
+        drop |= bad[codes]
+    return ~drop
+
+
+def apply_exclusions(df, names, columns=('rec', 'lig')):
+    '''
+    df without the excluded rows, or df itself if names is empty.
+    '''
+
+    if not names:
+        return df
+    return df[keep_mask(df, names, columns)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the ids of a combination of exclusion lists and what they remove from a coalesced table.')
+    parser.add_argument('names', nargs='+', help=f'List names ({", ".join(EXCLUSION_SETS)}) or files.')
+    parser.add_argument('--table', default=None, help='Coalesced table (csv or parquet/feather directory) to count the excluded rows and systems of.')
+    args = parser.parse_args()
+
+    for path in list_files(args.names):
+        print(f'{path}: {len(read_ids(path))} ids')
+    print(f'{len(exclusion_ids(args.names))} ids in all')
+    if args.table:
+        from coalescer import read_master
+        df = read_master(args.table)
+        keep = keep_mask(df, args.names)
+        systems = df.groupby([c for c in ('rec', 'lig') if c in df], observed=True).ngroup().to_numpy()
+        print(f'{(~keep).sum()} of {len(df)} rows and {len(np.unique(systems[~keep]))} of {len(np.unique(systems))} systems excluded')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+'''
+Analysis stage for flexible docking: ligand RMSD, side-chain RMSD of the flexible residues and
+pocket change of every docked pose in one table.
+
+For every pair of the pairs file (receptor, ligand, autobox ligand, output prefix) the poses in
+<prefix>fd.sdf and the flexible residues in <prefix>fd-RES.pdb (gnina --out --out_flex) are read
+in one pass each. The flexible residues are matched to the cognate receptor of the ligand (the
+<code>_PRO.pdb next to <code>_LIG_aligned.sdf) with the same prody.matchChains alignments as
+pocketdiff.py, and the side-chain heavy atom RMSD of every pose to the cognate side chains is
+computed as one array operation over all poses. sidechain_start_rmsd is the same for the side
+chains of the receptor before docking, so the two can be compared.
+
+Pairs are sorted by receptor and spread over a process pool in chunks, as in pocketdiff.py.
+A pocketdiff.py csv adds pocket_change and backbone_change. No hand-made command file or
+separate obrms_calc.py/coalescer.py run is needed, but a coalesced table can be given instead
+of the in-process ligand RMSD with --ligand_rmsds.
+
+Output:
+        csv with one row per pose: rec, lig, pose, rmsd, cnnscore, cnnaffinity, minimizedAffinity,
+        flex_residues, flex_atoms, sidechain_rmsd, sidechain_max_residue_rmsd,
+        sidechain_start_rmsd, pocket_change, backbone_change
+'''
+
+import argparse, multiprocessing, os
+from collections import namedtuple
+from functools import partial
+import numpy as np
+from sdf_stream import open_text
+
+BACKBONE = {'N', 'CA', 'C', 'O', 'OXT'}
+POSE_COLUMNS = ['rec', 'lig', 'pose', 'rmsd', 'cnnscore', 'cnnaffinity', 'minimizedAffinity',
+                'flex_residues', 'flex_atoms', 'sidechain_rmsd', 'sidechain_max_residue_rmsd', 'sidechain_start_rmsd']
+SCORE_TAGS = ['CNNscore', 'CNNaffinity', 'minimizedAffinity']
+
+FlexPoses = namedtuple('FlexPoses', ['atoms', 'coords'])
+
+
+def read_flex(path):
+    '''
+    Side-chain heavy atoms of every model of a gnina --out_flex pdb(.gz). atoms holds the
+    (chain, resnum, icode, name) of each atom and coords has shape (models, atoms, 3).
+    '''
+
+    atoms = None
+    ids = []
+    models = []
+    current = []
+    with open_text(path) as infile:
+        for line in infile:
+            if line.startswith(('ATOM', 'HETATM')):
+                name = line[12:16].strip()
+                element = line[76:78].strip() if len(line) > 76 else ''
+                if (element or name.lstrip('0123456789')[:1]).upper() == 'H' or name in BACKBONE:
+                    continue
+                current.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+                if atoms is None:
+                    ids.append((line[21], int(line[22:26]), line[26].strip(), name))
+            elif line.startswith('ENDMDL'):
+                if atoms is None:
+                    atoms = ids
+                elif len(current) != len(atoms):
+                    raise ValueError(f'{path}: model {len(models)+1} has {len(current)} flexible atoms, expected {len(atoms)}')
+                models.append(current)
+                current = []
+    if current or atoms is None:  # a single model without MODEL/ENDMDL
+        atoms = ids if atoms is None else atoms
+        models.append(current)
+    return FlexPoses(atoms, np.array(models, dtype=float).reshape(len(models), len(atoms), 3))
+
+
+class AtomIndex:
+    '''
+    Row of atom keys (one array per key field) in a receptor, looked up for whole arrays of keys
+    at once. A key that occurs more than once maps to its last atom.
+    '''
+
+    def __init__(self, *keys):
+        import pandas as pd
+
+        index = pd.MultiIndex.from_arrays([np.asarray(k) for k in keys])
+        last = ~index.duplicated(keep='last')
+        self.index = index[last]
+        self.rows = np.flatnonzero(last)
+
+    def lookup(self, *keys):
+        import pandas as pd
+
+        found = self.index.get_indexer(pd.MultiIndex.from_arrays([np.asarray(k) for k in keys]))
+        return np.where(found >= 0, self.rows[found], -1)
+
+
+def cognate_atoms(rec, ligrec, matches, flex_atoms):
+    '''
+    Index of every flexible atom in the docked receptor and in the cognate receptor (-1 where
+    missing), through the residue alignment of the match that maps the most flexible atoms.
+    '''
+
+    if not flex_atoms:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    ratoms, latoms = rec.atoms, ligrec.atoms
+    chids, resnums, icodes, names = (np.array(field) for field in zip(*flex_atoms))
+    rec_idx = AtomIndex(ratoms.getChids(), ratoms.getResnums(), ratoms.getIcodes(), ratoms.getNames()).lookup(chids, resnums, icodes, names)
+    lig_index = AtomIndex(ligrec.resindices, latoms.getNames())
+    found = rec_idx >= 0
+    best = np.full(len(flex_atoms), -1, dtype=np.int64)
+    for rmap, lrmap, _, _ in matches:
+        ridx = rmap.getIndices()
+        lidx = lrmap.getIndices()
+        ok = (ridx >= 0) & (ridx < len(rec.coords)) & (lidx >= 0) & (lidx < len(ligrec.coords))
+        res_map = np.full(rec.resindices.max()+1, -1, dtype=np.int64)
+        res_map[rec.resindices[ridx[ok]]] = ligrec.resindices[lidx[ok]]
+        cognate_res = np.where(found, res_map[rec.resindices[rec_idx]], -1)
+        target = np.where(cognate_res >= 0, lig_index.lookup(cognate_res, names), -1)
+        if (target >= 0).sum() > (best >= 0).sum():
+            best = target
+    return rec_idx, best
+
+
+def sidechain_rmsds(coords, ref, residues):
+    '''
+    (rmsd, largest per-residue rmsd) of every pose in coords (poses x atoms x 3) to ref (atoms x 3).
+    '''
+
+    d2 = ((coords-ref[None])**2).sum(axis=-1)
+    _, res, counts = np.unique(residues, return_inverse=True, return_counts=True)
+    onehot = np.zeros((len(residues), len(counts)))
+    onehot[np.arange(len(residues)), res] = 1
+    return np.sqrt(d2.mean(axis=1)), np.sqrt((d2 @ onehot)/counts).max(axis=1)
+
+
+def parse_pair(line, strip='/scr/paul/'):
+    rec, lig, _, prefix = line.replace(strip, '').split()
+    return rec, lig, prefix
+
+
+def code(path, suffix):
+    return os.path.basename(path).replace(suffix, '')[-4:]
+
+
+def analyze_pair(pair, root, ligand_suffix='fd.sdf', flex_suffix='fd-RES.pdb', early_stop=None, ligand_rmsd=True):
+    '''
+    Rows of POSE_COLUMNS for the poses of one pair.
+    '''
+
+    from pocketdiff import load_receptor, match_chains
+    from rmsd_engine import RMSDCalculator
+    from sdf_stream import records, tag_values
+
+    rec, lig, prefix = pair
+    rec_path = os.path.join(root, rec)
+    ligrec_path = os.path.join(root, lig.replace('LIG_aligned.sdf', 'PRO.pdb'))
+    flex = read_flex(os.path.join(root, prefix+flex_suffix))
+    nposes = len(flex.coords)
+    if ligand_rmsd:
+        poses = list(records(os.path.join(root, prefix+ligand_suffix)))
+        if len(poses) != nposes:
+            raise ValueError(f'{len(poses)} docked poses but {nposes} flexible residue models')
+        rmsds = RMSDCalculator(os.path.join(root, lig)).rmsds(poses)
+        scores = np.array([tag_values(pose, SCORE_TAGS) for pose in poses], dtype=float).reshape(nposes, len(SCORE_TAGS))
+    else:
+        rmsds = np.full(nposes, np.nan)
+        scores = np.full((nposes, len(SCORE_TAGS)), np.nan)
+
+    receptor = load_receptor(rec_path)
+    cognate = load_receptor(ligrec_path)
+    rec_idx, cog_idx = cognate_atoms(receptor, cognate, match_chains(rec_path, ligrec_path, early_stop), flex.atoms)
+    keep = cog_idx >= 0
+    residues = {}
+    res_codes = [residues.setdefault(atom[:3], len(residues)) for atom, k in zip(flex.atoms, keep) if k]
+    if keep.any():
+        sc, scmax = sidechain_rmsds(flex.coords[:, keep], cognate.coords[cog_idx[keep]], np.array(res_codes))
+        start = np.sqrt(((receptor.coords[rec_idx[keep]]-cognate.coords[cog_idx[keep]])**2).sum(axis=-1).mean())
+    else:
+        sc = scmax = np.full(nposes, np.nan)
+        start = np.nan
+
+    rec_code, lig_code = code(rec, '_PRO.pdb'), code(lig, '_LIG_aligned.sdf')
+    return [(rec_code, lig_code, i, rmsds[i], *scores[i], len(residues), int(keep.sum()), sc[i], scmax[i], start) for i in range(nposes)]
+
+
+def analyze_chunk(chunk, **kwargs):
+    results = []
+    for pair in chunk:
+        try:
+            results.append((pair, analyze_pair(pair, **kwargs), None))
+        except Exception as e:
+            results.append((pair, [], f'{type(e).__name__}: {e}'))
+    return results
+
+
+def ligand_table(path, tag=None):
+    '''
+    The ligand RMSDs and scores of a coalesced table (coalescer.py --getscores), keyed by rec, lig and pose.
+
+    Only the rows of tag are used, which may be left out if the table has a single tag (a
+    ValueError is raised if it has more).
+    '''
+
+    from coalescer import read_master
+
+    master = read_master(path)
+    tags = master['tag'].astype(str)
+    if tag is not None:
+        master = master[(tags == str(tag)).to_numpy()].copy()
+    elif tags.nunique() > 1:
+        raise ValueError(f'{path} has the tags {", ".join(sorted(tags.unique()))}, pick the one of the flexible run with --tag')
+    master['rec'] = master['rec'].astype(str).str[-4:]
+    master['lig'] = master['lig'].astype(str).str[-4:]
+    master['pose'] = master.groupby(['tag', 'rec', 'lig'], observed=True).cumcount()
+    cols = [c for c in ['tag', 'rec', 'lig', 'pose', 'rmsd', 'cnnscore', 'cnnaffinity', 'minimizedAffinity'] if c in master]
+    return master[cols].reset_index(drop=True)
+
+
+def join_ligand_rmsds(flex, master):
+    '''
+    Replace the in-process ligand RMSDs and scores with those of a ligand_table.
+
+    Every flexible pose is kept (with empty RMSDs if the table lacks it) and poses of the table
+    without flexible residues are left out.
+    '''
+
+    keys = ['rec', 'lig', 'pose']
+    cols = list(master.columns)
+    joined = flex.drop(columns=[c for c in cols if c in flex and c not in keys]).merge(master, on=keys, how='left')
+    return joined[cols+[c for c in joined if c not in cols]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ligand RMSD, flexible side-chain RMSD to the cognate receptor and pocket change of every flexible docking pose.')
+    parser.add_argument('-i', '--input', default='ds_cd_input_pairs.txt', help='Pairs file (receptor, ligand, autobox ligand, output prefix) (default: %(default)s)')
+    parser.add_argument('-r', '--root', default='.', help='Directory the paths in the pairs file are relative to (default: %(default)s)')
+    parser.add_argument('-o', '--output', default='flex_poses.csv', help='Output csv (default: %(default)s)')
+    parser.add_argument('--strip', default='/scr/paul/', help='Prefix to remove from the paths in the pairs file (default: %(default)s)')
+    parser.add_argument('--ligand_suffix', default='fd.sdf', help='Suffix of the docked ligands after the output prefix (default: %(default)s)')
+    parser.add_argument('--flex_suffix', default='fd-RES.pdb', help='Suffix of the --out_flex files after the output prefix (default: %(default)s)')
+    parser.add_argument('-l', '--ligand_rmsds', default=None, help='Coalesced table (coalescer.py --getscores) to take the ligand RMSDs and scores from instead of computing them.')
+    parser.add_argument('--tag', default=None, help='Tag of the flexible run in the --ligand_rmsds table, needed if it has more than one.')
+    parser.add_argument('-p', '--pocketdiff', default=None, help='pocketdiff.py csv, adds pocket_change and backbone_change.')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='Size of the process pool (default: number of cores)')
+    parser.add_argument('--chunksize', type=int, default=16, help='Pairs per task, sorted by receptor (default: %(default)s)')
+    parser.add_argument('--early_stop', type=float, default=None, help='As for pocketdiff.py.')
+    args = parser.parse_args()
+
+    import pandas as pd
+    from pocketdiff import make_chunks
+
+    master = None
+    if args.ligand_rmsds:
+        # read before any docking output, so a table with several tags fails at once
+        try:
+            master = ligand_table(args.ligand_rmsds, args.tag)
+        except ValueError as e:
+            parser.error(str(e))
+
+    pairs = [parse_pair(line, args.strip) for line in open(args.input) if line.strip()]
+    work = partial(analyze_chunk, root=args.root, ligand_suffix=args.ligand_suffix, flex_suffix=args.flex_suffix,
+                   early_stop=args.early_stop, ligand_rmsd=args.ligand_rmsds is None)
+    chunks = make_chunks(sorted(set(pairs)), args.chunksize)
+    rows = []
+    failed = 0
+    with multiprocessing.Pool(args.processes) as pool:
+        for n, results in enumerate(pool.imap_unordered(work, chunks)):
+            for pair, pair_rows, error in results:
+                rows += pair_rows
+                if error:
+                    failed += 1
+                    print(f'{pair[0]} {pair[1]}: {error}')
+            print(f'{n+1}/{len(chunks)} chunks done')
+
+    flex = pd.DataFrame(rows, columns=POSE_COLUMNS).sort_values(['rec', 'lig', 'pose'], kind='stable').reset_index(drop=True)
+    if master is not None:
+        flex = join_ligand_rmsds(flex, master)
+    if args.pocketdiff:
+        pocket = pd.read_csv(args.pocketdiff, index_col=0, dtype={'rec': str, 'lig': str}).drop_duplicates(['rec', 'lig'])
+        flex = flex.merge(pocket, on=['rec', 'lig'], how='left')
+    flex.to_csv(args.output, index=False)
+    print(f'{len(flex)} poses of {len(set(pairs))-failed} pairs written to {args.output}, {failed} pairs failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,22 @@
 
 # For the new pipeline using the python scripts in Paul's Repo
 # Takes in one of the csv's output by the coalescer.py script (or something that looks like that)
+# pandas and matplotlib are only imported by the functions that use them, so importing this module
+# (or asking for --help) stays cheap
 import argparse
+import os
 from datetime import datetime
 # from glob import glob
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-import matplotlib
+from topn import bootstrap_topn, compute_topn, read_table, stream_topn, topn_frames
 
-matplotlib.use('Agg')
+
+def getPyplot():
+    # Imports matplotlib on first use, with the non-interactive backend
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 
 def makeOffset(number_labels, width=1):  # number_labels=number of bars that will be plotted on the multiple bargraph, width is the spread of the bars for a given tick
@@ -35,58 +41,62 @@ def autolabel(rects, size, imp_ax):  # size is font-size of the annotation, imp_
                         textcoords="offset points",
                         ha='center', va='bottom', size=size)
 
-def getPlottingDataFrame(path, names, col_names, header, delim, usecols, key, unique):  # unique is the number of unique receptor-ligand systems that should exist
+def getTopNResult(path, col_names, header, delim, usecols, key, bootstrap=0, strata=None, ci=95, chunksize=None, exclude=None):
+    # TopN of every tag in one master table, a topn.TopNResult (or BootstrapResult with bootstrap replicates)
+    # All tags and thresholds are computed at once by topn.compute_topn
+    # With chunksize (or a parquet/feather directory from coalescer.py) the table is streamed through topn.stream_topn
+    # chunksize rows at a time, so memory depends on the number of systems and not on the number of poses
+    # exclude names exclusion lists (exclusions.py), whose rec/lig ids are dropped as the rows are read
+    from exclusions import apply_exclusions
+    if chunksize or os.path.isdir(path):
+        assert not bootstrap, "bootstrap needs the whole table in memory, leave out --chunksize"
+        if os.path.isdir(path):
+            from coalescer import iter_master
+            chunks = (apply_exclusions(chunk, exclude) for chunk in iter_master(path, list(dict.fromkeys(col_names+(['rec', 'lig'] if exclude else []))), chunksize or 1000000))
+        else:
+            chunks = read_table(path, col_names, header, delim, usecols, exclude, chunksize)
+        return stream_topn(chunks, key[0], key[1])
+    initial_df = read_table(path, col_names, header, delim, usecols, exclude)
+    if bootstrap:
+        return bootstrap_topn(initial_df, key[0], key[1], nboot=bootstrap, strata_key=strata, ci=ci)
+    return compute_topn(initial_df, key[0], key[1])
+
+
+def namePlottingDataFrames(new_datafs, nsystems, names, unique):
+    # Checks the number of systems of every tag's dataframe and gives the ranges (pose numbers) to plot them over
+    new_ranges = []
+    for name, nsys, plot_df in zip(names, nsystems, new_datafs):
+        print(f"{name}: {plot_df.attrs['tag']}")
+        assert nsys == unique, f"Doesn't have the right number of systems, should have {unique}, but has {nsys}"
+        new_ranges.append(list(plot_df.index))
+    return new_ranges
+
+
+def getPlottingDataFrame(path, names, col_names, header, delim, usecols, key, unique, bootstrap=0, strata=None, ci=95, chunksize=None, exclude=None):  # unique is the number of unique receptor-ligand systems that should exist
     # Generates a dataframe used for the graph making functions
     # Each row of dataframe is a cumulation of statistics of all poses before and the current pose
     # Each row has the percentage of Receptor-Ligand Systems with less than 1, 2, and 3 RMSD for 'good1', 'good2', and 'good3' respectively
-    initial_df = pd.read_csv(path, header=header, sep=delim, usecols=usecols)
-    initial_df.columns = col_names
-    initial_df['good2'] = (initial_df['rmsd'] < 2)
-    initial_df['good1'] = (initial_df['rmsd'] < 1)
-    initial_df['good3'] = (initial_df['rmsd'] < 3)
-    tags = initial_df[key[1]].unique()
-    tags.sort()
-    new_datafs = []
-    new_ranges = []
-    for tag, name in zip(tags, names):
-        df_tagonly = initial_df[initial_df[key[1]] == tag]
-        grouped_tagonly = df_tagonly.groupby(key[0])
-        print(f"{name}: {tag}") 
-        assert len(df_tagonly[key[0]].unique()) == unique, f"Doesn't have the right number of systems, should have {unique}, but has {len(initial_df[key[0]].unique())}"
-        idx = grouped_tagonly.nth(0).index
-        maxrange = grouped_tagonly.size().max()
-        rang = list(range(1, maxrange+1))
-        base = pd.DataFrame(None, index = idx, columns=['good1', 'good2', 'good3'])
-        combin_top_df = pd.DataFrame(None, index = rang, columns=['good1', 'good2', 'good3']) #non_def_top -> combin_top_df
-        top_bools = grouped_tagonly.nth(0)[['good1', 'good2', 'good3']] #non_def_last -> top_bools
-        combin_top_df.loc[1] = [top_bools['good1'].mean()*100, top_bools['good2'].mean()*100, top_bools['good3'].mean()*100]
-        for r in range(1, maxrange):
-            cur_row = base.combine_first(grouped_tagonly.nth(r)[['good1', 'good2', 'good3']]).fillna(False)
-            top_bools = cur_row | top_bools
-            combin_top_df.loc[r+1] = [top_bools['good1'].mean()*100, top_bools['good2'].mean()*100, top_bools['good3'].mean()*100]
-        new_datafs.append(combin_top_df)
-        new_ranges.append(rang)
-
-    return new_datafs, new_ranges
-
-
-# Need to integrate the benchmark data here
-# def getBenchmarkInfo(args):
-#    performance_files = glob('{}*.{}'.format(args.benchmark_root, args.benchmark_ext)
-#    performance_files.sort()
-#    master_file = pd.DataFrame(columns = ['mean', 'stddev', 'median', 'min', 'max', 'parameter', 'prot'])
-#    for sys in performance_files:
-#        perf_stats = pd.read_csv(sys, delimiter=', ')
-#        perf_stats['prot'] = perf_stats['command'].apply(lambda x: re.findall(r'(....)_PROT.pdb', x)[0])
-#        del perf_stats['command'], perf_stats['user'], perf_stats['system']
-#        master_file = master_file.append(perf_stats, ignore_index = True)
-#    master_file['var'] = master_file['stddev'].apply(lambda x: x**2)
-#    final_agg = master_grouped.agg({'mean':'mean', 'var': np.sum}).reset_index()
-#    final_agg['std'] = final_agg['var'].apply(lambda x: np.sqrt(x))
-#    return final_agg
+    # With bootstrap replicates there are also 'good1_lower', 'good1_upper', ... columns with the ci% confidence interval
+    result = getTopNResult(path, col_names, header, delim, usecols, key, bootstrap, strata, ci, chunksize, exclude)
+    new_datafs = topn_frames(result, names)
+    return new_datafs, namePlottingDataFrames(new_datafs, result.nsystems, names, unique)
+
+
+def getBenchmarkInfo(cost_path, metric='wall'):
+    # Cost per rec-lig system of every tag from a coalescer.py --journals cost table (<outfilename>.costs.csv)
+    # metric is 'wall' for the elapsed time or 'cpu' for user+system time of gnina, failed runs are left out
+    import pandas as pd
+    costs = pd.read_csv(cost_path)
+    costs = costs[costs['status'] == 'done'].copy()
+    costs['seconds'] = costs['elapsed'] if metric == 'wall' else costs['user']+costs['sys']
+    per_system = costs.groupby(['tag', 'rec', 'lig'], observed=True).agg(seconds=('seconds', 'sum'), maxrss_kb=('maxrss_kb', 'max'))
+    info = per_system.groupby(level='tag').agg(mean=('seconds', 'mean'), std=('seconds', 'std'), systems=('seconds', 'size'), maxrss_kb=('maxrss_kb', 'max'))
+    info.index = info.index.astype(str)
+    return info
 
 def makeLineGraph(config, dfs, ranges):  # dfs are all of the computed dataframes, ranges are the ranges (i.e. number of poses) for the dataframes
     # Generates a line graph of the number of "good" dockings cumulatively for all of the poses
+    plt = getPyplot()
     ax = plt.figure().gca()
     for j, plot_df in enumerate(dfs):
         rang = ranges[j]
@@ -98,16 +108,20 @@ def makeLineGraph(config, dfs, ranges):  # dfs are all of the computed dataframe
 
 def makeBarGraph(config, dfs):
     # Generates a multiple bar graph for the specified poses that shows the percentage of good systems at those poses (this is cumulative still)
+    plt = getPyplot()
     ax = plt.figure().gca()
     offset = makeOffset(len(config.compare_names), config.width)
     for j, plot_df in enumerate(dfs):
         bar_info = [plot_df['good2'].iat[p-1] for p in config.use_pose]
         yerr = np.zeros(shape=(2, len(config.use_pose)), dtype=float)
-        if config.use_bound:  # for showing error bars on the bars to denote the systems below 1 and 3 rmsd for - and + error respectively
+        if config.bootstrap:  # bootstrap confidence interval of the percentage
+            for p_idx, pose in enumerate(config.use_pose):
+                yerr[:, p_idx] = [bar_info[p_idx]-plot_df['good2_lower'].iat[pose-1], plot_df['good2_upper'].iat[pose-1]-bar_info[p_idx]]
+        elif config.use_bound:  # for showing error bars on the bars to denote the systems below 1 and 3 rmsd for - and + error respectively
             for p_idx, pose in enumerate(config.use_pose):
                 yerr_pos = float(plot_df.iloc[pose-1]['good3'])-float(plot_df.iloc[pose-1]['good2']) 
                 yerr_neg = float(plot_df.iloc[pose-1]['good2'])-float(plot_df.iloc[pose-1]['good1']) 
-                yerr[p_idx,:] = [yerr_neg, yerr_pos]
+                yerr[:, p_idx] = [yerr_neg, yerr_pos]
         else:
             yerr = None
         rects = ax.bar(np.array(config.use_pose)+offset[j], bar_info, config.width/len(config.compare_names), align='center', label=config.compare_names[j], yerr=yerr, capsize=4)
@@ -115,16 +129,28 @@ def makeBarGraph(config, dfs):
             autolabel(rects, config.annotate_size, ax)
     prettifyGraph(ax, 'Pose #', 'Percent Good Poses (<2 RMSD)', config.figname+'_bar', bargraph=config.use_pose, ylim=config.y_lim)
 
-# Not Very sure how to integrate the benchmark info into this yet, will definitely update it later
-# def makeBenchmarkGraph(config, dfs):
-#    ax = plt.figure().gca()
-#    for j, plot_df in enumerate(dfs):
-#        bar_info = [plot_df['good2'].iat[p] for p in config.use_pose]
-        
-    
+def makeBenchmarkGraph(config, dfs, costs):  # costs has the mean seconds per system of every dataframe (None if unknown)
+    # Generates a scatter plot of TopN against the cost of each run, to pick the speed/accuracy trade-off
+    plt = getPyplot()
+    ax = plt.figure().gca()
+    for j, plot_df in enumerate(dfs):
+        if costs[j] is None:
+            continue
+        mean = costs[j]
+        good = plot_df['good2'].iat[config.cost_pose-1]
+        yerr = None
+        if config.bootstrap:
+            yerr = [[good-plot_df['good2_lower'].iat[config.cost_pose-1]], [plot_df['good2_upper'].iat[config.cost_pose-1]-good]]
+        ax.errorbar([mean], [good], yerr=yerr, fmt='o', capsize=4, label=config.compare_names[j])
+    if any(c is not None for c in costs):
+        ax.set_xlim(right=1.1*max(c for c in costs if c is not None))
+    xlabel = 'Mean {} seconds per system'.format('wall clock' if config.cost_metric == 'wall' else 'CPU')
+    prettifyGraph(ax, xlabel, f'Top{config.cost_pose} (% of systems <2 RMSD)', config.figname+'_cost', ylim=config.y_lim)
 
 def prettifyGraph(imp_ax, xlabel, ylabel, figname, xlim=0, bargraph=False, ylim=None):  # bargraph should be the pose numbers that you are plotting bars for, to show the ticks for only those poses
     # Finalizes the graphs to make them goodlooking
+    from matplotlib.ticker import MaxNLocator
+    plt = getPyplot()
     imp_ax.set_xlim(left=xlim)
     imp_ax.xaxis.set_major_locator(MaxNLocator(integer=True))
     if bargraph:
@@ -140,53 +166,99 @@ def prettifyGraph(imp_ax, xlabel, ylabel, figname, xlim=0, bargraph=False, ylim=
     lgd = imp_ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
     plt.savefig('{}.png'.format(figname), dpi=300, bbox_extra_artists=(lgd,), bbox_inches='tight')
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--compare_paths', '-C', required=True, nargs='+', help="paths to all gnina runs' master rmsd files to compare")
-parser.add_argument('--compare_names', '-N', required=True, nargs='+', help='Ordered names of gnina runs to use in Legend, order should be same as compare_paths')
-parser.add_argument('--figname', '-F', default=str(datetime.now().time()), help='name to give to the figure, automatically appends "_line" and "_bar" to line and bar graphs, respectively')
-parser.add_argument('--line_graph', default=False, action='store_true', help='Plot a line graph of the information')
-parser.add_argument('--bar_graph', default=False, action='store_true', help='Plot a bar graph of the information')
-parser.add_argument('--key', '-k', default=['rec', 'tag'], nargs='+', help='Column names to group the csv by.(default: %(default)s')
-parser.add_argument('--delimiter', '-d', default=',', help='Delimiter that the files use (default=%(default)s)')
-parser.add_argument('--usecols', default=[0, 2, 7], nargs='+', type=int, help='Columns of the data files that should be used')
-parser.add_argument('--col_names', default=['tag', 'rmsd', 'rec'], nargs='+', help='Names of the columns in the dataframe')
-parser.add_argument('--header', default=True, action='store_false', help='Use if the data does not have a header')
-parser.add_argument('--num_unique', '-U', default=4260, type=int, help='number of unique rec-ligand pairs that should be in each file')
-parser.add_argument('--use_bound', action='store_true', default=False, help='Plot upper and lower bounds on "good" fit, (<1 and <3 RMSD)')
-parser.add_argument('--use_pose', default=[1, 3], type=int, nargs='+', help='which pose numbers to plot on the bar graph')
-parser.add_argument('--annotate_size', default=12, type=int, help='size of the annotation to use, if 0 then no annotation')
-parser.add_argument('--width', '-w', default=1.0, type=float, help='width of the spread of the bar graphs around the center')
-parser.add_argument('--y_lim', '-y', nargs=2, type=float, help='lower and upper bounds of y limit for graphs, defaults to whatever matplotlib wants')
-# parser.add_argument('--benchmark_graph', default = False, action='store_true', help='creates a graph that has benchmark timings vs performance')
-args = parser.parse_args()
-
-# assert len(args.compare_paths) == len(args.compare_names), "The number of paths is not the same as the number of names"
-assert args.line_graph or args.bar_graph, "If you don't wanna make a graph, then why are you using this?"
-if args.y_lim is not None:
-    assert args.y_lim[1] <= 100 and args.y_lim[0] >= 0, "The y limit must be between 0 and 100 (its a percent)"
-
-# make sure headers of pandas dataframes are handled correctly
-if args.header:
-    args.header = 'infer'
-else:
-    args.header = None
-
-list_of_dataframes = []
-list_of_ranges = []
-names = args.compare_names
-for i, path in enumerate(args.compare_paths):  # Calculate all of the dataframes to use for the graphs
-    assert len(names), "The number of names is not the same as the amount of tags in all of the csvs provided"
-    plot_df, rang = getPlottingDataFrame(path, names, args.col_names, args.header, args.delimiter, args.usecols, args.key, args.num_unique)
-    names = names[len(plot_df):]
-    list_of_dataframes += plot_df
-    list_of_ranges += rang
-
-if args.line_graph:
-    makeLineGraph(args, list_of_dataframes, list_of_ranges)
-    plt.clf()
-if args.bar_graph:
-    makeBarGraph(args, list_of_dataframes)
-    plt.clf()
-# if args.banchmark_graph:
-#     benchmark_info = getBenchmarkInfo()
-#     makeBenchmarkGraph(args, list_of_dataframes, benchmark_info)
+def makeParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--compare_paths', '-C', required=True, nargs='+', help="paths to all gnina runs' master rmsd files to compare")
+    parser.add_argument('--compare_names', '-N', required=True, nargs='+', help='Ordered names of gnina runs to use in Legend, order should be same as compare_paths')
+    parser.add_argument('--figname', '-F', default=str(datetime.now().time()), help='name to give to the figure, automatically appends "_line" and "_bar" to line and bar graphs, respectively')
+    parser.add_argument('--line_graph', default=False, action='store_true', help='Plot a line graph of the information')
+    parser.add_argument('--bar_graph', default=False, action='store_true', help='Plot a bar graph of the information')
+    parser.add_argument('--key', '-k', default=['rec', 'tag'], nargs='+', help='Column names to group the csv by.(default: %(default)s')
+    parser.add_argument('--delimiter', '-d', default=',', help='Delimiter that the files use (default=%(default)s)')
+    parser.add_argument('--usecols', default=[0, 2, 7], nargs='+', type=int, help='Columns of the data files that should be used')
+    parser.add_argument('--col_names', default=['tag', 'rmsd', 'rec'], nargs='+', help='Names of the columns in the dataframe')
+    parser.add_argument('--header', default=True, action='store_false', help='Use if the data does not have a header')
+    parser.add_argument('--num_unique', '-U', default=4260, type=int, help='number of unique rec-ligand pairs that should be in each file')
+    parser.add_argument('--use_bound', action='store_true', default=False, help='Plot upper and lower bounds on "good" fit, (<1 and <3 RMSD)')
+    parser.add_argument('--bootstrap', default=0, type=int, help='number of bootstrap replicates for confidence interval error bars on the bar graph, 0 for none (default: %(default)s)')
+    parser.add_argument('--strata', default=None, help='column to stratify the bootstrap by (e.g. pocket, which must then be in --col_names)')
+    parser.add_argument('--ci', default=95, type=float, help='confidence interval of the bootstrap error bars, in percent (default: %(default)s)')
+    parser.add_argument('--chunksize', default=None, type=int, help='read the files this many rows at a time and stream the TopN, for tables too big for memory (parquet/feather directories are always streamed)')
+    parser.add_argument('--exclude', nargs='+', default=[], help='exclusion lists (names from exclusions.py such as 2017general cd2020, or files of PDB ids) whose systems are left out; --num_unique counts what is left')
+    parser.add_argument('--use_pose', default=[1, 3], type=int, nargs='+', help='which pose numbers to plot on the bar graph')
+    parser.add_argument('--annotate_size', default=12, type=int, help='size of the annotation to use, if 0 then no annotation')
+    parser.add_argument('--width', '-w', default=1.0, type=float, help='width of the spread of the bar graphs around the center')
+    parser.add_argument('--y_lim', '-y', nargs=2, type=float, help='lower and upper bounds of y limit for graphs, defaults to whatever matplotlib wants')
+    parser.add_argument('--cost_graph', default=False, action='store_true', help='Plot TopN against the mean cost per system, needs --cost_paths')
+    parser.add_argument('--cost_paths', nargs='+', default=[], help='cost tables from coalescer.py --journals, one per compare_path in the same order')
+    parser.add_argument('--cost_metric', default='wall', choices=['wall', 'cpu'], help='cost to plot, wall clock or user+system CPU time of gnina (default: %(default)s)')
+    parser.add_argument('--cost_pose', default=1, type=int, help='N of the TopN plotted against cost (default: %(default)s)')
+    return parser
+
+
+def checkArgs(args):
+    # assert len(args.compare_paths) == len(args.compare_names), "The number of paths is not the same as the number of names"
+    assert args.line_graph or args.bar_graph or args.cost_graph, "If you don't wanna make a graph, then why are you using this?"
+    if args.cost_graph:
+        assert len(args.cost_paths) == len(args.compare_paths), "Need one cost table per compare_path for the cost graph"
+    if args.y_lim is not None:
+        assert args.y_lim[1] <= 100 and args.y_lim[0] >= 0, "The y limit must be between 0 and 100 (its a percent)"
+
+    # make sure headers of pandas dataframes are handled correctly
+    if args.header is True:
+        args.header = 'infer'
+    elif args.header is False:
+        args.header = None
+
+
+def collectPlottingData(args, topn=None):
+    # Dataframes, ranges and costs of every tag of every compare_path, in the order of compare_names
+    # topn(i, path) gives (dataframes, number of systems of each) for compare_path i, by default computed from the table
+    # (render_figures.py reads them from its cache instead)
+    list_of_dataframes = []
+    list_of_ranges = []
+    list_of_costs = []
+    names = args.compare_names
+    for i, path in enumerate(args.compare_paths):  # Calculate all of the dataframes to use for the graphs
+        assert len(names), "The number of names is not the same as the amount of tags in all of the csvs provided"
+        if topn is None:
+            plot_df, rang = getPlottingDataFrame(path, names, args.col_names, args.header, args.delimiter, args.usecols, args.key, args.num_unique, args.bootstrap, args.strata, args.ci, args.chunksize, args.exclude)
+        else:
+            plot_df, nsystems = topn(i, path)
+            plot_df = plot_df[:len(names)]
+            rang = namePlottingDataFrames(plot_df, nsystems, names, args.num_unique)
+        names = names[len(plot_df):]
+        list_of_dataframes += plot_df
+        list_of_ranges += rang
+        if args.cost_graph:
+            info = getBenchmarkInfo(args.cost_paths[i], args.cost_metric)
+            for df in plot_df:
+                tag = str(df.attrs['tag'])
+                list_of_costs.append(info.at[tag, 'mean'] if tag in info.index else None)
+                if tag in info.index:
+                    print(f"{tag}: {info.at[tag, 'mean']:.1f} s per system over {info.at[tag, 'systems']} systems, peak RSS {info.at[tag, 'maxrss_kb']/1024:.0f} MiB")
+                else:
+                    print(f"{tag}: no cost records")
+    return list_of_dataframes, list_of_ranges, list_of_costs
+
+
+def makeGraphs(args, list_of_dataframes, list_of_ranges, list_of_costs):
+    # Makes every graph asked for, closing each figure once it is saved
+    if args.line_graph:
+        makeLineGraph(args, list_of_dataframes, list_of_ranges)
+        getPyplot().close('all')
+    if args.bar_graph:
+        makeBarGraph(args, list_of_dataframes)
+        getPyplot().close('all')
+    if args.cost_graph:
+        makeBenchmarkGraph(args, list_of_dataframes, list_of_costs)
+        getPyplot().close('all')
+
+
+def main(argv=None):
+    args = makeParser().parse_args(argv)
+    checkArgs(args)
+    makeGraphs(args, *collectPlottingData(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+'''
+Helpers for the gnina command lines written by make_gnina_cmds.py.
+
+A command file has one gnina invocation per line. These helpers pull a command apart into
+its options so the runner and the other pipeline stages do not each re-implement the
+regex splitting done in obrms_calc.py.
+
+canonical_command reduces a command to the options that change its result, so the same docking
+run written two ways (option order, ensemble order, '8' vs '8.0', a default spelled out) gets the
+same key, and a registry of keys lets later sweeps reuse outputs already docked.
+
+An output split from a multi-ligand run by batch_gnina.py is not what its command gives on its own:
+gnina seeds once per run, so with a fixed --seed the poses of a ligand depend on the ligands docked
+before it. batch_membership tells those outputs apart so they are keyed with their batch.
+'''
+
+import hashlib, json, os, shlex
+from collections import namedtuple
+
+Job = namedtuple('Job', ['line', 'tokens', 'out'])
+
+#gnina's built in default ensemble (what make_gnina_cmds.py runs when --cnn is not given)
+DEFAULT_ENSEMBLE = ['dense', 'general_default2018_3', 'dense_3', 'crossdock_default2018', 'redock_default2018']
+
+#values gnina uses for options that are not given, so spelling one out is the same job
+GNINA_DEFAULTS = {
+    '--exhaustiveness': '8',
+    '--num_modes': '9',
+    '--min_rmsd_filter': '1',
+    '--autobox_add': '4',
+    '--cnn_rotation': '0',
+    '--num_mc_saved': '50',
+    '--cnn_empirical_weight': '1',
+    '--cnn_scoring': 'rescore',
+    '--cnn': tuple(sorted(DEFAULT_ENSEMBLE)),
+}
+ALIASES = {'-r': '--receptor', '-l': '--ligand', '-o': '--out'}
+FILE_OPTIONS = {'--receptor', '--ligand', '--autobox_ligand', '--flexdist_ligand', '--flexres'}
+#options that only say where or how fast to run, not what comes out
+IGNORED_OPTIONS = {'--out', '--cpu', '--log'}
+#sidecar of an output split from a batched run
+BATCH_SUFFIX = '.batch'
+
+
+def parse_command(line):
+    '''
+    Split one gnina command line into a Job.
+
+    out is the value of --out (or -o), None if the command does not write poses.
+    '''
+
+    tokens = shlex.split(line)
+    return Job(line.rstrip('\n'), tokens, get_option(tokens, '--out', '-o'))
+
+
+def read_commands(filename):
+    '''
+    Parse every non-empty line of a command file into a Job.
+    '''
+
+    with open(filename) as infile:
+        return [parse_command(line) for line in infile if line.strip()]
+
+
+def get_option(tokens, *flags):
+    '''
+    Value following the first of flags in tokens, None if none of them is present.
+    '''
+
+    for i, tok in enumerate(tokens[:-1]):
+        if tok in flags:
+            return tokens[i+1]
+    return None
+
+
+def get_values(tokens, *flags):
+    '''
+    All values following a flag up to the next option (e.g. the models after --cnn).
+    '''
+
+    for i, tok in enumerate(tokens):
+        if tok in flags:
+            values = []
+            for val in tokens[i+1:]:
+                if val.startswith('-') and not _is_number(val):
+                    break
+                values.append(val)
+            return values
+    return []
+
+
+def set_option(tokens, flag, value):
+    '''
+    Copy of tokens with flag set to value, appending the flag if it is missing.
+    '''
+
+    tokens = list(tokens)
+    for i, tok in enumerate(tokens[:-1]):
+        if tok == flag:
+            tokens[i+1] = str(value)
+            return tokens
+    return tokens+[flag, str(value)]
+
+
+def parse_options(tokens):
+    '''
+    {flag: tuple of values} of a tokenized command (the executable is skipped), with short flags expanded.
+    '''
+
+    options = {}
+    flag = None
+    for tok in tokens[1:]:
+        if tok.startswith('-') and not _is_number(tok):
+            flag = ALIASES.get(tok, tok)
+            options[flag] = ()
+        elif flag is not None:
+            options[flag] += (tok,)
+    return options
+
+
+def canonical_command(tokens, file_key=os.path.normpath):
+    '''
+    Canonical text of a gnina command: options sorted, defaults and output/threading options dropped,
+    numbers normalized, paths normalized and the --cnn ensemble sorted.
+
+    file_key maps the input file arguments (receptor, ligand, ...); result_cache.py uses their content hashes.
+    '''
+
+    options = parse_options(tokens)
+    options.setdefault('--cnn', GNINA_DEFAULTS['--cnn'])
+    canon = []
+    for flag, values in options.items():
+        if flag in IGNORED_OPTIONS:
+            continue
+        if flag == '--cnn':
+            values = tuple(sorted(set(values)))
+        elif flag in FILE_OPTIONS:
+            values = tuple(file_key(v) for v in values)
+        else:
+            values = tuple(format(float(v), '.12g') if _is_number(v) else v for v in values)
+        default = GNINA_DEFAULTS.get(flag)
+        if default is not None and values == (default if isinstance(default, tuple) else (default,)):
+            continue
+        canon.append(' '.join((flag,)+values))
+    return 'gnina '+' '.join(sorted(canon))
+
+
+def _content_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_batch_membership(out, members, index):
+    '''
+    Record in out's sidecar that it was split from a batched run of the command lines members,
+    as the index-th of them.
+    '''
+
+    rec = {'members': [canonical_command(shlex.split(line)) for line in members], 'index': index,
+           'sha256': _content_digest(out)}
+    with open(out+BATCH_SUFFIX, 'w') as outfile:
+        json.dump(rec, outfile)
+
+
+def batch_membership(out):
+    '''
+    {'members': canonical commands, 'index': position} of the batch out was split from, None if it
+    was docked on its own or has been replaced since the split.
+    '''
+
+    try:
+        with open(out+BATCH_SUFFIX) as infile:
+            rec = json.load(infile)
+        if rec.pop('sha256') != _content_digest(out):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return rec
+
+
+def load_registry(filename):
+    '''
+    {canonical command: output} of every command recorded in a registry file (one JSON record per line).
+    '''
+
+    known = {}
+    if filename and os.path.isfile(filename):
+        with open(filename) as infile:
+            for line in infile:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                known.setdefault(rec['key'], rec['out'])
+    return known
+
+
+def append_registry(filename, entries):
+    '''
+    Record (canonical command, output) pairs in a registry file.
+    '''
+
+    with open(filename, 'a') as outfile:
+        for key, out in entries:
+            outfile.write(json.dumps({'key': key, 'out': out})+'\n')
+
+
+def _is_number(text):
+    try:
+        float(text)
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+'''
+Cost-aware ordering and sharding of the command file written by make_gnina_cmds.py.
+
+Each command gets a predicted runtime from:
+        ligand heavy atom count and rotatable bonds
+        search box volume (autobox ligand extent + autobox_add on each side; whole protein boxes are huge)
+        exhaustiveness
+        the CNN models used (per-model cost taken from data/benchmark/*.csv, with GPU and CPU timings)
+        cnn_scoring (refinement runs the CNN inside the search)
+
+The empirical (Vina) part of the model is refit against the journals of past runs from
+run_gnina_cmds.py when they are given.
+
+Commands are then written longest-processing-time first, optionally split into shards with
+balanced predicted totals so that several nodes finish at the same time.
+
+Output:
+        <output>                 -- all commands, longest predicted first  (without --shards)
+        <output stem>_shard<k>   -- one command file per shard               (with --shards)
+'''
+
+import argparse, heapq, json, os
+import numpy as np
+from gnina_jobs import DEFAULT_ENSEMBLE, read_commands, get_option, get_values
+from sdf_stream import bridges, records
+
+#benchmark csv names of the single models and the family they belong to
+BENCHMARK_FAMILIES = {
+    'Crossdock Default2018': 'crossdock_default2018',
+    'Crossdock Dense': 'dense',
+    'Default2017': 'default2017',
+    'General Default2018': 'general_default2018',
+    'Redock Default2018': 'redock_default2018',
+}
+
+DEFAULT_BENCHMARKS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'benchmark', name) for name in ('gpu_models.csv', 'nogpu_models.csv')]
+
+
+def _read_benchmark(filename):
+    means = {}
+    with open(filename) as infile:
+        next(infile)
+        for line in infile:
+            _, model, mean = line.rstrip().split(',')
+            means[model] = float(mean)
+    return means
+
+
+def ligand_features(path):
+    '''
+    (heavy atoms, rotatable bonds) of the first molecule in a ligand file.
+
+    A bond counts as rotatable if it is not in a ring and both ends have another heavy neighbor.
+    Bond orders are not used, so non-ring double bonds are counted too.
+    '''
+
+    mol = next(records(path))
+    heavy = [i for i, e in enumerate(mol.elements) if e not in ('H', 'D')]
+    renum = {old: new for new, old in enumerate(heavy)}
+    bonds = [(renum[a], renum[b]) for a, b in mol.bonds if a in renum and b in renum]
+    degree = np.zeros(len(heavy), dtype=int)
+    for a, b in bonds:
+        degree[a] += 1
+        degree[b] += 1
+    rot = sum(1 for k in bridges(len(heavy), bonds) if degree[bonds[k][0]] > 1 and degree[bonds[k][1]] > 1)
+    return len(heavy), rot
+
+
+def box_volume(path, autobox_add=4.0):
+    '''
+    Volume of the autobox made from the atoms in path (sdf(.gz) or pdb).
+    '''
+
+    if '.pdb' in path:
+        coords = []
+        with open(path) as infile:
+            for line in infile:
+                if line.startswith(('ATOM', 'HETATM')):
+                    coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+        coords = np.array(coords)
+    else:
+        coords = next(records(path)).coords
+    extent = coords.max(axis=0)-coords.min(axis=0)+2*autobox_add
+    return float(np.prod(extent))
+
+
+class RuntimePredictor:
+    '''
+    Predicts the wall time (seconds) of a gnina command.
+
+    time = vina * (heavy/h0)^a * ((1+rot)/(1+r0))^b * (volume/v0)^c * (exhaustiveness/8)^d + cnn
+
+    where vina is the benchmark Vina time of an average system (h0, r0, v0 are the means over the
+    commands being scheduled) and cnn is the summed benchmark cost of the models, scaled for
+    refinement. fit() replaces (vina, a, b, c, d) with a least squares fit to past runs.
+    '''
+
+    def __init__(self, benchmarks=DEFAULT_BENCHMARKS):
+        self.coef = np.array([np.log(25.0), 1.0, 0.5, 0.3, 1.0])
+        self.model_cost = {'gpu': {}, 'cpu': {}}
+        self.refine_factor = {'gpu': 1.0, 'cpu': 1.0}
+        self.ref = np.zeros(3)
+        self._features = {}
+        for filename in benchmarks:
+            if os.path.isfile(filename):
+                self.calibrate_benchmark(filename, 'cpu' if 'nogpu' in os.path.basename(filename) else 'gpu')
+
+    def calibrate_benchmark(self, filename, device):
+        '''
+        Per-model CNN costs from one of the data/benchmark csvs.
+
+        The single model row gives the cost of <family> and the ensemble row gives the cost of
+        <family>_1 ... <family>_4 as (ensemble - single)/4, both relative to the Vina row.
+        '''
+
+        means = _read_benchmark(filename)
+        vina = means['Vina']
+        if device == 'gpu':
+            self.coef[0] = np.log(vina)
+        costs = self.model_cost[device]
+        for name, family in BENCHMARK_FAMILIES.items():
+            if name not in means:
+                continue
+            single = max(means[name]-vina, 0.0)
+            costs[family] = single
+            if name+' Ensemble' in means:
+                member = max((means[name+' Ensemble']-vina-single)/4, 0.0)
+                for k in range(1, 5):
+                    costs[f'{family}_{k}'] = member
+        if 'Default Ensemble Refine' in means and 'Default Ensemble' in means:
+            self.refine_factor[device] = (means['Default Ensemble Refine']-vina)/max(means['Default Ensemble']-vina, 1e-6)
+        elif device == 'cpu':
+            self.refine_factor['cpu'] = self.refine_factor['gpu']
+
+    def job_features(self, tokens):
+        '''
+        (heavy atoms, rotatable bonds, box volume, exhaustiveness) of one command.
+        '''
+
+        lig = get_option(tokens, '-l', '--ligand')
+        box = get_option(tokens, '--autobox_ligand')
+        add = float(get_option(tokens, '--autobox_add') or 4)
+        key = (lig, box, add)
+        if key not in self._features:
+            heavy, rot = ligand_features(lig)
+            self._features[key] = (heavy, rot, box_volume(box if box else lig, add))
+        exh = float(get_option(tokens, '--exhaustiveness') or 8)
+        return self._features[key]+(exh,)
+
+    def cnn_cost(self, tokens):
+        '''
+        Benchmark CNN cost of the models a command uses.
+        '''
+
+        scoring = get_option(tokens, '--cnn_scoring') or 'rescore'
+        if scoring == 'none':
+            return 0.0
+        device = 'cpu' if '--no_gpu' in tokens else 'gpu'
+        models = get_values(tokens, '--cnn') or DEFAULT_ENSEMBLE
+        costs = self.model_cost[device]
+        fallback = np.mean(list(costs.values())) if costs else 0.0
+        cost = sum(costs.get(m, fallback) for m in models)
+        if scoring in ('refinement', 'all'):
+            exh = float(get_option(tokens, '--exhaustiveness') or 8)
+            cost *= self.refine_factor[device]*exh/8
+        return cost
+
+    def _design(self, feats):
+        feats = np.asarray(feats, dtype=float)
+        logs = np.column_stack([np.log(feats[:, 0]), np.log1p(feats[:, 1]), np.log(feats[:, 2]), np.log(feats[:, 3]/8)])
+        logs[:, :3] -= self.ref
+        return np.column_stack([np.ones(len(feats)), logs])
+
+    def set_reference(self, jobs):
+        '''
+        Center the features on the commands being scheduled, so that the benchmark means
+        describe an average system of this job list. An empty list keeps the current reference.
+        '''
+
+        if not jobs:
+            return
+        feats = np.array([self.job_features(job.tokens) for job in jobs], dtype=float)
+        self.ref = np.array([np.log(feats[:, 0]).mean(), np.log1p(feats[:, 1]).mean(), np.log(feats[:, 2]).mean()])
+
+    def fit(self, journal_files, min_records=10):
+        '''
+        Refit the empirical part of the model on the finished commands in run_gnina_cmds.py journals.
+
+        Returns the number of records used (the defaults are kept below min_records).
+        '''
+
+        feats, target = [], []
+        for journal in journal_files:
+            with open(journal) as infile:
+                for line in infile:
+                    try:
+                        rec = json.loads(line)
+                        if rec['status'] != 'done':
+                            continue
+                        tokens = rec['cmd'].split()
+                        vina = rec['elapsed']-self.cnn_cost(tokens)
+                        if vina <= 0:
+                            continue
+                        feats.append(self.job_features(tokens))
+                        target.append(np.log(vina))
+                    except (ValueError, KeyError, OSError, StopIteration):
+                        continue
+        if len(target) >= min_records:
+            self.coef = np.linalg.lstsq(self._design(feats), np.array(target), rcond=None)[0]
+        return len(target)
+
+    def predict(self, jobs):
+        '''
+        Predicted seconds for every Job.
+        '''
+
+        if not jobs:
+            return np.zeros(0)
+        feats = [self.job_features(job.tokens) for job in jobs]
+        vina = np.exp(self._design(feats) @ self.coef)
+        return vina+np.array([self.cnn_cost(job.tokens) for job in jobs])
+
+
+def lpt_shards(times, nshards):
+    '''
+    Longest-processing-time-first assignment of jobs to nshards.
+
+    Returns (shards, loads): shards is a list of job index lists, each in descending time
+    order, loads is the predicted total of every shard.
+    '''
+
+    if nshards < 1:
+        raise ValueError(f'need at least one shard, got {nshards}')
+    order = np.argsort(-np.asarray(times), kind='stable')
+    heap = [(0.0, k) for k in range(nshards)]
+    shards = [[] for _ in range(nshards)]
+    loads = [0.0]*nshards
+    for i in order:
+        load, k = heapq.heappop(heap)
+        shards[k].append(int(i))
+        loads[k] = load+times[i]
+        heapq.heappush(heap, (loads[k], k))
+    return shards, loads
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Order gnina commands longest predicted runtime first and optionally split them into balanced shards.')
+    parser.add_argument('-i', '--input', required=True, help='Command file made by make_gnina_cmds.py.')
+    parser.add_argument('-o', '--output', required=True, help='Name of the ordered command file. With --shards, <stem>_shard<k><ext> files are written instead.')
+    parser.add_argument('--shards', type=int, default=0, help='Number of node shards to split the commands into (default: 0, no sharding)')
+    parser.add_argument('--workers', type=int, default=1, help='Concurrent commands per shard, only used for the makespan estimate.')
+    parser.add_argument('--journals', nargs='+', default=[], help='run_gnina_cmds.py journals of past runs to calibrate the predictor on.')
+    parser.add_argument('--benchmarks', nargs='+', default=DEFAULT_BENCHMARKS, help='Benchmark csvs with per-model mean times (default: data/benchmark/*.csv).')
+    args = parser.parse_args(argv)
+    if args.shards < 0:
+        parser.error('--shards must be at least 1 (or 0 for no sharding)')
+
+    jobs = read_commands(args.input)
+    predictor = RuntimePredictor(args.benchmarks)
+    predictor.set_reference(jobs)
+    if args.journals:
+        print(f'calibrated on {predictor.fit(args.journals)} past runs')
+    times = predictor.predict(jobs)
+    print(f'{len(jobs)} commands, {times.sum()/3600:.1f} predicted cpu-hours')
+
+    if args.shards:
+        shards, loads = lpt_shards(times, args.shards)
+        stem, ext = os.path.splitext(args.output)
+        for k, shard in enumerate(shards):
+            with open(f'{stem}_shard{k}{ext}', 'w') as outfile:
+                for i in shard:
+                    outfile.write(jobs[i].line+'\n')
+            print(f'shard {k}: {len(shard)} commands, {loads[k]/3600/args.workers:.1f} predicted hours')
+    else:
+        with open(args.output, 'w') as outfile:
+            for i in np.argsort(-times, kind='stable'):
+                outfile.write(jobs[i].line+'\n')
+        print(f'{times.sum()/3600/args.workers:.1f} predicted hours on {args.workers} workers')
+
+
+if __name__ == '__main__':
+    main()
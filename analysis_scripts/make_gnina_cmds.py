@@ -3,10 +3,21 @@
 '''
 This script aims to create a text file with a line per gnina command that needs to be run.
 
-NOTE if an option(s) is selected, the script will write a command for that option while keeping the others as gnina's defaults!
+NOTE by default (--mode oat) if an option(s) is selected, the script will write a command for that option while keeping the others as gnina's defaults!
 
 IE if you specify --exhaustiveness 1 2 3 AND --cnn_rotations 1 2 3 you will get 6 jobs (not 9)!
 
+The other modes combine the options:
+        grid   -- every combination of the values (9 jobs in the example above)
+        lhs    -- --samples combinations by Latin hypercube sampling over the value lists
+        random -- --samples combinations drawn at random
+and are named <outfile prefix>...<option1><value1>_<option2><value2>...
+
+With --dedupe (implied by --registry) commands that would dock the same thing as a command already
+written -- in this file, in a --previous command file or in the registry -- are not written again.
+Their output name is symlinked to the existing output and the command goes to <output>.reused so
+obrms_calc.py can still be run on it.
+
 Input:
         infile         -- a space-delimited file containing: <recfile> <ligfile> <autobox_ligand file> <outfile prefix>
         cnn            -- defaults to gnina default. Must be in [crossdock_default2018, crossdock_default2018_<1-4>, 
@@ -21,6 +32,11 @@ Input:
         num_mc_saved   -- number(s)
         cnn_empirical_weight -- number(s)
         --gpu : this will turn on gpu acceleration for the command.
+        mode           -- oat (default), grid, lhs or random
+        samples        -- number of combinations for lhs and random
+        registry       -- file of the commands of every run, used to reuse outputs across sweeps
+        cache          -- result cache directory (see result_cache.py)
+        gnina_version  -- gnina version of the cache keys where gnina can not be run
 
 The name of the output file for the gnina command will be the name of the outfile_prefix+"option"+.sdf
 
@@ -28,7 +44,8 @@ Output:
         a text file with a command per line.
 '''
 
-import argparse, os, re
+import argparse, itertools, os, random, re
+from gnina_jobs import append_registry, batch_membership, canonical_command, load_registry, parse_command, read_commands
 
 def make_out_name(cnns):  # make sure names of output sdf is consistent for single models and ensembles
     # Ensembles will be named <model>_<seed_values>
@@ -48,28 +65,6 @@ def make_out_name(cnns):  # make sure names of output sdf is consistent for sing
 
     return f'{"_".join(out_strings)}'
 
-parser=argparse.ArgumentParser(description='Create a text file containing all the gnina commands you specify to run.')
-parser.add_argument('-i','--input',required=True,help='Space-delimited file containing: <Receptor file> <Ligand file> <autobox ligand file> <outfile prefix>.')
-parser.add_argument('-o','--output',default='gnina_cmds.txt',help='Name of the output file containing the commands to run. Defaults to "gnina_cmds.txt"')
-parser.add_argument('--cnn',nargs='+',help="Specify built-in CNN model for gnina. Defaults to unspecified cnn, which uses the default cnn model of gnina. If multiple models are specified, an ensemble will be evaluated.(ensembles can also be specified through the same notation as Gnina, i.e. '<model>_ensemble' to specify the ensemble of <model>")
-parser.add_argument('--cnn_scoring',default='rescore',help='Specify what method of CNN scoring. Must be [none, rescore,refinement,all]. Defaults to rescore')
-parser.add_argument('--exhaustiveness',default=None,nargs='+',help='exhaustiveness arguments for gnina. Accepts any number of arguments.')
-parser.add_argument('--min_rmsd_filter',default=None,nargs='+',help='Filters for min_rmsd_filter for gnina. Accepts any number of arguments.')
-parser.add_argument('--cnn_rotation',default=None,nargs='+',help='Options for cnn_rotation for gnina. Accepts any number of arguments. All must be [0,24].')
-parser.add_argument('--num_modes',default=None,nargs='+',help='Options for num_modes for gnina. Accepts any number of arguments.')
-parser.add_argument('--autobox_add',default=None,nargs='+',help='Options for autobox_add for gnina. Accepts any number of arguments.')
-parser.add_argument('--num_mc_saved',default=None,nargs='+',help='Options for num_mc_saved for gnina. Accepts any number of arguments.')
-parser.add_argument('--cnn_empirical_weight',default=None, nargs='+',help='Option for merging CNN with empirical forces and energies during docking. Accepts any number of arguments.')
-parser.add_argument('--nogpu',action='store_true',help='Flag to turn OFF gpu acceleration for gnina.')
-parser.add_argument('--seed',default=420,type=int,help='Seed for Gnina (default: %(default)d)')
-args=parser.parse_args()
-
-#Checking that the input arguments make sense
-if args.cnn_rotation:
-    for rot in args.cnn_rotation:
-        assert (0<=int(rot) and int(rot)<=24),"cnn_rotations need to be in [0,24]!"
-
-assert (args.cnn_scoring in ['none', 'rescore', 'refinement', 'all']),"cnn_scoring must be one of none,rescore,refinement,all!"
 possible=[
 'crossdock_default2018', 'crossdock_default2018_1', 'crossdock_default2018_2',
 'crossdock_default2018_3', 'crossdock_default2018_4', 'default2017',
@@ -78,90 +73,229 @@ possible=[
 'general_default2018_4', 'redock_default2018', 'redock_default2018_1',
 'redock_default2018_2', 'redock_default2018_3', 'redock_default2018_4'
 ]
-if args.cnn is not None:
-    if '_ensemble' in '_'.join(args.cnn):  # See if '_ensemble' in any of the arguments
-        new_args_cnn = set()  # Using set so don't have two of the same model in the ensemble
-        for model in args.cnn:
-            if 'ensemble' not in model:
-                new_args_cnn.add(model)
-            else:
-                assert model[:-len('_ensemble')] in possible+[''], "Must be ensemble of built in model(s)"  # can also be ensemble of all models which would be '_ensemble' so '' is a valid model
-                base_cnn = model[:-len('_ensemble')]
-                ensemble = [cnn_model for cnn_model in possible if base_cnn in cnn_model]
-                new_args_cnn.update(ensemble)
-        args.cnn = sorted(list(new_args_cnn))
-
-    for cnn in args.cnn:
-        assert(cnn in possible), "Specified cnn not built into gnina!"
 
 # Specifying arguments to skip over
-skip = set(['input', 'output', 'cnn', 'cnn_scoring', 'nogpu', 'seed'])
-
-# Gathering the receptor, ligand, and autobox_ligand arguments from input
-todock = []  # list of tuples (recfile,ligfile,autobox_ligand,outf_prefix)
-with open(args.input) as infile:
-    for line in infile:
-        rec, lig, box, outf_prefix = line.rstrip().split()
-        todock.append((rec, lig, box, outf_prefix))
-
-# main part of the program
-# step1 -- check if we just want all defaults
-only_defaults = True
-for arg in vars(args):
-    if arg not in skip:
-        if getattr(args, arg):
-            only_defaults = False
-
-with open(args.output, 'w') as outfile:
-    # TEMP WORKAROUND -- if only specified defaults E.G. passed no arguments into the script we still want to dock
-    if only_defaults:
+skip = set(['input', 'output', 'cnn', 'cnn_scoring', 'nogpu', 'seed', 'mode', 'samples', 'sample_seed', 'dedupe', 'registry', 'previous', 'cache', 'gnina', 'gnina_version'])
+
+def make_parser():
+    parser=argparse.ArgumentParser(description='Create a text file containing all the gnina commands you specify to run.')
+    parser.add_argument('-i','--input',required=True,help='Space-delimited file containing: <Receptor file> <Ligand file> <autobox ligand file> <outfile prefix>.')
+    parser.add_argument('-o','--output',default='gnina_cmds.txt',help='Name of the output file containing the commands to run. Defaults to "gnina_cmds.txt"')
+    parser.add_argument('--cnn',nargs='+',help="Specify built-in CNN model for gnina. Defaults to unspecified cnn, which uses the default cnn model of gnina. If multiple models are specified, an ensemble will be evaluated.(ensembles can also be specified through the same notation as Gnina, i.e. '<model>_ensemble' to specify the ensemble of <model>")
+    parser.add_argument('--cnn_scoring',default='rescore',help='Specify what method of CNN scoring. Must be [none, rescore,refinement,all]. Defaults to rescore')
+    parser.add_argument('--exhaustiveness',default=None,nargs='+',help='exhaustiveness arguments for gnina. Accepts any number of arguments.')
+    parser.add_argument('--min_rmsd_filter',default=None,nargs='+',help='Filters for min_rmsd_filter for gnina. Accepts any number of arguments.')
+    parser.add_argument('--cnn_rotation',default=None,nargs='+',help='Options for cnn_rotation for gnina. Accepts any number of arguments. All must be [0,24].')
+    parser.add_argument('--num_modes',default=None,nargs='+',help='Options for num_modes for gnina. Accepts any number of arguments.')
+    parser.add_argument('--autobox_add',default=None,nargs='+',help='Options for autobox_add for gnina. Accepts any number of arguments.')
+    parser.add_argument('--num_mc_saved',default=None,nargs='+',help='Options for num_mc_saved for gnina. Accepts any number of arguments.')
+    parser.add_argument('--cnn_empirical_weight',default=None, nargs='+',help='Option for merging CNN with empirical forces and energies during docking. Accepts any number of arguments.')
+    parser.add_argument('--nogpu',action='store_true',help='Flag to turn OFF gpu acceleration for gnina.')
+    parser.add_argument('--seed',default=420,type=int,help='Seed for Gnina (default: %(default)d)')
+    parser.add_argument('--mode',default='oat',choices=['oat','grid','lhs','random'],help='How to combine the options: one at a time (oat), all combinations (grid), Latin hypercube (lhs) or random samples (default: %(default)s)')
+    parser.add_argument('--samples',default=10,type=int,help='Number of combinations for --mode lhs or random (default: %(default)d)')
+    parser.add_argument('--sample_seed',default=0,type=int,help='Seed for --mode lhs or random (default: %(default)d)')
+    parser.add_argument('--dedupe',action='store_true',help='Flag to skip commands that dock the same thing as one already written, symlinking their outputs instead.')
+    parser.add_argument('--registry',default=None,help='File recording the commands of every run. Implies --dedupe, across all the runs using the same registry.')
+    parser.add_argument('--previous',default=[],nargs='+',help='Command files of earlier sweeps whose outputs can be reused. Implies --dedupe.')
+    parser.add_argument('--cache',default=None,help='Result cache directory (result_cache.py). Commands already in it are linked instead of written.')
+    parser.add_argument('--gnina',default='gnina',help='gnina executable whose version is part of the cache key (default: %(default)s)')
+    parser.add_argument('--gnina_version',default=None,help='gnina version for the cache keys, for hosts where gnina can not be run (default: the first line of <GNINA> --version)')
+    return parser
+
+def check_args(args):
+    #Checking that the input arguments make sense, expanding '<model>_ensemble' into its models
+    if args.cnn_rotation:
+        for rot in args.cnn_rotation:
+            assert (0<=int(rot) and int(rot)<=24),"cnn_rotations need to be in [0,24]!"
+
+    assert (args.cnn_scoring in ['none', 'rescore', 'refinement', 'all']),"cnn_scoring must be one of none,rescore,refinement,all!"
+    if args.cnn is not None:
+        if '_ensemble' in '_'.join(args.cnn):  # See if '_ensemble' in any of the arguments
+            new_args_cnn = set()  # Using set so don't have two of the same model in the ensemble
+            for model in args.cnn:
+                if 'ensemble' not in model:
+                    new_args_cnn.add(model)
+                else:
+                    assert model[:-len('_ensemble')] in possible+[''], "Must be ensemble of built in model(s)"  # can also be ensemble of all models which would be '_ensemble' so '' is a valid model
+                    base_cnn = model[:-len('_ensemble')]
+                    ensemble = [cnn_model for cnn_model in possible if base_cnn in cnn_model]
+                    new_args_cnn.update(ensemble)
+            args.cnn = sorted(list(new_args_cnn))
+
+        for cnn in args.cnn:
+            assert(cnn in possible), "Specified cnn not built into gnina!"
+    return args
+
+def read_pairs(filename):
+    # Gathering the receptor, ligand, and autobox_ligand arguments from input
+    todock = []  # list of tuples (recfile,ligfile,autobox_ligand,outf_prefix)
+    with open(filename) as infile:
+        for line in infile:
+            rec, lig, box, outf_prefix = line.rstrip().split()
+            todock.append((rec, lig, box, outf_prefix))
+    return todock
+
+def dock_out_name(args, out_prefix, label):
+    # label is 'defaults' or <option><value>
+    if args.cnn is None:
+        return out_prefix + 'default_ensemble_' + args.cnn_scoring + '_' + label + '.sdf.gz'
+    elif len(args.cnn) == len(possible):
+        return out_prefix+'all_ensemble_'+args.cnn_scoring+'_'+ label +'.sdf.gz'
+    cnn_out_string = make_out_name(args.cnn)
+    return out_prefix+cnn_out_string+'_'+args.cnn_scoring+ '_' + label +'.sdf.gz'
+
+def make_command(args, r, l, box, out_prefix, config=()):
+    # config is a sequence of (option, value) pairs to set, empty for gnina's defaults
+    sent = f'gnina -r {r} -l {l} --autobox_ligand {box} --cnn_scoring {args.cnn_scoring} --cpu 1 --seed {args.seed}'
+    label = '_'.join(arg + val for arg, val in config) if config else 'defaults'
+    dock_out = dock_out_name(args, out_prefix, label)
+    if args.cnn is None:
+        sent += f' --out {dock_out}'
+    else:
+        sent += f' --cnn {" ".join(args.cnn)} --out {dock_out}'
+
+    for arg, val in config:
+        # adding in the stuff for the specified argument
+        sent += f' --{arg} {val}'
+
+        #if the cnn_empirical_weight is selected, adding the other necessary gnina flags.
+        if arg == 'cnn_empirical_weight':
+            sent+=' --cnn_mix_emp_force --cnn_mix_emp_energy'
+
+    if args.nogpu:
+            sent += ' --no_gpu'
+    return sent
+
+def sweep_options(args):
+    # (option, values) of every option that was given, in parser order
+    return [(arg, getattr(args, arg)) for arg in vars(args) if arg not in skip and getattr(args, arg)]
+
+def latin_hypercube(options, samples, rng):
+    # each option's value list is cut into samples equal strata, and every stratum is used once per option
+    columns = []
+    for _, values in options:
+        strata = list(range(samples))
+        rng.shuffle(strata)
+        columns.append([values[int((k + rng.random()) / samples * len(values))] for k in strata])
+    return [tuple(col[i] for col in columns) for i in range(samples)]
+
+def make_configs(args):
+    # list of configs (tuples of (option, value)) to dock, following --mode
+    options = sweep_options(args)
+    if not options:
+        return [()]
+    if args.mode == 'oat':
+        return [((arg, val),) for arg, values in options for val in values]
+    names = [arg for arg, _ in options]
+    if args.mode == 'grid':
+        combos = itertools.product(*[values for _, values in options])
+    else:
+        rng = random.Random(args.sample_seed)
+        if args.mode == 'lhs':
+            combos = latin_hypercube(options, args.samples, rng)
+        else:
+            combos = [tuple(rng.choice(values) for _, values in options) for _ in range(args.samples)]
+    configs = []
+    for combo in combos:
+        config = tuple(zip(names, combo))
+        if config not in configs:  # sampling with few values per option repeats combinations
+            configs.append(config)
+    return configs
+
+def make_commands(args, todock):
+    # main part of the program
+    configs = make_configs(args)
+    cmds = []
+    if configs == [()]:
+        # TEMP WORKAROUND -- if only specified defaults E.G. passed no arguments into the script we still want to dock
         print('default arguments')
+    for config in configs:
+        print(' '.join(arg + ' ' + val for arg, val in config))
         for r, l, box, out_prefix in todock:
-            sent = f'gnina -r {r} -l {l} --autobox_ligand {box} --cnn_scoring {args.cnn_scoring} --cpu 1 --seed {args.seed}'
-            if args.cnn is None:
-                dock_out = out_prefix + 'default_ensemble_' + args.cnn_scoring+'_defaults.sdf.gz'
-            elif len(args.cnn) == len(possible):
-                dock_out = out_prefix+'all_ensemble_'+args.cnn_scoring+'_defaults.sdf.gz'
-            else:
-                cnn_out_string = make_out_name(args.cnn)
-                dock_out = out_prefix+cnn_out_string+'_'+args.cnn_scoring+'_defaults.sdf.gz'
-            if args.cnn is None:
-                sent += f' --out {dock_out}'
-            else:
-                sent += f' --cnn {" ".join(args.cnn)} --out {dock_out}'
-
-            if args.nogpu:
-                    sent += ' --no_gpu'
+            cmds.append(make_command(args, r, l, box, out_prefix, config))
+    return cmds
+
+def dedupe_commands(cmds, known):
+    # Splits cmds into the commands to run and (command, existing output) pairs whose result is
+    # already known. known maps canonical commands to outputs and gets the new commands added.
+    # An output split from a batched run (batch_gnina.py) depends on its batch, so it is not reused.
+    torun = []
+    reused = []
+    for sent in cmds:
+        job = parse_command(sent)
+        key = canonical_command(job.tokens)
+        target = known.get(key)
+        if target is not None and target != job.out and batch_membership(target) is not None:
+            target = None
+        if target is None or target == job.out:
+            known[key] = job.out
+            torun.append((sent, key))
+        else:
+            reused.append((sent, target))
+    return torun, reused
+
+def link_output(out, target):
+    # point the legacy output name at the output that is already (or will be) docked
+    if os.path.lexists(out):
+        return
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    os.symlink(os.path.relpath(target, os.path.dirname(out) or '.'), out)
+
+def cached_commands(torun, cache_dir, gnina, version=None):
+    # Splits (command, key) pairs into those to run and those already in the result cache, linking the latter
+    # version is the gnina version of the cache keys, by default asked from gnina
+    from result_cache import ResultCache, gnina_version, job_key
+    cache = ResultCache(cache_dir)
+    version = version or gnina_version(gnina)
+    keep = []
+    hits = []
+    for sent, key in torun:
+        job = parse_command(sent)
+        path = cache.lookup(job_key(job.tokens, version), job.out)
+        if path:
+            cache.link(path, job.out)
+            hits.append((sent, key))
+        else:
+            keep.append((sent, key))
+    return keep, hits
+
+def main(argv=None):
+    parser = make_parser()
+    args = check_args(parser.parse_args(argv))
+    todock = read_pairs(args.input)
+    cmds = make_commands(args, todock)
+    if not (args.dedupe or args.registry or args.previous or args.cache):
+        with open(args.output, 'w') as outfile:
+            for sent in cmds:
+                outfile.write(sent+'\n')
+        return
+
+    known = {}
+    if args.dedupe or args.registry or args.previous:
+        known = load_registry(args.registry)
+        for filename in args.previous:
+            for job in read_commands(filename):
+                known.setdefault(canonical_command(job.tokens), job.out)
+    torun, reused = dedupe_commands(cmds, known)
+    hits = []
+    if args.cache:
+        try:
+            torun, hits = cached_commands(torun, args.cache, args.gnina, args.gnina_version)
+        except RuntimeError as e:
+            parser.error(str(e))
+    with open(args.output, 'w') as outfile:
+        for sent, _ in torun:
             outfile.write(sent+'\n')
-    else:
-        for arg in vars(args):
-            if arg not in skip:
-                print(arg)
-                if getattr(args, arg):
-                    for val in getattr(args, arg):
-                        print(val)
-                        for r, l, box, out_prefix in todock:
-                            sent = f'gnina -r {r} -l {l} --autobox_ligand {box} --cnn_scoring {args.cnn_scoring} --cpu 1 --seed {args.seed}'
-                            if args.cnn is None:
-                                dock_out = out_prefix + 'default_ensemble_' + args.cnn_scoring + '_' + arg + val + '.sdf.gz'
-                            elif len(args.cnn) == len(possible):
-                                dock_out = out_prefix+'all_ensemble_'+args.cnn_scoring+'_'+ arg + val +'.sdf.gz'
-                            else:
-                                cnn_out_string = make_out_name(args.cnn)
-                                dock_out = out_prefix+cnn_out_string+'_'+args.cnn_scoring+ '_' + arg + val +'.sdf.gz'
-
-                            if args.cnn is None:
-                                sent += f' --out {dock_out}'
-                            else:
-                                sent += f' --cnn {" ".join(args.cnn)} --out {dock_out}'
-
-                            # adding in the stuff for the specified argument
-                            sent += f' --{arg} {val}'
-
-                            #if the cnn_empirical_weight is selected, adding the other necessary gnina flags.
-                            if arg == 'cnn_empirical_weight':
-                                sent+=' --cnn_mix_emp_force --cnn_mix_emp_energy'
-
-                            if args.nogpu:
-                                    sent += ' --no_gpu'
-                            outfile.write(sent+'\n')
+    with open(args.output+'.reused', 'w') as outfile:
+        for sent, target in reused:
+            link_output(parse_command(sent).out, target)
+            outfile.write(sent+'\n')
+        for sent, _ in hits:
+            outfile.write(sent+'\n')
+    if args.registry:
+        append_registry(args.registry, [(key, parse_command(sent).out) for sent, key in torun+hits])
+    print(f'{len(torun)} commands to run, {len(reused)+len(hits)} reuse existing outputs (listed in {args.output}.reused)')
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,9 @@
 '''
 This is a script that takes as an argument a directory name and docking job lines.
 
-It then will use obrms to calculate the true rmsd to the correct ligand.
+It then will calculate the true rmsd to the correct ligand with rmsd_engine.py, an in-process
+equivalent of obrms. Each reference ligand is only parsed once and all of the poses in an output
+file are scored in one batch.
 
 The --CNNscore flag will trigger the use of sdsorter to sort the molecule by CNNscore instead of minimizedAffinity
 	before performing the obrms calculation.
@@ -11,9 +13,11 @@ The --CNNscore flag will trigger the use of sdsorter to sort the molecule by CNN
 
 
 import argparse, re
-from plumbum.cmd import obrms
-from plumbum.cmd import grep
-from plumbum.cmd import zgrep
+from rmsd_engine import RMSDCalculator
+from sdf_stream import records, tag_values
+from sdf_index import indexed_records
+
+SCORE_TAGS=['CNNscore','CNNaffinity','minimizedAffinity']
 
 def get_lig_out(instring):
 	'''
@@ -34,39 +38,48 @@ def splitter(intuple, pattern):
 
 	return (intuple[0].split(pattern)[1], intuple[1].split(pattern)[1])
 
-parser=argparse.ArgumentParser(description='Run OBRMS on docking outputs')
-parser.add_argument('-i','--input',type=str, required=True, help='Name of docking jobs file.')
-parser.add_argument('-d','--dirname',type=str,required=True, help='Name of directory the job will work on')
-parser.add_argument('-s','--splitprefix',type=str,default=None, help='Text prefix to split off of filepaths in input. Defaults to None')
-parser.add_argument('--getscores',action='store_true', help='Flag to output the CNNscore, CNNaffinity, and minimizedAffinity in the output file (in that order)')
+def rmsd_lines(calculator, dockedlig, getscores=False, index=False):
+	'''
+	Lines of the .rmsds file for one docked output: the obrms line of each pose, followed by
+	the CNNscore, CNNaffinity and minimizedAffinity if getscores. With index the sdf_index.py
+	sidecar of the output is written from the same pass.
+	'''
 
-args=parser.parse_args()
+	#one decompression pass gives both the coordinates and the score tags
+	poses=indexed_records(dockedlig) if index else list(records(dockedlig))
+	items=calculator.obrms_lines(poses)
+	if not getscores:
+		return items
+	return [' '.join([start]+tag_values(pose,SCORE_TAGS)) for start,pose in zip(items,poses)]
 
+def main(argv=None):
+	parser=argparse.ArgumentParser(description='Run OBRMS on docking outputs')
+	parser.add_argument('-i','--input',type=str, required=True, help='Name of docking jobs file.')
+	parser.add_argument('-d','--dirname',type=str,required=True, help='Name of directory the job will work on')
+	parser.add_argument('-s','--splitprefix',type=str,default=None, help='Text prefix to split off of filepaths in input. Defaults to None')
+	parser.add_argument('--getscores',action='store_true', help='Flag to output the CNNscore, CNNaffinity, and minimizedAffinity in the output file (in that order)')
+	parser.add_argument('--index',action='store_true', help='Flag to also write the sdf_index.py index (<output>.idx) of every docked output while it is read.')
 
-todo=open(args.input).readlines()
-todo=[get_lig_out(x) for x in todo if args.dirname in x]
+	args=parser.parse_args(argv)
 
-if args.splitprefix:
-	todo=[splitter(x, args.splitprefix) for x in todo]
+	todo=open(args.input).readlines()
+	todo=[get_lig_out(x) for x in todo if args.dirname in x]
 
+	if args.splitprefix:
+		todo=[splitter(x, args.splitprefix) for x in todo]
 
-#we now have a list of (lig, dockedlig) tuples.
-for lig, dockedlig in todo:
 
-	outname=dockedlig.split('.sdf')[0]+'.rmsds'
+	#we now have a list of (lig, dockedlig) tuples.
+	#the same reference ligand shows up once per sweep value, so keep its mappings around
+	calculators={}
+	for lig, dockedlig in todo:
+		if lig not in calculators:
+			calculators[lig]=RMSDCalculator(lig)
 
-	if args.getscores:
-		if dockedlig.endswith('.gz'):
-			cnnscores=re.findall("-?\d+\.\d+",(zgrep['-A1','CNNscore',dockedlig])())
-			cnnaffs=re.findall("-?\d+\.\d+",(zgrep['-A1','CNNaffinity',dockedlig])())
-			vinascores=re.findall("-?\d+\.\d+",(zgrep['-A1','minimizedAffinity',dockedlig])())
-		else:
-			cnnscores=re.findall("-?\d+\.\d+",(grep['-A1','CNNscore',dockedlig])())
-			cnnaffs=re.findall("-?\d+\.\d+",(grep['-A1','CNNaffinity',dockedlig])())
-			vinascores=re.findall("-?\d+\.\d+",(grep['-A1','minimizedAffinity',dockedlig])())
-		items=(obrms[dockedlig,lig])().split('\n')
+		outname=dockedlig.split('.sdf')[0]+'.rmsds'
 		with open(outname,'w') as outfile:
-			for start,cnnscore,cnnaff,vina in zip(items,cnnscores,cnnaffs,vinascores):
-				outfile.write(f'{start} {cnnscore} {cnnaff} {vina}\n')
-	else:
-		(obrms[dockedlig,lig] > outname)()
+			for line in rmsd_lines(calculators[lig],dockedlig,args.getscores,args.index):
+				outfile.write(line+'\n')
+
+if __name__=='__main__':
+	main()
@@ -1,27 +1,57 @@
+import argparse
+import csv
 import numpy as np
-import pandas as pd
-import prody
-from openbabel import openbabel, pybel
-import multiprocessing, subprocess
+import multiprocessing
 import os
-from functools import partial
+from collections import namedtuple
+from functools import lru_cache, partial
 
+# prody, openbabel, scipy and pandas are only imported where they are used so that importing this
+# module (e.g. from a notebook or another script) stays cheap
 
-def calc_pocket_rmsd(rec, lig, root):
+CUTOFFS = range(90, 0, -10)
+POCKET_CUTOFF = 3.5
+PROGRESS_FIELDS = ["rec", "lig", "pocket_change", "backbone_change"]
+
+Receptor = namedtuple("Receptor", ["atoms", "coords", "tree", "resindices", "protein", "ca"])
+
+
+@lru_cache(maxsize=64)
+def load_receptor(path):
     """
-    Calculate difference between the ligand reference receptor and
-    the receptor it is being docked into.
+    Parsed receptor and the arrays the pocket selection needs, with a KD-tree over its atoms.
+    Cached per worker since the same receptor shows up in dozens of pairs
+    """
+    import prody
+    from scipy.spatial import cKDTree
 
-    From original script by David Koes
+    atoms = prody.parsePDB(path)
+    coords = atoms.getCoords()
+    return Receptor(atoms, coords, cKDTree(coords), atoms.getResindices(),
+                    atoms.getFlags("protein"), atoms.getFlags("ca"))
+
+
+def load_ligand_coords(path):
+    from openbabel import pybel
+
+    lig = next(pybel.readfile("sdf", path))
+    return np.array([a.coords for a in lig.atoms])
+
+
+@lru_cache(maxsize=256)
+def match_chains(rec_path, ligrec_path, early_stop=None):
+    """
+    prody.matchChains at every cutoff from 90 down to 10, memoized per (rec, ligrec) pair.
+
+    With early_stop the loop stops at the first cutoff that gives a match with at least
+    early_stop percent sequence identity and overlap.
     """
-    ligrec = lig.replace("LIG_aligned.sdf", "PRO.pdb")
-    rec = prody.parsePDB(os.path.join(root, rec))
-    ligrec = prody.parsePDB(os.path.join(root, ligrec))
-    lig = next(pybel.readfile("sdf", os.path.join(root, lig)))
-    c = np.array([a.coords for a in lig.atoms])
-    nearby = rec.select("protein and same residue as within 3.5 of point", point=c)
+    import prody
+
+    rec = load_receptor(rec_path).atoms
+    ligrec = load_receptor(ligrec_path).atoms
     matches = []
-    for cutoff in range(90, 0, -10):
+    for cutoff in CUTOFFS:
         # can't just set a low cutoff since we'll end up with bad alignments
         # try a whole bunch of alignments to maximize the likelihood we get the right one
         m = prody.matchChains(
@@ -29,64 +59,177 @@ def calc_pocket_rmsd(rec, lig, root):
         )
         if m:
             matches += m
+            if early_stop is not None and any(
+                seqid >= early_stop and overlap >= early_stop
+                for _, _, seqid, overlap in m
+            ):
+                break
+    return matches
+
+
+def pocket_mask(rec, points, cutoff=POCKET_CUTOFF):
+    """
+    Boolean mask of the receptor atoms selected by
+    "protein and same residue as within <cutoff> of point", from one KD-tree query
+    """
+    hits = rec.tree.query_ball_point(points, cutoff)
+    near = np.fromiter((i for h in hits for i in h), dtype=np.int64)
+    return np.isin(rec.resindices, rec.resindices[near]) & rec.protein
+
+
+def pocket_candidates(rec, ligrec, mask, matches):
+    """
+    Sorted receptor and ligand-receptor atom indices (all pocket atoms and their CAs) of every distinct match.
+
+    Indexing a prody AtomGroup with a list sorts and uniquifies it, so both sides are taken through
+    np.unique; matches for which prody.calcRMSD would raise (different atom or CA counts, no CA,
+    dummy atoms) are dropped, as the original try/except did.
+    """
+    seen = set()
+    candidates = []
+    natoms = len(ligrec.coords)
+    for rmap, lrmap, _, _ in matches:
+        ridx = rmap.getIndices()
+        lidx = lrmap.getIndices()
+        keep = (ridx >= 0) & (ridx < len(mask))
+        keep[keep] = mask[ridx[keep]]
+        if not keep.any():
+            continue
+        ratoms = np.unique(ridx[keep])
+        lratoms = np.unique(lidx[keep])
+        key = (ratoms.tobytes(), lratoms.tobytes())
+        if key in seen:
+            continue  # the lower cutoffs mostly repeat the matches of the higher ones
+        seen.add(key)
+        if len(ratoms) != len(lratoms) or lratoms[0] < 0 or lratoms[-1] >= natoms:
+            continue
+        rca = ratoms[rec.ca[ratoms]]
+        lca = lratoms[ligrec.ca[lratoms]]
+        if len(rca) == 0 or len(rca) != len(lca):
+            continue
+        candidates.append((ratoms, lratoms, rca, lca))
+    return candidates
+
+
+def _rmsd(ref, tar):
+    # same arithmetic as prody.calcRMSD, so the csv matches the original script to the last digit
+    return np.sqrt(((ref - tar) ** 2).sum() * (1.0 / ref.shape[0]))
+
+
+def calc_pocket_rmsd(rec, lig, root, early_stop=None):
+    """
+    Calculate difference between the ligand reference receptor and
+    the receptor it is being docked into.
+
+    From original script by David Koes
+    """
+    rec_path = os.path.join(root, rec)
+    ligrec_path = os.path.join(root, lig.replace("LIG_aligned.sdf", "PRO.pdb"))
+    rec = load_receptor(rec_path)
+    ligrec = load_receptor(ligrec_path)
+    mask = pocket_mask(rec, load_ligand_coords(os.path.join(root, lig)))
     minrmsd = np.inf
     minbackrmsd = np.inf
-    for rmap, lrmap, _, _ in matches:
-        try:
-            closeatoms = set(nearby.getIndices())
-            lratoms = []
-            ratoms = []
-            for i, idx in enumerate(rmap.getIndices()):
-                if idx in closeatoms:
-                    lratoms.append(lrmap.getIndices()[i])
-                    ratoms.append(idx)
-            if len(lratoms) == 0:
-                continue
-            rmsd = prody.calcRMSD(rec[ratoms], ligrec[lratoms])
-            backrmsd = prody.calcRMSD(rec[ratoms] & rec.ca, ligrec[lratoms] & ligrec.ca)
-            if rmsd < minrmsd:
-                minrmsd = rmsd
-                minbackrmsd = backrmsd
-        except:
-            pass
+    for ratoms, lratoms, rca, lca in pocket_candidates(rec, ligrec, mask, match_chains(rec_path, ligrec_path, early_stop)):
+        rmsd = _rmsd(rec.coords[ratoms], ligrec.coords[lratoms])
+        if rmsd < minrmsd:
+            minrmsd = rmsd
+            minbackrmsd = _rmsd(rec.coords[rca], ligrec.coords[lca])
     return minrmsd, minbackrmsd
 
 
-def process_line(line, root):
-    rec, lig, _, _ = line.replace("/scr/paul/", "").split()
+def parse_line(line, strip="/scr/paul/"):
+    rec, lig, _, _ = line.replace(strip, "").split()
+    return rec, lig
+
+
+def process_pair(pair, root, early_stop=None):
+    rec, lig = pair
     try:
-        return (rec, lig, *calc_pocket_rmsd(rec, lig, root))
+        return (rec, lig, *calc_pocket_rmsd(rec, lig, root, early_stop))
     except:
         return (rec, lig, np.inf, np.inf)
 
 
-if __name__ == "__main__":
-    root = "/net/pulsar/home/koes/paf46/Research/gnina1.0"
-    ifile = os.path.join(root, "ds_cd_input_pairs.txt")
+def process_chunk(chunk, root, early_stop=None):
+    return [process_pair(pair, root, early_stop) for pair in chunk]
 
-    rec, lig, _, _ = open(ifile).readline().replace("/scr/paul/", "").split()
-    print(rec, lig)
-    print(calc_pocket_rmsd(rec, lig, root))
 
-    pool = multiprocessing.Pool(6)
+def load_progress(progress):
+    """
+    Pocket RMSDs already computed by an earlier (possibly killed) run, keyed by (rec, lig)
+    """
+    done = {}
+    if os.path.isfile(progress):
+        with open(progress) as infile:
+            for row in csv.DictReader(infile):
+                try:
+                    done[row["rec"], row["lig"]] = (float(row["pocket_change"]), float(row["backbone_change"]))
+                except (TypeError, ValueError):
+                    continue  # a torn last line
+    return done
+
+
+def make_chunks(pairs, chunksize):
+    """
+    Chunks of pairs sorted by receptor, so each worker reuses the structures it has parsed
+    """
+    pairs = sorted(pairs)
+    return [pairs[i:i + chunksize] for i in range(0, len(pairs), chunksize)]
 
-    pocket_rmsds = pool.map(partial(process_line, root=root), list(open(ifile)))
 
-    rmsds = np.array([r for (_, _, r, br) in pocket_rmsds])
-    validrmsds = rmsds[~np.isinf(rmsds)]
+def main():
+    parser = argparse.ArgumentParser(description="Calculate the pocket RMSD between each receptor and the receptor of the ligand docked into it")
+    parser.add_argument("-i", "--input", default="ds_cd_input_pairs.txt", help="Pairs file (receptor, ligand, ...) as used by make_gnina_cmds.py (default: %(default)s)")
+    parser.add_argument("-r", "--root", default=".", help="Directory the receptor and ligand paths are relative to (default: %(default)s)")
+    parser.add_argument("-o", "--output", default="pocketdiff.csv", help="Output csv (default: %(default)s)")
+    parser.add_argument("--strip", default="/scr/paul/", help="Prefix to remove from the paths in the pairs file (default: %(default)s)")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="Size of the process pool (default: number of cores)")
+    parser.add_argument("--chunksize", type=int, default=16, help="Pairs per task; pairs are sorted by receptor so a chunk mostly reuses one parsed receptor (default: %(default)s)")
+    parser.add_argument("--early_stop", type=float, default=None, help="Stop trying lower matchChains cutoffs once a match has this percent sequence identity and overlap. Default tries every cutoff, as the original script")
+    parser.add_argument("--progress", default=None, help="Csv every result is appended to as it finishes, used to resume a killed run (default: <output>.progress)")
+    args = parser.parse_args()
+
+    import pandas as pd
+
+    pairs = [parse_line(line, args.strip) for line in open(args.input) if line.strip()]
+    progress = args.progress if args.progress else args.output + ".progress"
+    done = load_progress(progress)
+    todo = [pair for pair in set(pairs) if pair not in done]
+    print(f"{len(todo)} of {len(pairs)} pairs to compute")
+
+    if todo:
+        new = not os.path.isfile(progress) or os.path.getsize(progress) == 0
+        with open(progress, "a", newline="") as outfile, multiprocessing.Pool(args.processes) as pool:
+            writer = csv.writer(outfile)
+            if new:
+                writer.writerow(PROGRESS_FIELDS)
+            elif not open(progress).read().endswith("\n"):
+                outfile.write("\n")  # don't glue the first new row onto a torn last line
+            chunks = make_chunks(todo, args.chunksize)
+            work = partial(process_chunk, root=args.root, early_stop=args.early_stop)
+            for n, results in enumerate(pool.imap_unordered(work, chunks)):
+                for rec, lig, rmsd, backrmsd in results:
+                    writer.writerow([rec, lig, repr(float(rmsd)), repr(float(backrmsd))])
+                    done[rec, lig] = (rmsd, backrmsd)
+                outfile.flush()
+                print(f"{n + 1}/{len(chunks)} chunks done")
 
     targetdiff = pd.DataFrame(
         [
             (
                 r.replace("_PRO.pdb", "")[-4:],
                 l.replace("_LIG_aligned.sdf", "")[-4:],
-                rmsd,
-                br,
+                *done[r, l],
             )
-            for r, l, rmsd, br in pocket_rmsds
+            for r, l in pairs
         ],
         columns=("rec", "lig", "pocket_change", "backbone_change"),
     )
 
     print(targetdiff)
-    targetdiff.to_csv("pocketdiff.csv")
+    targetdiff.to_csv(args.output)
+
+
+if __name__ == "__main__":
+    main()
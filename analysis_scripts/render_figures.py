@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+'''
+Renders every figure of a report from one spec file, instead of one generate_RMSD_graphs.py run
+(and one TopN computation of the master tables) per figure.
+
+The spec is a JSON file:
+
+        {"cache": "figure_cache",
+         "defaults": {"num_unique": 4260, "use_pose": [1, 3]},
+         "figures": [
+                {"figname": "figures/rd_ensembles", "line_graph": true, "bar_graph": true,
+                 "compare_paths": ["redock_master.csv"], "compare_names": ["Default", "Dense"]},
+                {"figname": "figures/rd_cost", "cost_graph": true, "compare_paths": ["redock_master.csv"],
+                 "compare_names": ["Default", "Dense"], "cost_paths": ["redock_master.csv.costs.csv"]},
+                {"figname": "figures/rd_rescore", "line_graph": true,
+                 "summary_paths": ["../data/redocking/rescore_ensembles.csv"]}]}
+
+Every figure takes the options of generate_RMSD_graphs.py under their dest names (line_graph,
+bar_graph, cost_graph, compare_paths, use_bound, exclude, ...), over the spec's defaults, over the
+script's defaults. summary_paths adds the columns of TopN summary csvs (index N, one column of
+percentages per run, as in data/ and MakeFinalGraphs.ipynb) as good2 curves, named by the rest of
+compare_names or by their headers. Relative paths are taken from the directory of the spec.
+
+The TopN of every master table is computed once, however many figures use it, and kept in the
+cache directory keyed by the sha1 of the table (and of its exclusion lists) and the options that
+change it. A figure is rendered again only if its outputs or TopN tables are missing or the digest of
+its options, inputs and the plotting code changed. TopN tables and figures are computed in -j worker processes
+with the Agg backend.
+
+Usage:
+        python render_figures.py report.json -j 8
+'''
+
+import argparse, contextlib, hashlib, io, json, os, sys
+from concurrent.futures import ProcessPoolExecutor
+
+VERSION = 1
+BLOCK = 1 << 20
+PATH_KEYS = ('compare_paths', 'cost_paths', 'summary_paths')
+# options that change the TopN table of a master table
+TOPN_KEYS = ('col_names', 'header', 'delimiter', 'usecols', 'key', 'bootstrap', 'strata', 'ci')
+GRAPHS = (('line_graph', '_line'), ('bar_graph', '_bar'), ('cost_graph', '_cost'))
+
+
+def _state(path):
+    # (relative name, size, mtime) of every file of a table, which may be a parquet/feather directory
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return [['', st.st_size, st.st_mtime_ns]]
+    state = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            st = os.stat(full)
+            state.append([os.path.relpath(full, path), st.st_size, st.st_mtime_ns])
+    return state
+
+
+class FileHashes:
+    '''
+    sha1 of the contents of files and directories, remembered in <cache>/hashes.json until their
+    size or mtime changes, so unchanged master tables are not read again.
+    '''
+
+    def __init__(self, cache):
+        self.path = os.path.join(cache, 'hashes.json')
+        try:
+            with open(self.path) as infile:
+                self.known = json.load(infile)
+        except (OSError, ValueError):
+            self.known = {}
+
+    def digest(self, path):
+        path = os.path.abspath(path)
+        state = _state(path)
+        known = self.known.get(path)
+        if known is not None and known[0] == state:
+            return known[1]
+        sha = hashlib.sha1()
+        for name, _, _ in state:
+            sha.update(name.encode()+b'\0')
+            with open(os.path.join(path, name) if name else path, 'rb') as infile:
+                for block in iter(lambda: infile.read(BLOCK), b''):
+                    sha.update(block)
+        self.known[path] = [state, sha.hexdigest()]
+        return self.known[path][1]
+
+    def save(self):
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as outfile:
+            json.dump(self.known, outfile)
+        os.replace(tmp, self.path)
+
+
+def _sha1(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+def load_spec(path):
+    '''
+    One generate_RMSD_graphs.py argument Namespace per figure of a spec, and the cache directory.
+    '''
+
+    from generate_RMSD_graphs import checkArgs, makeParser
+
+    with open(path) as infile:
+        spec = json.load(infile)
+    base = os.path.dirname(os.path.abspath(path))
+    parser = makeParser()
+    defaults = vars(parser.parse_args(['-C', '', '-N', '']))
+    defaults.update(compare_paths=[], compare_names=[], summary_paths=[])
+    configs = []
+    for fig in spec['figures']:
+        options = dict(spec.get('defaults', {}), **fig)
+        unknown = set(options)-set(defaults)
+        if unknown:
+            raise SystemExit(f'unknown options {", ".join(sorted(unknown))} in figure {fig.get("figname")}')
+        if 'figname' not in fig:
+            raise SystemExit('every figure needs a figname')
+        config = argparse.Namespace(**dict(defaults, **options))
+        for key in PATH_KEYS:
+            setattr(config, key, [os.path.join(base, p) for p in getattr(config, key)])
+        config.figname = os.path.join(base, config.figname)
+        checkArgs(config)
+        configs.append(config)
+    return configs, os.path.join(base, spec.get('cache', os.path.basename(path)+'.cache'))
+
+
+def code_digest(hashes, *names):
+    here = os.path.dirname(os.path.abspath(__file__))
+    return [hashes.digest(os.path.join(here, name)) for name in names]
+
+
+def topn_key(hashes, config, path):
+    '''
+    Cache key of the TopN table of one master table under the options of a figure.
+    '''
+
+    from exclusions import list_files
+
+    excl = sorted(hashes.digest(f) for f in list_files(config.exclude)) if config.exclude else []
+    code = code_digest(hashes, 'topn.py', 'exclusions.py')
+    return _sha1([VERSION, code, hashes.digest(path), excl]+[getattr(config, k) for k in TOPN_KEYS])
+
+
+def topn_file(cache, key):
+    return os.path.join(cache, f'topn-{key}.csv')
+
+
+def write_topn(config, path, outname):
+    '''
+    Compute the TopN of a master table and write it to the cache, one row per tag and N.
+    '''
+
+    import pandas as pd
+    from generate_RMSD_graphs import getTopNResult
+    from topn import topn_frames
+
+    result = getTopNResult(path, config.col_names, config.header, config.delimiter, config.usecols, config.key,
+                           config.bootstrap, config.strata, config.ci, config.chunksize, config.exclude)
+    frames = []
+    for frame, nsys in zip(topn_frames(result), result.nsystems):
+        tag = frame.attrs['tag']
+        frame = frame.rename_axis('N').reset_index()
+        frame.insert(0, 'systems', int(nsys))
+        frame.insert(0, 'tag', tag)
+        frames.append(frame)
+    pd.concat(frames, ignore_index=True).to_csv(outname+'.tmp', index=False)
+    os.replace(outname+'.tmp', outname)
+    return path
+
+
+def read_topn(filename):
+    '''
+    (dataframes, number of systems of each) of a cached TopN table, as getPlottingDataFrame makes them.
+    '''
+
+    import pandas as pd
+
+    table = pd.read_csv(filename, dtype={'tag': str})
+    frames = []
+    nsystems = []
+    for tag, frame in table.groupby('tag', sort=False):
+        nsystems.append(int(frame['systems'].iat[0]))
+        frame = frame.drop(columns=['tag', 'systems']).set_index('N')
+        frame.index.name = None
+        frame.attrs['tag'] = tag
+        frames.append(frame)
+    return frames, nsystems
+
+
+def read_summary(path):
+    # one good2 dataframe per column of a TopN summary csv, over the Ns the column has values for
+    import pandas as pd
+
+    table = pd.read_csv(path, index_col=0)
+    frames = []
+    for col in table.columns:
+        frame = table[[col]].dropna().set_axis(['good2'], axis=1)
+        frame.attrs['tag'] = col
+        frames.append(frame)
+    return frames
+
+
+def render(config, cached):
+    '''
+    Make the graphs of one figure from the cached TopN tables of its compare_paths.
+
+    Returns what the plotting code printed (which tag got which name, costs), for the main
+    process to print with the figure instead of workers writing over each other.
+    '''
+
+    from generate_RMSD_graphs import collectPlottingData, makeGraphs
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        dfs, ranges, costs = collectPlottingData(config, lambda i, path: read_topn(cached[i]))
+        labels = config.compare_names[:len(dfs)]
+        names = config.compare_names[len(dfs):]
+        for path in config.summary_paths:
+            for frame in read_summary(path):
+                labels.append(names.pop(0) if names else frame.attrs['tag'])
+                print(f"{labels[-1]}: {path}")
+                dfs.append(frame)
+                ranges.append(list(frame.index))
+                costs.append(None)
+        config.compare_names = labels
+        makeGraphs(config, dfs, ranges, costs)
+    return log.getvalue()
+
+
+def outputs(config):
+    return [config.figname+suffix+'.png' for flag, suffix in GRAPHS if getattr(config, flag)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render all figures of a spec file, computing the TopN of each master table once and only re-rendering figures whose inputs changed.')
+    parser.add_argument('spec', help='JSON figure spec.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='Flag to render every figure, changed or not.')
+    parser.add_argument('--only', nargs='+', default=None, help='Render only the figures with these fignames (as in the spec).')
+    args = parser.parse_args(argv)
+
+    configs, cache = load_spec(args.spec)
+    if args.only:
+        wanted = {os.path.join(os.path.dirname(os.path.abspath(args.spec)), name) for name in args.only}
+        configs = [config for config in configs if config.figname in wanted]
+    os.makedirs(cache, exist_ok=True)
+    hashes = FileHashes(cache)
+    code = code_digest(hashes, 'generate_RMSD_graphs.py', 'render_figures.py')
+
+    # what every figure needs, and whether its outputs are up to date
+    stamps_file = os.path.join(cache, 'figures.json')
+    try:
+        with open(stamps_file) as infile:
+            stamps = json.load(infile)
+    except (OSError, ValueError):
+        stamps = {}
+    todo = []
+    needed = {}
+    for config in configs:
+        cached = [topn_file(cache, topn_key(hashes, config, path)) for path in config.compare_paths]
+        inputs = [hashes.digest(p) for p in config.cost_paths+config.summary_paths]
+        digest = _sha1([VERSION, code, sorted((k, v) for k, v in vars(config).items() if k != 'chunksize'), cached, inputs])
+        # a deleted TopN table is computed again and its figures rendered from it
+        if (args.force or stamps.get(config.figname) != digest or not all(os.path.exists(out) for out in outputs(config))
+                or not all(os.path.exists(name) for name in cached)):
+            todo.append((config, cached, digest))
+            for path, name in zip(config.compare_paths, cached):
+                if not os.path.exists(name):
+                    needed.setdefault(name, (config, path))
+    hashes.save()
+    print(f'{len(todo)} of {len(configs)} figures to render, {len(needed)} TopN tables to compute')
+
+    failed = []
+    with ProcessPoolExecutor(max(args.jobs, 1)) as pool:
+        futures = {name: pool.submit(write_topn, config, path, name) for name, (config, path) in needed.items()}
+        for name, future in futures.items():
+            try:
+                print(f'TopN of {future.result()}')
+            except Exception as e:
+                print(f'TopN of {needed[name][1]} failed: {e!r}', file=sys.stderr)
+        renders = [(config, digest, pool.submit(render, config, cached)) for config, cached, digest in todo
+                   if all(os.path.exists(name) for name in cached)]
+        failed += [config.figname for config, cached, digest in todo if not all(os.path.exists(name) for name in cached)]
+        for config, digest, future in renders:
+            try:
+                log = future.result()
+                stamps[config.figname] = digest
+                print(f'rendered {" ".join(outputs(config))}')
+                print(log, end='')
+            except Exception as e:
+                failed.append(config.figname)
+                print(f'{config.figname} failed: {e!r}', file=sys.stderr)
+
+    tmp = stamps_file+'.tmp'
+    with open(tmp, 'w') as outfile:
+        json.dump(stamps, outfile, indent=1)
+    os.replace(tmp, stamps_file)
+    if failed:
+        raise SystemExit(f'{len(failed)} figures failed: {" ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
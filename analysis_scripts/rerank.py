@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+'''
+Re-ranking and score threshold analysis of a coalesced table (coalescer.py --getscores).
+
+The thresh_cnnscore_*/thresh_cnnaffinity_* tables were made by filtering the table and recomputing
+TopN once per cutoff. Here the poses of every system are sorted once per ranking (the order in the
+file, a score column or a weighted sum of score columns) and TopN is computed for every cutoff at
+once: each good pose gives the range of cutoffs over which it is the system's first good pose in
+the top N, and a cumulative sum over the sorted cutoffs counts the successes of all of them.
+
+Two filters, as in the notebooks:
+        system -- keep the systems whose top ranked pose scores >= the cutoff (MakeRedockCSVs),
+                  left is the percentage of systems kept
+        pose   -- drop the poses scoring <= the cutoff and rank the rest (MakeCrossDockCSVs),
+                  left is the percentage of poses kept
+With --per_pocket TopN is averaged over the pockets that still have systems, as topN(perpocket=True).
+
+Input:
+        input          -- coalesced csv (or parquet/feather directory) with score columns
+        rank           -- rankings: file, a column, or column:weight,column:weight (minimizedAffinity
+                          counts lower as better)
+        filter         -- score column the cutoffs apply to
+        thresholds     -- start stop num of the cutoffs, as np.linspace
+
+Output:
+        csv with one row per tag, ranking, cutoff and N: the TopN percentage and the percentage left
+'''
+
+import argparse, time
+from collections import namedtuple
+import numpy as np
+
+#sign that makes a higher value better
+SCORE_SIGNS = {'minimizedAffinity': -1}
+
+RerankResult = namedtuple('RerankResult', ['rankings', 'thresholds', 'good', 'left', 'systems_left'])
+
+
+def parse_ranking(text):
+    '''
+    {column: weight} of a ranking: 'file' (empty, the order in the table), a column, or 'col:w,col:w'.
+    '''
+
+    if text == 'file':
+        return {}
+    weights = {}
+    for item in text.split(','):
+        col, _, weight = item.partition(':')
+        weights[col] = float(weight) if weight else 1.0
+    return weights
+
+
+def ranking_key(df, weights):
+    '''
+    Score of every pose under a ranking, higher is better. None for the order in the table.
+    '''
+
+    if not weights:
+        return None
+    key = np.zeros(len(df))
+    for col, weight in weights.items():
+        key += weight*SCORE_SIGNS.get(col, 1)*df[col].to_numpy(dtype=float)
+    return key
+
+
+def _interval_counts(groups, start, stop, ngroups, ncut):
+    # (groups x cutoffs) count of the [start, stop) cutoff index ranges of every item
+    keep = start < stop
+    diff = np.zeros((ngroups, ncut+1))
+    np.add.at(diff, (groups[keep], start[keep]), 1)
+    np.add.at(diff, (groups[keep], stop[keep]), -1)
+    return diff.cumsum(axis=1)[:, :ncut]
+
+
+def _ranked_matrices(sys_codes, nsys, key, filt, good):
+    '''
+    (systems x poses) filter scores (-inf padded) and good flags with the poses of every system in ranked order.
+    '''
+
+    idx = np.arange(len(sys_codes))
+    order = np.lexsort((idx, sys_codes)) if key is None else np.lexsort((idx, -key, sys_codes))
+    sys_sorted = sys_codes[order]
+    starts = np.flatnonzero(np.r_[True, sys_sorted[1:] != sys_sorted[:-1]])
+    rank = idx-np.repeat(starts, np.diff(np.r_[starts, len(idx)]))
+    width = int(rank.max())+1 if len(rank) else 0
+    scores = np.full((nsys, width), -np.inf)
+    scores[sys_sorted, rank] = np.where(np.isnan(filt[order]), -np.inf, filt[order])
+    goods = np.zeros((nsys, width), dtype=bool)
+    goods[sys_sorted, rank] = good[order]
+    return scores, goods
+
+
+def threshold_topn(df, rankings=('file',), filter_key='cnnscore', thresholds=np.linspace(0, 0.99, 100), max_n=1,
+                   mode='pose', system_key=('pocket', 'rec', 'lig'), pocket_key=None, rmsd_cut=2, rmsd_key='rmsd'):
+    '''
+    TopN (<rmsd_cut) of every ranking at every cutoff of filter_key, for one tag.
+
+    pocket_key averages TopN over pockets instead of systems. Returns a RerankResult with the
+    sorted cutoffs, good of shape (rankings x cutoffs x max_n), left and systems_left of shape
+    (rankings x cutoffs).
+    '''
+
+    import pandas as pd
+
+    sys_keys = [system_key] if isinstance(system_key, str) else list(system_key)
+    sys_codes = df.groupby(sys_keys, sort=False, observed=True).ngroup().to_numpy()
+    nsys = int(sys_codes.max())+1 if len(sys_codes) else 0
+    pockets = np.zeros(nsys, dtype=np.int64)
+    if pocket_key is not None:
+        pockets[sys_codes] = pd.factorize(df[pocket_key])[0]
+    npockets = int(pockets.max())+1 if nsys else 0
+    cuts = np.sort(np.asarray(thresholds, dtype=float))
+    ncut = len(cuts)
+    filt = df[filter_key].to_numpy(dtype=float)
+    good = df[rmsd_key].to_numpy(dtype=float) < rmsd_cut
+    # poses kept by the pose filter, the same for every ranking
+    sorted_filt = np.sort(np.where(np.isnan(filt), -np.inf, filt))
+    poses_left = (len(filt)-np.searchsorted(sorted_filt, cuts, 'right'))/len(filt)*100 if len(filt) else np.zeros(ncut)
+
+    names = list(rankings)
+    out_good = np.full((len(names), ncut, max_n), np.nan)
+    out_left = np.zeros((len(names), ncut))
+    out_sys = np.zeros((len(names), ncut))
+    for r, name in enumerate(names):
+        scores, goods = _ranked_matrices(sys_codes, nsys, ranking_key(df, parse_ranking(name)), filt, good)
+        width = scores.shape[1]
+        successes = np.zeros((max_n, npockets, ncut))
+        if mode == 'system':
+            top = scores[:, 0]
+            first = np.where(goods.any(axis=1), goods.argmax(axis=1), width)
+            stop = np.searchsorted(cuts, top, 'right')  # cutoffs <= the top pose's score keep the system
+            zero = np.zeros(nsys, dtype=np.int64)
+            kept = _interval_counts(pockets, zero, stop, npockets, ncut)
+            for n in range(max_n):
+                succ = first <= n
+                successes[n] = _interval_counts(pockets[succ], zero[succ], stop[succ], npockets, ncut)
+            out_left[r] = kept.sum(axis=0)/nsys*100 if nsys else 0
+        else:
+            # nth largest filter score among the poses ranked before each pose (-inf if fewer than n)
+            prior = np.full((nsys, width, max_n), -np.inf)
+            best = np.full((nsys, max_n), -np.inf)
+            for j in range(width):
+                prior[:, j] = best[:, ::-1]
+                best = np.sort(np.concatenate([best, scores[:, j:j+1]], axis=1), axis=1)[:, 1:]
+            # highest filter score of the good poses ranked before each pose
+            good_scores = np.where(goods, scores, -np.inf)
+            prev_good = np.concatenate([np.full((nsys, 1), -np.inf), np.maximum.accumulate(good_scores, axis=1)[:, :-1]], axis=1)
+            stop = np.searchsorted(cuts, scores, 'left')  # a pose is kept for cutoffs below its score
+            rows = np.broadcast_to(pockets[:, None], scores.shape)
+            for n in range(max_n):
+                # the pose is the first good one left and within the top n+1 for cutoffs in [lo, score)
+                lo = np.maximum(prior[:, :, n], prev_good)
+                start = np.searchsorted(cuts, lo, 'left')
+                successes[n] = _interval_counts(rows[goods], start[goods], stop[goods], npockets, ncut)
+            kept = _interval_counts(pockets, np.zeros(nsys, dtype=np.int64), np.searchsorted(cuts, scores.max(axis=1, initial=-np.inf), 'left'), npockets, ncut)
+            out_left[r] = poses_left
+        out_sys[r] = kept.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if pocket_key is None:
+                out_good[r] = (successes.sum(axis=1)/kept.sum(axis=0)).T*100
+            else:
+                per = successes/kept
+                per[:, kept == 0] = np.nan
+                out_good[r] = np.nanmean(per, axis=1).T*100
+    return RerankResult(names, cuts, out_good, out_left, out_sys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TopN of every re-ranking of the poses at every score cutoff, in one pass.')
+    parser.add_argument('-i', '--input', required=True, help='Coalesced table from coalescer.py --getscores (csv or parquet/feather directory).')
+    parser.add_argument('-o', '--output', required=True, help='Output csv.')
+    parser.add_argument('--rank', nargs='+', default=['file'], help='Rankings: file, a score column or col:weight,col:weight (default: %(default)s)')
+    parser.add_argument('--mix', nargs=2, default=None, metavar=('COL1', 'COL2'), help='Also rank by COL1 + w*COL2 for every --mix_weights w.')
+    parser.add_argument('--mix_weights', nargs='+', type=float, default=list(np.linspace(0, 1, 11)), help='Weights of COL2 for --mix (default: 0 to 1 in steps of 0.1)')
+    parser.add_argument('--filter', default='cnnscore', help='Score column the cutoffs apply to (default: %(default)s)')
+    parser.add_argument('--thresholds', nargs=3, type=float, default=[0, 0.99, 100], metavar=('START', 'STOP', 'NUM'), help='Cutoffs as np.linspace (default: %(default)s)')
+    parser.add_argument('--mode', default='pose', choices=['pose', 'system'], help='Filter poses, or systems by their top pose (default: %(default)s)')
+    parser.add_argument('--max_n', type=int, default=1, help='Largest N of the TopN (default: %(default)s)')
+    parser.add_argument('--rmsd', type=float, default=2, help='RMSD of a good pose (default: %(default)s)')
+    parser.add_argument('--system', nargs='+', default=['pocket', 'rec', 'lig'], help='Columns identifying a system (default: %(default)s)')
+    parser.add_argument('--per_pocket', action='store_true', help='Flag to average TopN over pockets, as topN(perpocket=True).')
+    parser.add_argument('--tags', nargs='+', default=None, help='Tags to analyse (default: all)')
+    parser.add_argument('--exclude', nargs='+', default=[], help='Exclusion lists (exclusions.py names or files of PDB ids) whose systems are left out.')
+    args = parser.parse_args()
+
+    from coalescer import read_master
+    from exclusions import apply_exclusions
+    import pandas as pd
+
+    df = apply_exclusions(read_master(args.input), args.exclude)
+    rankings = list(args.rank)
+    if args.mix:
+        rankings += [f'{args.mix[0]}:1,{args.mix[1]}:{w:g}' for w in args.mix_weights]
+    tags = args.tags if args.tags else sorted(df['tag'].astype(str).unique())
+    cuts = np.linspace(args.thresholds[0], args.thresholds[1], int(args.thresholds[2]))
+
+    start = time.time()
+    frames = []
+    for tag in tags:
+        sub = df[df['tag'].astype(str) == str(tag)]
+        res = threshold_topn(sub, rankings, args.filter, cuts, args.max_n, args.mode, args.system,
+                             'pocket' if args.per_pocket else None, args.rmsd)
+        r, c, n = np.meshgrid(np.arange(len(rankings)), np.arange(len(cuts)), np.arange(args.max_n), indexing='ij')
+        frames.append(pd.DataFrame({'tag': tag, 'ranking': np.asarray(rankings)[r.ravel()], 'threshold': res.thresholds[c.ravel()],
+                                    'N': n.ravel()+1, 'good': res.good.ravel(), 'left': res.left[r.ravel(), c.ravel()],
+                                    'systems_left': res.systems_left[r.ravel(), c.ravel()].astype(np.int64)}))
+    pd.concat(frames, ignore_index=True).to_csv(args.output, index=False)
+    print(f'{len(tags)} tags x {len(rankings)} rankings x {len(cuts)} cutoffs in {time.time()-start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
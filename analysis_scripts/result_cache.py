@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+'''
+Content-addressed cache of gnina outputs.
+
+Output names like <prefix>default_ensemble_rescore_exhaustiveness8.sdf.gz only encode part of a run,
+so a changed receptor goes unnoticed and a renamed prefix is docked again. Here every command is keyed
+by the sha256 of
+        the canonical command (gnina_jobs.canonical_command: sorted options, sorted --cnn ensemble,
+        seed, defaults dropped) with every input file replaced by the sha256 of its contents,
+        the gnina version,
+        and, for an output split from a batched run (batch_gnina.py), the commands of its batch.
+Each output is stored once as <cache>/objects/<key[:2]>/<key>.sdf.gz and the legacy output names are
+symlinks to it. A cache hit touches the object, and evict() removes the least recently used objects
+until the cache fits in its size limit (a legacy name left dangling just runs again).
+
+make_gnina_cmds.py --cache and run_gnina_cmds.py --cache use this module; run on its own it reports
+or trims a cache.
+'''
+
+import argparse, hashlib, json, os, shutil, subprocess
+from functools import lru_cache
+from gnina_jobs import FILE_OPTIONS, canonical_command, parse_options
+
+SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_size(text):
+    '''
+    Bytes in a size like 500M or 2G (None stays None).
+    '''
+
+    if text is None:
+        return None
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ''
+    return int(float(text[:len(text)-len(unit)])*SIZE_UNITS[unit])
+
+
+@lru_cache(maxsize=None)
+def gnina_version(exe='gnina'):
+    '''
+    First line of `gnina --version`.
+
+    Raises RuntimeError if exe can not be run here: keying on a placeholder would keep outputs
+    docked where gnina runs from ever matching, and would let different builds share keys. Pass
+    the version explicitly (--gnina_version) where gnina is not installed.
+    '''
+
+    try:
+        proc = subprocess.run([exe, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=60)
+    except (OSError, subprocess.SubprocessError) as e:
+        raise RuntimeError(f'can not get the version of {exe} ({e}), give it with --gnina_version') from e
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        raise RuntimeError(f'{exe} --version exited with {proc.returncode}, give the version with --gnina_version')
+    return lines[0].strip()
+
+
+_digests = {}
+
+
+def file_digest(path):
+    '''
+    sha256 of a file's contents, remembered per (path, size, mtime) since receptors are shared by many commands.
+    '''
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 'missing:'+os.path.normpath(path)
+    stamp = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if stamp not in _digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                h.update(block)
+        _digests[stamp] = 'sha256:'+h.hexdigest()
+    return _digests[stamp]
+
+
+def job_key(tokens, version, batch=None):
+    '''
+    Cache key of a tokenized gnina command run with the given gnina version, as part of batch
+    (gnina_jobs.batch_membership) if it was docked in a batch.
+    '''
+
+    text = canonical_command(tokens, file_key=file_digest)+'\nversion '+version
+    if batch is not None:
+        text += '\nbatch '+json.dumps(batch, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def newer_than_inputs(tokens, out):
+    '''
+    True if out was written after every input file of the command changed last (make's rule), for
+    adopting outputs docked before the cache existed.
+    '''
+
+    mtime = os.path.getmtime(out)
+    for flag, values in parse_options(tokens).items():
+        if flag in FILE_OPTIONS:
+            for path in values:
+                if not os.path.exists(path) or os.path.getmtime(path) > mtime:
+                    return False
+    return True
+
+
+def _suffix(out):
+    name = os.path.basename(out)
+    return name[name.index('.sdf'):] if '.sdf' in name else ''
+
+
+class ResultCache:
+    '''
+    Objects under <root>/objects, least recently used evicted past max_bytes (no limit if None).
+    '''
+
+    def __init__(self, root, max_bytes=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+
+    def object_path(self, key, suffix='.sdf.gz'):
+        return os.path.join(self.root, 'objects', key[:2], key+suffix)
+
+    def lookup(self, key, out):
+        '''
+        Cached object of key (marking it used), None on a miss.
+        '''
+
+        path = self.object_path(key, _suffix(out))
+        if not os.path.isfile(path):
+            return None
+        os.utime(path)
+        return path
+
+    def link(self, path, out):
+        '''
+        Make the legacy output name a symlink to a cached object.
+        '''
+
+        if os.path.islink(out) and os.readlink(out) == path:
+            return
+        if os.path.lexists(out):
+            os.remove(out)
+        os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+        os.symlink(path, out)
+
+    def store(self, key, out):
+        '''
+        Move a finished output into the cache and leave a symlink in its place. Returns the object path.
+        '''
+
+        path = self.object_path(key, _suffix(out))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path+f'.{os.getpid()}.tmp'
+        shutil.move(out, tmp)
+        os.replace(tmp, path)
+        self.link(path, out)
+        return path
+
+    def objects(self):
+        '''
+        (last use, size, path) of every cached object.
+        '''
+
+        found = []
+        for dirpath, _, names in os.walk(os.path.join(self.root, 'objects')):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                found.append((st.st_mtime, st.st_size, path))
+        return found
+
+    def evict(self, max_bytes=None):
+        '''
+        Remove least recently used objects until the cache fits in max_bytes. Returns (removed, bytes freed).
+        '''
+
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        if limit is None:
+            return 0, 0
+        found = sorted(self.objects())
+        total = sum(size for _, size, _ in found)
+        removed = freed = 0
+        for _, size, path in found:
+            if total <= limit:
+                break
+            os.remove(path)
+            total -= size
+            freed += size
+            removed += 1
+        return removed, freed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report on or trim a gnina result cache.')
+    parser.add_argument('cache', help='Cache directory.')
+    parser.add_argument('--max_size', default=None, help='Evict least recently used outputs until the cache is at most this big (e.g. 200G).')
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cache)
+    found = cache.objects()
+    print(f'{len(found)} outputs, {sum(size for _, size, _ in found)/2**30:.2f} GiB')
+    if args.max_size:
+        removed, freed = cache.evict(parse_size(args.max_size))
+        print(f'evicted {removed} outputs, {freed/2**30:.2f} GiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+'''
+In-process replacement for the obrms calls made by obrms_calc.py.
+
+The reference ligand is parsed once and the symmetry-corrected heavy atom mappings
+(graph automorphisms, the same thing obrms enumerates) are computed once per ligand. Like
+obrms, which sets every bond to a single ring bond before matching, atoms are matched on element
+and connectivity only, so bond orders, aromaticity and gnina's kekulization play no part.
+Every pose of a docked output file is then scored in one batched numpy operation
+over a (poses x atoms x 3) coordinate array.
+
+Output lines follow obrms: RMSD <pose title>:<reference title> <rmsd>
+
+Usage (drop in for obrms):
+    python rmsd_engine.py <reference ligand> <docked poses>
+'''
+
+import argparse
+import numpy as np
+from sdf_stream import records
+
+
+def heavy_atoms(mol):
+    '''
+    Strip hydrogens from an SDRecord, the same as obrms does before matching.
+
+    Returns (elements, coords, neighbors) for the heavy atom graph.
+    '''
+
+    elements, coords, bonds = mol.elements, mol.coords, mol.bonds
+    keep = [i for i, e in enumerate(elements) if e not in ('H', 'D')]
+    renum = {old: new for new, old in enumerate(keep)}
+    neighbors = [[] for _ in keep]
+    for a, b in bonds:
+        if a in renum and b in renum:
+            neighbors[renum[a]].append(renum[b])
+            neighbors[renum[b]].append(renum[a])
+
+    return [elements[i] for i in keep], coords[keep], neighbors
+
+
+def _refine_colors(elements, neighbors):
+    # Color refinement (1-WL) so that only topologically equivalent atoms are tried against each other
+    sigs = [(e, len(n)) for e, n in zip(elements, neighbors)]
+    lookup = {s: c for c, s in enumerate(sorted(set(sigs)))}
+    colors = [lookup[s] for s in sigs]
+    while True:
+        sigs = [(colors[i], tuple(sorted(colors[j] for j in neighbors[i]))) for i in range(len(colors))]
+        lookup = {s: c for c, s in enumerate(sorted(set(sigs)))}
+        new_colors = [lookup[s] for s in sigs]
+        if len(lookup) == len(set(colors)):
+            return new_colors
+        colors = new_colors
+
+
+def graph_matches(elem_a, nbr_a, elem_b, nbr_b, limit=100000):
+    '''
+    Enumerate the isomorphisms from heavy atom graph a onto graph b.
+
+    Returns an int array of shape (matches, atoms) where row k maps atom i of a onto atom
+    row[i] of b. Passing the same graph twice gives its automorphisms. At most limit
+    mappings are returned, so for ligands with more symmetry than that the RMSD is the minimum
+    over the first limit mappings only.
+    '''
+
+    n = len(elem_a)
+    if n != len(elem_b) or sum(map(len, nbr_a)) != sum(map(len, nbr_b)):
+        return np.empty((0, n), dtype=int)
+    if n == 0:
+        return np.empty((1, 0), dtype=int)
+
+    # refine the disjoint union so that colors are comparable between the two graphs
+    colors = _refine_colors(elem_a+elem_b, nbr_a+[[j+n for j in nb] for nb in nbr_b])
+    col_a, col_b = colors[:n], colors[n:]
+    if sorted(col_a) != sorted(col_b):
+        return np.empty((0, n), dtype=int)
+    by_color = {}
+    for b, c in enumerate(col_b):
+        by_color.setdefault(c, []).append(b)
+    nbrset_b = [set(nb) for nb in nbr_b]
+
+    # visit atoms of a so that every atom after the first of its fragment has a mapped neighbor
+    order = []
+    seen = [False]*n
+    for start in sorted(range(n), key=lambda i: len(by_color[col_a[i]])):
+        if seen[start]:
+            continue
+        seen[start] = True
+        queue = [start]
+        while queue:
+            a = queue.pop(0)
+            order.append(a)
+            for x in nbr_a[a]:
+                if not seen[x]:
+                    seen[x] = True
+                    queue.append(x)
+
+    mapping = [-1]*n
+    used = [False]*n
+    results = []
+
+    def extend(depth):
+        if depth == n:
+            results.append(list(mapping))
+            return len(results) >= limit
+        a = order[depth]
+        mapped = [mapping[x] for x in nbr_a[a] if mapping[x] >= 0]
+        if mapped:
+            cands = [b for b in nbr_b[mapped[0]] if col_b[b] == col_a[a]]
+        else:
+            cands = by_color[col_a[a]]
+        for b in cands:
+            if used[b] or not all(m in nbrset_b[b] for m in mapped):
+                continue
+            mapping[a] = b
+            used[b] = True
+            done = extend(depth+1)
+            mapping[a] = -1
+            used[b] = False
+            if done:
+                return True
+        return False
+
+    extend(0)
+    return np.array(results, dtype=int).reshape(len(results), n)
+
+
+def batch_rmsd(ref_coords, pose_coords, maps, chunk=256):
+    '''
+    Minimum RMSD over all mappings for a stack of poses, without alignment (like obrms).
+
+    ref_coords is (atoms, 3), pose_coords is (poses, atoms, 3) and maps is (mappings, atoms)
+    with maps[k, i] the pose atom matched to reference atom i.
+    '''
+
+    nposes, natoms = pose_coords.shape[:2]
+    if len(maps) == 0:
+        return np.full(nposes, np.inf)
+    if natoms == 0:
+        return np.zeros(nposes)
+
+    # |x-r|^2 = |x|^2 + |r|^2 - 2x.r and only the cross term depends on the mapping
+    center = ref_coords.mean(axis=0)
+    ref = ref_coords - center
+    poses = pose_coords - center
+    refsq = (ref**2).sum()
+    posesq = (poses**2).sum(axis=(1, 2))
+    dots = np.einsum('pjd,id->pji', poses, ref)  # pose atom j against reference atom i
+
+    cols = np.arange(natoms)
+    best = np.full(nposes, -np.inf)
+    for start in range(0, len(maps), chunk):
+        cross = dots[:, maps[start:start+chunk], cols].sum(axis=2)
+        best = np.maximum(best, cross.max(axis=1))
+
+    msd = (posesq + refsq - 2*best)/natoms
+    return np.sqrt(np.clip(msd, 0, None))
+
+
+class RMSDCalculator:
+    '''
+    Symmetry corrected heavy atom RMSD against one reference ligand.
+
+    The reference graph and its automorphisms are computed once, and the mapping onto each
+    distinct pose topology is cached, so scoring another output file of the same ligand
+    only costs the batched coordinate math.
+    '''
+
+    def __init__(self, ref_path, limit=100000):
+        ref = next(records(ref_path))
+        self.title = ref.title
+        self.elements, self.coords, self.neighbors = heavy_atoms(ref)
+        self.limit = limit
+        self.automorphisms = graph_matches(self.elements, self.neighbors, self.elements, self.neighbors, limit)
+        self._maps = {}
+
+    def mappings(self, elements, neighbors):
+        '''
+        All reference->pose atom mappings for a pose topology.
+        '''
+
+        key = (tuple(elements), tuple(tuple(sorted(nb)) for nb in neighbors))
+        if key not in self._maps:
+            if elements == self.elements and all(sorted(a) == sorted(b) for a, b in zip(neighbors, self.neighbors)):
+                # same atom order as the reference, the automorphisms are the mappings
+                self._maps[key] = self.automorphisms
+            else:
+                iso = graph_matches(self.elements, self.neighbors, elements, neighbors, 1)
+                if len(iso):
+                    self._maps[key] = iso[0][self.automorphisms]
+                else:
+                    self._maps[key] = iso
+        return self._maps[key]
+
+    def rmsds(self, mols):
+        '''
+        RMSD of every SDRecord in mols, grouping poses that share a topology into one batch.
+        '''
+
+        out = np.full(len(mols), np.inf)
+        groups = {}
+        for i, mol in enumerate(mols):
+            elements, coords, neighbors = heavy_atoms(mol)
+            key = (tuple(elements), tuple(tuple(sorted(nb)) for nb in neighbors))
+            if key not in groups:
+                groups[key] = (elements, neighbors, [], [])
+            groups[key][2].append(i)
+            groups[key][3].append(coords)
+        for elements, neighbors, idx, coords in groups.values():
+            maps = self.mappings(elements, neighbors)
+            out[idx] = batch_rmsd(self.coords, np.stack(coords), maps)
+        return out
+
+    def obrms_lines(self, mols):
+        '''
+        obrms formatted output lines for every SDRecord in mols.
+        '''
+
+        return [f'RMSD {mol.title}:{self.title} {rmsd:g}' for mol, rmsd in zip(mols, self.rmsds(mols))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Symmetry corrected heavy atom RMSD of docked poses to a reference ligand (obrms compatible output)')
+    parser.add_argument('reference', help='Reference ligand file (first molecule is used).')
+    parser.add_argument('test', help='sdf or sdf.gz file of poses to score.')
+    args = parser.parse_args()
+
+    for line in RMSDCalculator(args.reference).obrms_lines(list(records(args.test))):
+        print(line)
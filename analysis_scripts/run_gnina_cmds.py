@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+'''
+Parallel, resumable runner for the command file written by make_gnina_cmds.py.
+
+Replaces the bash while-loop in the README. Commands are run on a process pool sized to the
+machine, commands whose output .sdf.gz already exists and is complete are skipped, and every
+finished or failed command is appended to a journal so that a killed sweep picks up where it
+stopped.
+
+gnina writes to a .partial output that is renamed on success, so a killed job never leaves an
+output that looks finished.
+
+With --cache outputs live in a content-addressed cache (result_cache.py): a command whose inputs,
+arguments and gnina version match a cached run is only linked, outputs docked before the cache are
+adopted if they are newer than their inputs, and a changed input file means the command runs again
+even though its output name exists.
+
+Input:
+        input          -- command file from make_gnina_cmds.py
+        jobs           -- number of commands to run at once (defaults to cores / cpu_per_job)
+        cpu_per_job    -- rewrite the --cpu option of every command to this value
+        gnina          -- gnina executable to use instead of the one in the commands (e.g. a stub for testing)
+        journal        -- journal file, defaults to <input>.journal
+        cache          -- result cache directory, with cache_size its size limit
+
+Output:
+        the gnina outputs and a journal with one JSON record per finished or failed command: output,
+        status, exit code, wall time and, from wait4, the user/system CPU seconds and peak RSS of gnina.
+        coalescer.py --journals turns the journals into a cost table that joins to the RMSD table.
+'''
+
+import argparse, gzip, json, multiprocessing, os, subprocess, time, zlib
+from gnina_jobs import read_commands, set_option
+
+
+def partial_name(out):
+    '''
+    Name gnina writes to before the output is known to be complete (keeps the .sdf(.gz) extension).
+    '''
+
+    head, tail = os.path.split(out)
+    if '.sdf' in tail:
+        stem, ext = tail.split('.sdf', 1)
+        return os.path.join(head, f'{stem}.partial.sdf{ext}')
+    return out+'.partial'
+
+
+def output_complete(out):
+    '''
+    True if out exists, decompresses to the end and finishes with a whole sdf record.
+    '''
+
+    if not os.path.isfile(out) or os.path.getsize(out) == 0:
+        return False
+    opener = gzip.open if out.endswith('.gz') else open
+    last = ''
+    try:
+        with opener(out, 'rt') as infile:
+            for line in infile:
+                if line.strip():
+                    last = line
+    except (EOFError, OSError, zlib.error):
+        return False
+    return last.startswith('$$$$')
+
+
+def load_journal(journal):
+    '''
+    Last journal record of every output, keyed by output name.
+    '''
+
+    done = {}
+    if os.path.isfile(journal):
+        with open(journal) as infile:
+            for line in infile:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # a torn last line from a killed run
+                done[rec['out']] = rec
+    return done
+
+
+def run_job(tokens, out):
+    '''
+    Run one gnina command, writing to the partial name and renaming on success.
+
+    Returns the journal record for the command.
+    '''
+
+    tmp = partial_name(out) if out else None
+    cmd = set_option(tokens, '--out', tmp) if out else tokens
+    start = time.time()
+    usage = None
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        err = proc.stderr.read()
+        proc.stderr.close()
+        # reap the child ourselves to get its resource usage
+        _, status, usage = os.wait4(proc.pid, 0)
+        returncode = proc.returncode = os.waitstatus_to_exitcode(status)
+    except OSError as e:
+        returncode, err = -1, str(e)
+    elapsed = time.time()-start
+
+    status = 'failed'
+    if returncode == 0 and (out is None or output_complete(tmp)):
+        if out:
+            os.replace(tmp, out)
+        status = 'done'
+    elif tmp and os.path.exists(tmp):
+        os.remove(tmp)
+
+    rec = {'out': out, 'status': status, 'returncode': returncode, 'elapsed': elapsed, 'cmd': ' '.join(tokens)}
+    if usage is not None:
+        rec.update(user=usage.ru_utime, sys=usage.ru_stime, maxrss_kb=usage.ru_maxrss)
+    if status == 'failed':
+        rec['stderr'] = err[-2000:]
+    return rec
+
+
+def _run(item):
+    return run_job(*item)
+
+
+def select_jobs(jobs, journal_recs, retry_failed=False):
+    '''
+    Commands that still need to run, dropping complete outputs and (unless retrying) journaled failures.
+    '''
+
+    todo = []
+    for job in jobs:
+        rec = journal_recs.get(job.out)
+        if rec is not None and rec['status'] == 'failed' and not retry_failed:
+            continue
+        if job.out and output_complete(job.out):
+            continue
+        todo.append(job)
+    return todo
+
+
+def prepare(jobs, gnina=None, cpu_per_job=None):
+    '''
+    (tokens, out) of every job, with the executable and --cpu swapped if asked.
+    '''
+
+    items = []
+    for job in jobs:
+        tokens = job.tokens
+        if gnina:
+            tokens = [gnina]+tokens[1:]
+        if cpu_per_job:
+            tokens = set_option(tokens, '--cpu', cpu_per_job)
+        items.append((tokens, job.out))
+    return items
+
+
+def run_commands(items, nworkers, journal, verbose=True):
+    '''
+    Run (tokens, out) items on a pool of nworkers, appending every record to the journal.
+
+    Returns the journal records.
+    '''
+
+    recs = []
+    torn = False
+    if os.path.isfile(journal) and os.path.getsize(journal):
+        with open(journal, 'rb') as infile:
+            infile.seek(-1, os.SEEK_END)
+            torn = infile.read(1) != b'\n'
+    with open(journal, 'a') as jfile, multiprocessing.Pool(nworkers) as pool:
+        if torn:
+            jfile.write('\n')  # end the record cut short by a killed run instead of appending to it
+        for i, rec in enumerate(pool.imap_unordered(_run, items)):
+            jfile.write(json.dumps(rec)+'\n')
+            jfile.flush()
+            recs.append(rec)
+            if not verbose:
+                continue
+            if rec['status'] == 'failed':
+                print(f"FAILED ({rec['returncode']}): {rec['cmd']}")
+            print(f"{i+1}/{len(items)} {rec['status']} {rec['elapsed']:.1f}s {rec['out']}")
+    return recs
+
+
+def default_workers(cpu_per_job=None):
+    return max(1, (os.cpu_count() or 1)//(cpu_per_job or 1))
+
+
+def select_cached(jobs, journal_recs, cache, gnina=None, retry_failed=False, version=None):
+    '''
+    Commands that still need to run when using a ResultCache, linking every cache hit to its output name.
+
+    version is the gnina version of the cache keys, by default asked from the gnina each command runs.
+    Returns the commands to run, {output: cache key} of those commands and the number of hits.
+    '''
+
+    from gnina_jobs import batch_membership
+    from result_cache import gnina_version, job_key, newer_than_inputs
+
+    todo = []
+    keys = {}
+    hits = 0
+    for job in jobs:
+        if not job.out:
+            todo.append(job)
+            continue
+        # an output batch_gnina.py split from a batched run is keyed with its batch, never as the command alone
+        key = job_key(job.tokens, version or gnina_version(gnina or job.tokens[0]), batch_membership(job.out))
+        path = cache.lookup(key, job.out)
+        if path:
+            cache.link(path, job.out)
+            hits += 1
+            continue
+        rec = journal_recs.get(job.out)
+        if rec is not None and rec['status'] == 'failed' and not retry_failed:
+            continue
+        if not os.path.islink(job.out) and output_complete(job.out) and newer_than_inputs(job.tokens, job.out):
+            cache.store(key, job.out)
+            hits += 1
+            continue
+        keys[job.out] = key
+        todo.append(job)
+    return todo, keys, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a gnina command file on a process pool, skipping finished jobs and journaling progress.')
+    parser.add_argument('-i', '--input', required=True, help='Command file made by make_gnina_cmds.py.')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of commands to run at once. Defaults to the number of cores divided by --cpu_per_job.')
+    parser.add_argument('--cpu_per_job', type=int, default=None, help='Value to set for the --cpu option of every command. Defaults to leaving the commands unchanged.')
+    parser.add_argument('--gnina', default=None, help='gnina executable to run in place of the first word of each command.')
+    parser.add_argument('--journal', default=None, help='Journal of finished and failed commands. Defaults to <input>.journal')
+    parser.add_argument('--retry_failed', action='store_true', help='Flag to rerun commands the journal lists as failed.')
+    parser.add_argument('--dry_run', action='store_true', help='Flag to only print how many commands would run.')
+    parser.add_argument('--cache', default=None, help='Directory of a content-addressed result cache to take outputs from and store them in.')
+    parser.add_argument('--cache_size', default=None, help='Size limit of the cache (e.g. 200G); least recently used outputs are evicted after the run.')
+    parser.add_argument('--gnina_version', default=None, help='gnina version for the cache keys, for hosts where gnina can not be run (default: the first line of gnina --version)')
+    args = parser.parse_args()
+
+    journal = args.journal if args.journal else args.input+'.journal'
+    jobs = read_commands(args.input)
+    cache = None
+    if args.cache:
+        from result_cache import ResultCache, parse_size
+        cache = ResultCache(args.cache, parse_size(args.cache_size))
+        try:
+            todo, keys, hits = select_cached(jobs, load_journal(journal), cache, args.gnina, args.retry_failed, args.gnina_version)
+        except RuntimeError as e:
+            parser.error(str(e))
+        print(f'{hits} commands found in the cache')
+    else:
+        todo = select_jobs(jobs, load_journal(journal), args.retry_failed)
+    print(f'{len(todo)} of {len(jobs)} commands to run')
+    if args.dry_run or not todo:
+        if cache:
+            cache.evict()
+        return
+
+    nworkers = args.jobs if args.jobs else default_workers(args.cpu_per_job)
+    items = prepare(todo, args.gnina, args.cpu_per_job)
+    recs = run_commands(items, nworkers, journal)
+    nfailed = sum(rec['status'] == 'failed' for rec in recs)
+    print(f'{len(items)-nfailed} done, {nfailed} failed')
+    if cache:
+        for rec in recs:
+            if rec['status'] == 'done' and rec['out'] in keys:
+                cache.store(keys[rec['out']], rec['out'])
+        removed, freed = cache.evict()
+        if removed:
+            print(f'evicted {removed} cached outputs ({freed/2**30:.2f} GiB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+'''
+Sidecar index (<file>.idx) for random access to the poses of a docked sdf(.gz) output.
+
+The index holds the byte offset and length of every record in the decompressed stream, the gzip
+member checkpoints to start decompressing from, and the values of every SD tag. With it a score
+column is read without touching the sdf at all, and pose k is read by decompressing from the
+nearest checkpoint to the end of the pose instead of the whole file.
+
+gnina writes a single gzip member, so by default the only checkpoint is the start of the file
+and pose k costs decompressing poses 0..k (cheap for the top poses, which come first). --repack
+rewrites the file as a series of small gzip members of --records_per_member poses each, in the
+style of bgzip: still a valid .gz file for gzip, openbabel and sdf_stream.py, but any pose can be
+read by decompressing a single member. Symlinked outputs (result_cache.py) are indexed but never
+repacked, since the cached object is shared.
+
+An index is ignored once the size or mtime of its sdf changes.
+
+Usage:
+        python sdf_index.py build --repack docked/*.sdf.gz
+        python sdf_index.py tags <poses.sdf.gz> CNNscore CNNaffinity
+        python sdf_index.py get <poses.sdf.gz> 0 1 2 > top3.sdf
+'''
+
+import argparse, gzip, json, os, sys, zlib
+from bisect import bisect_right
+from sdf_stream import parse_molblock
+
+VERSION = 1
+CHUNK = 1 << 16
+
+
+def index_path(path):
+    return path+'.idx'
+
+
+def _source_state(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _open_bytes(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def scan(path):
+    '''
+    Yield (offset, length, lines) of every record of a (possibly gzipped) sdf file, offsets and
+    lengths being in bytes of the decompressed stream, $$$$ line included.
+    '''
+
+    offset = 0
+    start = 0
+    block = []
+    with _open_bytes(path) as infile:
+        for raw in infile:
+            if raw.startswith(b'$$$$'):
+                offset += len(raw)
+                yield start, offset-start, block
+                start = offset
+                block = []
+            else:
+                offset += len(raw)
+                block.append(raw.decode(errors='replace').rstrip('\r\n'))
+    if len(block) > 3:
+        yield start, offset-start, block
+
+
+class SDFIndex:
+    '''
+    Offsets, gzip checkpoints, titles and SD tag values of one sdf(.gz) file.
+    '''
+
+    def __init__(self, path, state, members, offsets, lengths, titles, tags):
+        self.path = path
+        self.state = state
+        self.members = members
+        self.offsets = offsets
+        self.lengths = lengths
+        self.titles = titles
+        self.tags = tags
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def from_records(cls, path, spans, recs, members=None):
+        tags = {}
+        for i, rec in enumerate(recs):
+            for name, value in rec.tags.items():
+                tags.setdefault(name, [None]*len(recs))[i] = value
+        return cls(path, _source_state(path), members or [[0, 0]], [s[0] for s in spans], [s[1] for s in spans],
+                   [rec.title for rec in recs], tags)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        The index of path, or None if there is none or the file changed since it was written.
+        '''
+
+        try:
+            with open(index_path(path)) as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != VERSION or data['state'] != _source_state(path):
+            return None
+        return cls(path, data['state'], data['members'], data['offsets'], data['lengths'], data['titles'], data['tags'])
+
+    def save(self):
+        tmp = index_path(self.path)+'.tmp'
+        with open(tmp, 'w') as outfile:
+            json.dump({'version': VERSION, 'state': self.state, 'members': self.members, 'offsets': self.offsets,
+                       'lengths': self.lengths, 'titles': self.titles, 'tags': self.tags}, outfile)
+        os.replace(tmp, index_path(self.path))
+
+    def column(self, name, missing='nan'):
+        '''
+        Values of an SD tag for every pose, as the strings in the file.
+        '''
+
+        values = self.tags.get(name, [None]*len(self))
+        return [missing if v is None else v for v in values]
+
+    def _read(self, start, length):
+        # bytes [start, start+length) of the decompressed stream
+        with open(self.path, 'rb') as infile:
+            if not self.path.endswith('.gz'):
+                infile.seek(start)
+                return infile.read(length)
+            i = bisect_right([m[1] for m in self.members], start)-1
+            infile.seek(self.members[i][0])
+            pos = self.members[i][1]
+            out = bytearray()
+            d = zlib.decompressobj(31)
+            pending = b''
+            while len(out) < length:
+                if not pending:
+                    pending = infile.read(CHUNK)
+                    if not pending:
+                        break
+                data = d.decompress(pending, CHUNK)
+                if pos+len(data) > start:
+                    out += data[max(start-pos, 0):]
+                pos += len(data)
+                if d.eof:
+                    pending = d.unused_data
+                    d = zlib.decompressobj(31)
+                else:
+                    pending = d.unconsumed_tail
+            return bytes(out[:length])
+
+    def block(self, k):
+        '''
+        Lines of record k without the $$$$ terminator, as sdf_stream.blocks gives them.
+        '''
+
+        text = self._read(self.offsets[k], self.lengths[k]).decode(errors='replace')
+        lines = (text[:-1] if text.endswith('\n') else text).split('\n')
+        if lines[-1].startswith('$$$$'):
+            lines.pop()
+        return [line.rstrip('\r') for line in lines]
+
+    def record(self, k):
+        '''
+        SDRecord of pose k.
+        '''
+
+        return parse_molblock(self.block(k))
+
+
+def repack(path, spans, per_member):
+    '''
+    Rewrite a gzipped sdf as one gzip member per per_member records, returning the [compressed,
+    decompressed] offset of every member. Whatever follows the last record (a trailing newline, an
+    unterminated record too short to index) goes into the last member, so the decompressed stream
+    is unchanged.
+    '''
+
+    members = []
+    tmp = path+'.repack.tmp'
+    with _open_bytes(path) as infile, open(tmp, 'wb') as outfile:
+        written = 0
+        for i in range(0, len(spans), per_member):
+            group = spans[i:i+per_member]
+            start = group[0][0]
+            if i+per_member >= len(spans):
+                data = infile.read()
+            else:
+                data = infile.read(group[-1][0]+group[-1][1]-start)
+            members.append([written, start])
+            member = gzip.compress(data, mtime=0)
+            outfile.write(member)
+            written += len(member)
+    os.replace(tmp, path)
+    return members
+
+
+def _read_all(path):
+    spans = []
+    recs = []
+    for start, length, lines in scan(path):
+        spans.append((start, length))
+        recs.append(parse_molblock(lines))
+    return spans, recs
+
+
+def build(path, repack_gz=False, per_member=8):
+    '''
+    Index path (repacking it first if asked) and write the sidecar index.
+    '''
+
+    spans, recs = _read_all(path)
+    members = None
+    if repack_gz and path.endswith('.gz') and not os.path.islink(path) and spans:
+        members = repack(path, spans, per_member)
+    index = SDFIndex.from_records(path, spans, recs, members)
+    index.save()
+    return index
+
+
+def indexed_records(path):
+    '''
+    Like sdf_stream.records (as a list), but also writes the index of path from the same pass
+    unless it already has an up to date one.
+    '''
+
+    spans, recs = _read_all(path)
+    if SDFIndex.load(path) is None:
+        SDFIndex.from_records(path, spans, recs).save()
+    return recs
+
+
+def load_or_build(path):
+    '''
+    The up to date index of path, building it if needed.
+    '''
+
+    index = SDFIndex.load(path)
+    if index is None:
+        index = SDFIndex.from_records(path, *_read_all(path))
+        try:
+            index.save()
+        except OSError:
+            pass  # outputs on a read-only file system are still indexed for this run
+    return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build and read the random access index of sdf(.gz) docking outputs.')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    b = sub.add_parser('build', help='Write the index of every file.')
+    b.add_argument('files', nargs='+', help='sdf or sdf.gz files.')
+    b.add_argument('--repack', action='store_true', help='Flag to rewrite gzipped files as small gzip members so any pose can be read alone.')
+    b.add_argument('--records_per_member', type=int, default=8, help='Poses per gzip member with --repack (default: %(default)d)')
+    b.add_argument('--force', action='store_true', help='Flag to rebuild indexes that are up to date.')
+    t = sub.add_parser('tags', help='Print the title and SD tags of every pose from the index.')
+    t.add_argument('file', help='sdf or sdf.gz file.')
+    t.add_argument('tags', nargs='*', help='Names of the SD tags to print.')
+    g = sub.add_parser('get', help='Print poses by their index in the file as sdf.')
+    g.add_argument('file', help='sdf or sdf.gz file.')
+    g.add_argument('poses', nargs='+', type=int, help='0-based pose numbers.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        for path in args.files:
+            index = None if args.force else SDFIndex.load(path)
+            if index is None or (args.repack and len(index.members) == 1):
+                build(path, args.repack, args.records_per_member)
+    elif args.command == 'tags':
+        index = load_or_build(args.file)
+        for row in zip(index.titles, *[index.column(name) for name in args.tags]):
+            print(' '.join(row))
+    else:
+        index = load_or_build(args.file)
+        for k in args.poses:
+            sys.stdout.write(''.join(line+'\n' for line in index.block(k))+'$$$$\n')
+
+
+if __name__ == '__main__':
+    main()
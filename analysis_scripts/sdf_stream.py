@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+'''
+Single-pass streaming reader for (possibly gzipped) sdf files.
+
+Every record is yielded as it is read, with its coordinates and all of its SD tags, so a docked
+output file only has to be decompressed once no matter how many score fields are wanted, and
+memory use is bounded by the size of one pose.
+
+Usage (dump tags as a table):
+    python sdf_stream.py <poses.sdf.gz> CNNscore CNNaffinity minimizedAffinity
+'''
+
+import argparse, gzip
+from collections import namedtuple
+import numpy as np
+
+SDRecord = namedtuple('SDRecord', ['title', 'elements', 'coords', 'bonds', 'tags', 'orders'], defaults=(None,))
+
+
+def open_text(path):
+    '''
+    Open a plain or gzipped text file for reading.
+    '''
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+def parse_molblock(lines):
+    '''
+    Parse the lines of one V2000 sdf record (without the $$$$ terminator) into an SDRecord.
+
+    bonds is a list of 0-based (atom1, atom2) tuples and orders the bond order of each (4 for
+    aromatic). gnina may kekulize the docked poses differently than the input ligand, so the
+    orders of ring bonds should not be relied on. Tag values are kept as the strings in the file.
+    A record cut off before the end of its bond block raises ValueError.
+    '''
+
+    title = lines[0].strip()
+    counts = lines[3]
+    if 'V3000' in counts:
+        raise ValueError('V3000 molblocks are not supported')
+    natoms = int(counts[0:3])
+    nbonds = int(counts[3:6])
+    if len(lines) < 4+natoms+nbonds:
+        raise ValueError(f'record {title!r} is truncated: {len(lines)} lines for {natoms} atoms and {nbonds} bonds')
+
+    elements = []
+    coords = np.empty((natoms, 3))
+    for i, line in enumerate(lines[4:4+natoms]):
+        coords[i] = (float(line[0:10]), float(line[10:20]), float(line[20:30]))
+        elements.append(line[31:34].strip())
+
+    bonds = []
+    orders = []
+    for line in lines[4+natoms:4+natoms+nbonds]:
+        bonds.append((int(line[0:3])-1, int(line[3:6])-1))
+        orders.append(int(line[6:9].strip() or 1))
+
+    tags = {}
+    name = None
+    for line in lines[4+natoms+nbonds:]:
+        if line.startswith('>'):
+            start = line.find('<')
+            name = line[start+1:line.find('>', start)] if start >= 0 else None
+            if name is not None:
+                tags[name] = ''
+        elif name is not None:
+            if line.strip() == '':
+                name = None
+            elif tags[name]:
+                tags[name] += '\n'+line
+            else:
+                tags[name] = line
+
+    return SDRecord(title, elements, coords, bonds, tags, orders)
+
+
+def bridges(n, bonds):
+    '''
+    Indices of the bonds of an n atom graph that are not in a ring (Tarjan's bridge finding).
+    '''
+
+    nbrs = [[] for _ in range(n)]
+    for k, (a, b) in enumerate(bonds):
+        nbrs[a].append((b, k))
+        nbrs[b].append((a, k))
+    low = [0]*n
+    disc = [-1]*n
+    bridges = set()
+    timer = 0
+    for root in range(n):
+        if disc[root] >= 0:
+            continue
+        disc[root] = low[root] = timer
+        timer += 1
+        stack = [(root, -1, iter(nbrs[root]))]
+        while stack:
+            node, parent_edge, it = stack[-1]
+            for nxt, k in it:
+                if k == parent_edge:
+                    continue
+                if disc[nxt] < 0:
+                    disc[nxt] = low[nxt] = timer
+                    timer += 1
+                    stack.append((nxt, k, iter(nbrs[nxt])))
+                    break
+                low[node] = min(low[node], disc[nxt])
+            else:
+                stack.pop()
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                    if low[node] > disc[parent]:
+                        bridges.add(parent_edge)
+    return bridges
+
+
+def blocks(path):
+    '''
+    Yield the lines of every record of a (possibly gzipped) sdf file, without the $$$$ terminator.
+    '''
+
+    block = []
+    with open_text(path) as infile:
+        for line in infile:
+            if line.startswith('$$$$'):
+                yield block
+                block = []
+            else:
+                block.append(line.rstrip('\n'))
+    if len(block) > 3:  # tolerate a missing terminator on the last record
+        yield block
+
+
+def records(path):
+    '''
+    Yield an SDRecord for every record of a (possibly gzipped) sdf file in one pass.
+    '''
+
+    for block in blocks(path):
+        yield parse_molblock(block)
+
+
+def tag_values(rec, names, missing='nan'):
+    '''
+    Values of the SD tags in names for one record, missing tags are reported as missing.
+    '''
+
+    return [rec.tags.get(name, missing) for name in names]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the title and the requested SD tags of every record in an sdf(.gz) file')
+    parser.add_argument('sdf', help='sdf or sdf.gz file to read.')
+    parser.add_argument('tags', nargs='*', help='Names of the SD tags to print.')
+    args = parser.parse_args()
+
+    for rec in records(args.sdf):
+        print(' '.join([rec.title]+tag_values(rec, args.tags)))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+'''
+Runs the obrms_calc.py and coalescer.py stages over many nodes from a manifest of work units.
+
+obrms_calc.py works on the commands matching --dirname and coalescer.py on the pockets of
+--dirlist, which does not spread a large analysis evenly over a cluster. Here every docked output
+is a work unit and:
+
+        plan   -- lists the units of a command file (with the pocket and sweep value coalescer.py
+                  would give them), weighs them by file size or pose count and splits them into
+                  --shards balanced shards (longest first, as job_scheduler.py)
+        run    -- on each node: computes the .rmsds files of one shard and writes its partial
+                  table to <manifest>.parts/, restartable since up to date .rmsds files are kept
+        merge  -- checks every shard finished and combines the partial tables into the master
+                  table, always in unit order (pocket, value, path) whatever node ran what
+        local  -- runs every shard as a local process and merges, standing in for the cluster
+
+Partial tables are named after the plan, so parts of an older plan are never merged.
+
+Usage:
+        python shard_manifest.py plan -i cd_cmds.txt -r /data/crossdock -d cd_dirs.txt -s _ensemble_exhaustiveness -v 4 8 16 --getscores --shards 64 -o cd.manifest.json
+        python shard_manifest.py run -m cd.manifest.json --shard $SLURM_ARRAY_TASK_ID
+        python shard_manifest.py merge -m cd.manifest.json -o crossdock_master.csv
+'''
+
+import argparse, csv, glob, hashlib, json, os, subprocess, sys
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from coalescer import COLUMNS, SCORE_COLUMNS, read_rmsds, rows_to_frame, write_csv, write_parts
+from job_scheduler import lpt_shards
+from obrms_calc import get_lig_out, rmsd_lines, splitter
+from rmsd_engine import RMSDCalculator
+
+VERSION = 1
+
+
+def find_unit(rmsds, root, dirs, suffix, values):
+    '''
+    (pocket, value) coalescer.py would give a .rmsds file, or None if it would not pick it up.
+    '''
+
+    for pocket in dirs:
+        rest = rmsds[len(root+pocket):]
+        if not rmsds.startswith(root+pocket) or '/' in rest:
+            continue
+        for val in values:
+            if fnmatch(rest, '*'+suffix+val+'.rmsds'):
+                return pocket, val
+    return None
+
+
+def unit_weights(outs, weight):
+    '''
+    Weight of every docked output: its size, or its number of poses. Pose counts come from the
+    sdf_index.py indexes where there are any, the rest are estimated from their size.
+    '''
+
+    from sdf_index import SDFIndex
+
+    sizes = [os.path.getsize(out) if os.path.exists(out) else 0 for out in outs]
+    if weight == 'size':
+        return sizes
+    poses = [None]*len(outs)
+    for i, out in enumerate(outs):
+        index = SDFIndex.load(out) if sizes[i] else None
+        if index is not None:
+            poses[i] = len(index)
+    known = [i for i, p in enumerate(poses) if p is not None]
+    known_size = sum(sizes[i] for i in known)
+    per_byte = sum(poses[i] for i in known)/known_size if known_size else 1.0
+    return [p if p is not None else s*per_byte for p, s in zip(poses, sizes)]
+
+
+def plan(lines, root, dirs, suffix, values, nshards, weight='size', splitprefix=None, getscores=False):
+    '''
+    Manifest dict of the commands in lines. Units are in the order of the master table.
+    '''
+
+    units = {}
+    skipped = 0
+    for line in lines:
+        if ' -l ' not in line or ' --out ' not in line:
+            continue
+        lig, out = get_lig_out(line)
+        if splitprefix:
+            lig, out = splitter((lig, out), splitprefix)
+        rmsds = out.split('.sdf')[0]+'.rmsds'
+        found = find_unit(rmsds, root, dirs, suffix, values)
+        if found is None:
+            skipped += 1
+        elif out not in units:
+            units[out] = {'lig': lig, 'out': out, 'rmsds': rmsds, 'pocket': found[0], 'val': found[1]}
+    pockets = {p: i for i, p in enumerate(dirs)}
+    vals = {v: i for i, v in enumerate(values)}
+    units = sorted(units.values(), key=lambda u: (pockets[u['pocket']], vals[u['val']], u['rmsds']))
+
+    weights = unit_weights([u['out'] for u in units], weight)
+    shards, loads = lpt_shards(weights, nshards)
+    for k, shard in enumerate(shards):
+        for i in shard:
+            units[i]['shard'] = k
+            units[i]['weight'] = weights[i]
+    plan_id = hashlib.sha1(json.dumps([units, getscores], sort_keys=True).encode()).hexdigest()[:12]
+    return {'version': VERSION, 'plan': plan_id, 'shards': nshards, 'getscores': getscores, 'loads': loads, 'skipped': skipped, 'units': units}
+
+
+def part_name(manifest_file, manifest, k):
+    return os.path.join(manifest_file+'.parts', f'shard{k:04d}-{manifest["plan"]}.csv')
+
+
+def run_shard(manifest_file, manifest, k, force=False):
+    '''
+    Compute the .rmsds files of shard k and write its partial table. Returns the number of rows.
+    '''
+
+    getscores = manifest['getscores']
+    calculators = {}
+    rows = []
+    for i, unit in enumerate(manifest['units']):
+        if unit['shard'] != k:
+            continue
+        if not os.path.exists(unit['out']):
+            continue
+        rmsds = unit['rmsds']
+        if force or not os.path.exists(rmsds) or os.path.getmtime(rmsds) < os.path.getmtime(unit['out']):
+            if unit['lig'] not in calculators:
+                calculators[unit['lig']] = RMSDCalculator(unit['lig'])
+            tmp = rmsds+'.tmp'
+            with open(tmp, 'w') as outfile:
+                for line in rmsd_lines(calculators[unit['lig']], unit['out'], getscores):
+                    outfile.write(line+'\n')
+            os.replace(tmp, rmsds)
+        rows += [(str(i),)+row for row in read_rmsds(rmsds, unit['pocket'], unit['val'], getscores)]
+
+    name = part_name(manifest_file, manifest, k)
+    os.makedirs(os.path.dirname(name), exist_ok=True)
+    write_csv(name+'.tmp', rows, ['unit']+(SCORE_COLUMNS if getscores else COLUMNS), False)
+    os.replace(name+'.tmp', name)
+    return len(rows)
+
+
+def merge(manifest_file, manifest):
+    '''
+    (header, rows, sources) of the master table from the partial tables of all shards, in unit order.
+    '''
+
+    missing = [k for k in range(manifest['shards']) if not os.path.exists(part_name(manifest_file, manifest, k))]
+    if missing:
+        raise SystemExit(f'{len(missing)} shards have not finished: {" ".join(map(str, missing))}')
+    header = None
+    rows = []
+    for k in range(manifest['shards']):
+        with open(part_name(manifest_file, manifest, k), newline='') as infile:
+            reader = csv.reader(infile)
+            header = next(reader)[1:]
+            rows += [(int(row[0]), k, n, tuple(row[1:])) for n, row in enumerate(reader)]
+    rows.sort(key=lambda r: r[:3])
+    units = manifest['units']
+    return header, [r[3] for r in rows], [units[r[0]]['rmsds'] for r in rows]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shard the RMSD and coalescing stages over nodes with a manifest of work units.')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    p = sub.add_parser('plan', help='Write the manifest of work units split into balanced shards.')
+    p.add_argument('-i', '--input', required=True, help='Docking command file.')
+    p.add_argument('-o', '--output', required=True, help='Manifest to write.')
+    p.add_argument('-r', '--dataroot', required=True, help='Root of the pocket directories, as for coalescer.py.')
+    p.add_argument('-d', '--dirlist', required=True, help='File listing the pocket directories, as for coalescer.py.')
+    p.add_argument('-s', '--suffix', required=True, help='Suffix of the output files before the sweep value, as for coalescer.py.')
+    p.add_argument('-v', '--values', nargs='+', default=[''], help='Sweep values, as for coalescer.py.')
+    p.add_argument('--splitprefix', default=None, help='Text prefix to split off of the paths in the commands, as for obrms_calc.py.')
+    p.add_argument('--getscores', action='store_true', help='Flag to include the CNNscore, CNNaffinity and minimizedAffinity, as for obrms_calc.py and coalescer.py.')
+    p.add_argument('--shards', type=int, required=True, help='Number of shards.')
+    p.add_argument('--weight', default='size', choices=['size', 'poses'], help='Balance shards by output file size or pose count (default: %(default)s)')
+    for name, help_text in (('run', 'Compute the RMSDs and partial table of one shard.'), ('merge', 'Combine the partial tables into the master table.'),
+                            ('local', 'Run every shard as a local process, then merge.')):
+        s = sub.add_parser(name, help=help_text)
+        s.add_argument('-m', '--manifest', required=True, help='Manifest written by plan.')
+        if name in ('run', 'local'):
+            s.add_argument('--force', action='store_true', help='Flag to recompute .rmsds files that are up to date.')
+        if name == 'run':
+            s.add_argument('--shard', type=int, required=True, help='Shard to run (0-based).')
+        else:
+            s.add_argument('-o', '--outfilename', required=True, help='Master table (a directory for parquet/feather).')
+            s.add_argument('--format', default='csv', choices=['csv', 'parquet', 'feather'], help='Output format (default: %(default)s)')
+        if name == 'local':
+            s.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Shards run at once (default: number of CPUs)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'plan':
+        if args.shards < 1:
+            parser.error('--shards must be at least 1')
+        if args.dataroot[-1] != '/':
+            args.dataroot += '/'
+        dirs = [x.rstrip() for x in open(args.dirlist).readlines()]
+        manifest = plan(open(args.input).readlines(), args.dataroot, dirs, args.suffix, args.values, args.shards, args.weight, args.splitprefix, args.getscores)
+        with open(args.output, 'w') as outfile:
+            json.dump(manifest, outfile, indent=1)
+        loads = manifest['loads']
+        print(f'{len(manifest["units"])} units in {args.shards} shards (loads {min(loads):.0f} to {max(loads):.0f} by {args.weight}), {manifest["skipped"]} commands outside the pockets/values')
+        return
+
+    with open(args.manifest) as infile:
+        manifest = json.load(infile)
+    if args.command == 'run':
+        if not 0 <= args.shard < manifest['shards']:
+            parser.error(f'--shard must be from 0 to {manifest["shards"]-1}')
+        n = run_shard(args.manifest, manifest, args.shard, args.force)
+        print(f'shard {args.shard}: {n} rows')
+        return
+    if args.command == 'local':
+        cmd = [sys.executable, os.path.abspath(__file__), 'run', '-m', args.manifest]+(['--force'] if args.force else [])
+        with ThreadPoolExecutor(max(args.jobs, 1)) as pool:
+            codes = list(pool.map(lambda k: subprocess.call(cmd+['--shard', str(k)]), range(manifest['shards'])))
+        failed = [k for k, code in enumerate(codes) if code]
+        if failed:
+            raise SystemExit(f'shards {" ".join(map(str, failed))} failed')
+
+    header, rows, sources = merge(args.manifest, manifest)
+    if args.format == 'csv':
+        write_csv(args.outfilename, rows, header, False)
+    elif rows:
+        for old in glob.glob(os.path.join(args.outfilename, 'tag=*', 'part-*')):
+            os.remove(old)
+        parts = write_parts(args.outfilename, rows_to_frame(rows, header, sources), args.format, manifest['plan'])
+        print(f'{len(parts)} part files')
+    print(f'{len(rows)} rows from {manifest["shards"]} shards')
+
+
+if __name__ == '__main__':
+    main()
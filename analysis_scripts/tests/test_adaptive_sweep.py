@@ -0,0 +1,35 @@
+import argparse
+import pytest
+
+import adaptive_sweep
+from adaptive_sweep import evaluate, rung_sizes
+
+
+def test_rung_sizes():
+    assert rung_sizes(1000, 200, 2) == [200, 400, 800, 1000]
+    assert rung_sizes(10, 3, 1.01) == [3, 4, 5, 6, 7, 8, 9, 10]
+    assert rung_sizes(50, 200, 2) == [50]
+    for start, growth in ((0, 2), (-5, 2), (10, 1), (10, 0.5)):
+        with pytest.raises(ValueError):
+            rung_sizes(100, start, growth)
+
+
+@pytest.mark.parametrize('option', [['--growth', '1'], ['--start', '0']])
+def test_bad_rungs_rejected(option, capsys):
+    with pytest.raises(SystemExit):
+        adaptive_sweep.main(['-i', 'pairs.txt', '--exhaustiveness', '4', '8']+option)
+    assert option[0] in capsys.readouterr().err
+
+
+def test_failures_count_as_misses(monkeypatch):
+    # config 0 docks half of the systems perfectly and crashes on the rest, config 1 gets 3 of 4 right
+    poses = {(0, 0): [0.5], (0, 1): [0.5], (0, 2): [], (0, 3): [],
+             (1, 0): [0.5], (1, 1): [0.5], (1, 2): [0.5], (1, 3): [5.0]}
+    monkeypatch.setattr(adaptive_sweep, 'pose_rmsds', lambda cmd, calculators: poses[cmd])
+    commands = [[(c, i) for i in range(4)] for c in range(2)]
+    todock = [(f'pocket{i % 2}/rec.pdb', 'lig.sdf', 'lig.sdf', 'out') for i in range(4)]
+    args = argparse.Namespace(stratify=False, threshold=2, top=1, nboot=50, ci=95, subset_seed=0)
+    result, failed = evaluate([0, 1], range(4), commands, todock, {}, args)
+    assert failed == {0: 2}
+    assert list(result.nsystems) == [4, 4]
+    assert list(result.topn[:, 0, 0]) == [50, 75]
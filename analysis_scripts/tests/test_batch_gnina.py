@@ -0,0 +1,73 @@
+import gzip, os
+import pytest
+
+from batch_gnina import plan, split
+from gnina_jobs import batch_membership, canonical_command, parse_command, read_commands
+from make_gnina_cmds import dedupe_commands
+from result_cache import ResultCache, job_key
+from run_gnina_cmds import select_cached
+
+LIGAND = 'lig{}\n  test\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n$$$$\n'
+
+
+def pose(title):
+    return f'{title}\n  gnina\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n> <minimizedAffinity>\n-7.0\n\n$$$$\n'
+
+
+@pytest.fixture
+def batched(tmp_path):
+    # two ligands docked as one batch with the fixed seed of make_gnina_cmds.py, and the batch split back
+    (tmp_path/'rec.pdb').write_text('ATOM\n')
+    lines = []
+    for name in 'ab':
+        (tmp_path/f'{name}.sdf').write_text(LIGAND.format(name))
+        lines.append(f'gnina -r {tmp_path}/rec.pdb -l {tmp_path}/{name}.sdf --autobox_ligand {tmp_path}/rec.pdb '
+                     f'--cpu 1 --seed 420 --out {tmp_path}/{name}_out.sdf.gz')
+    cmds = tmp_path/'cmds.txt'
+    cmds.write_text(''.join(line+'\n' for line in lines))
+    batch_lines, manifest = plan(read_commands(str(cmds)), str(tmp_path/'batches'), 32)
+    assert len(manifest) == 1
+    batch_out = parse_command(batch_lines[0]).out
+    with gzip.open(batch_out, 'wt') as outfile:
+        outfile.write(pose('0|lig_a')+pose('1|lig_b')+pose('0|lig_a'))
+    assert split(manifest) == []
+    return tmp_path, cmds, lines
+
+
+def test_split_records_batch(batched):
+    root, _, lines = batched
+    members = [canonical_command(parse_command(line).tokens) for line in lines]
+    assert batch_membership(str(root/'a_out.sdf.gz')) == {'members': members, 'index': 0}
+    assert batch_membership(str(root/'b_out.sdf.gz')) == {'members': members, 'index': 1}
+    # docked again on its own, the old record no longer applies
+    with gzip.open(root/'b_out.sdf.gz', 'wt') as outfile:
+        outfile.write(pose('lig_b'))
+    assert batch_membership(str(root/'b_out.sdf.gz')) is None
+
+
+def test_cache_keys_batch(batched):
+    root, cmds, lines = batched
+    jobs = read_commands(str(cmds))
+    cache = ResultCache(str(root/'cache'))
+    for _ in range(2):  # adopted once, then found under the batched key through the symlinks
+        todo, keys, hits = select_cached(jobs, {}, cache, version='gnina test')
+        assert (todo, hits) == ([], 2)
+    for job in jobs:
+        batch = batch_membership(job.out)
+        assert batch is not None
+        assert cache.lookup(job_key(job.tokens, 'gnina test', batch), job.out)
+        assert cache.lookup(job_key(job.tokens, 'gnina test'), job.out) is None
+    # the same docking alone under another name is not served the batched result
+    alone = parse_command(lines[0].replace('a_out', 'alone'))
+    todo, _, hits = select_cached([alone], {}, cache, version='gnina test')
+    assert (todo, hits) == ([alone], 0)
+
+
+def test_registry_skips_batched(batched):
+    root, _, lines = batched
+    known = {canonical_command(parse_command(line).tokens): parse_command(line).out for line in lines}
+    torun, reused = dedupe_commands([lines[0].replace('a_out', 'alone')], known)
+    assert reused == [] and len(torun) == 1
+    os.remove(str(root/'b_out.sdf.gz.batch'))  # a docking of its own is reused as before
+    torun, reused = dedupe_commands([lines[1].replace('b_out', 'alone')], known)
+    assert torun == [] and reused[0][1] == str(root/'b_out.sdf.gz')
@@ -0,0 +1,188 @@
+'''
+coalescer.py on a tree of .rmsds files, in csv and in partitioned parquet/feather form, and the
+cost table it makes from run_gnina_cmds.py journals.
+'''
+
+import json, os
+import numpy as np
+import pandas as pd
+import pytest
+
+import coalescer
+import generate_RMSD_graphs
+from topn import stream_topn
+
+POCKETS = ['P1/', 'P2/']
+VALUES = ['4', '8', '16']
+SUFFIX = '_exhaustiveness'
+
+
+def write_rmsds(path, rng, nposes=None):
+    nposes = int(rng.integers(1, 6)) if nposes is None else nposes
+    with open(path, 'w') as outfile:
+        for k in range(nposes):
+            outfile.write(f'RMSD lig_{k}:lig {rng.uniform(0, 5):.5g} {rng.random():.4f} {5+rng.random():.4f} {-7+rng.random():.4f}\n')
+
+
+@pytest.fixture
+def tree(tmp_path):
+    rng = np.random.default_rng(0)
+    root = tmp_path/'data'
+    for pocket in POCKETS:
+        (root/pocket).mkdir(parents=True)
+        for r in range(3):
+            for val in VALUES:
+                write_rmsds(root/pocket/f'{pocket[:-1]}r{r}_PRO_{pocket[:-1]}l{r}_LIG{SUFFIX}{val}.rmsds', rng)
+    dirlist = tmp_path/'dirs.txt'
+    dirlist.write_text(''.join(pocket+'\n' for pocket in POCKETS))
+    return tmp_path, root, dirlist
+
+
+def coalesce(tree, out, fmt='csv', *extra):
+    tmp_path, root, dirlist = tree
+    coalescer.main(['-r', str(root), '-d', str(dirlist), '-s', SUFFIX, '-v']+VALUES+['-o', str(tmp_path/out), '--getscores', '--format', fmt]+list(extra))
+    return str(tmp_path/out)
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+def test_partitioned_tags_sort_like_csv(tree, fmt):
+    csv = coalesce(tree, 'master.csv')
+    part = coalesce(tree, 'master', fmt)
+    # directory names sort as '16' < '4' < '8', the csv's tag column is numeric
+    assert coalescer.read_master(part)['tag'].dtype.categories.tolist() == [4, 8, 16]
+    for columns in (None, ['tag', 'rmsd', 'rec']):
+        chunk = next(coalescer.iter_master(part, columns))
+        assert chunk['tag'].dtype == pd.read_csv(csv)['tag'].dtype
+    expected = stream_topn(coalescer.iter_master(csv, chunksize=7))
+    result = stream_topn(coalescer.iter_master(part, chunksize=7))
+    assert result.tags.tolist() == expected.tags.tolist() == [4, 8, 16]
+    np.testing.assert_array_equal(result.topn, expected.topn)
+
+
+def test_partitioned_string_tags(tmp_path):
+    # tags that are not all numbers stay strings
+    df = pd.DataFrame({'tag': ['a', '4'], 'molids': ['m', 'm'], 'rmsd': ['1', '2'], 'pocket': ['P', 'P'], 'rec': ['r', 'r'], 'lig': ['l', 'l']})
+    coalescer.write_parts(str(tmp_path/'master'), coalescer.rows_to_frame(df.values.tolist(), list(df.columns), ['s', 's']), 'parquet', '0')
+    assert sorted(coalescer.read_master(str(tmp_path/'master'))['tag'].tolist()) == ['4', 'a']
+
+
+def table(path):
+    # rows of a master table as sorted tuples of strings, whatever its format
+    df = coalescer.read_master(path).drop(columns='source', errors='ignore')
+    return sorted(tuple(f'{v:g}' if isinstance(v, float) else str(v) for v in row) for row in df.itertuples(index=False))
+
+
+def fresh(tree, fmt):
+    return table(coalesce(tree, f'fresh.{fmt}', fmt, '--rebuild', '--manifest', str(tree[0]/f'fresh.{fmt}.json')))
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet', 'feather'])
+def test_incremental(tree, fmt, capsys):
+    tmp_path, root, _ = tree
+    rng = np.random.default_rng(1)
+    out = coalesce(tree, 'master', fmt)
+    assert table(out) == fresh(tree, fmt)
+    nrows = len(table(out))
+
+    # rerun with nothing changed
+    capsys.readouterr()
+    coalesce(tree, 'master', fmt)
+    assert '0 new or changed files, 0 to replace or remove' in capsys.readouterr().out
+    assert len(table(out)) == nrows
+
+    # add, modify and remove one file each
+    write_rmsds(root/'P1'/f'P1r9_PRO_P1l9_LIG{SUFFIX}8.rmsds', rng, 4)
+    write_rmsds(root/'P2'/f'P2r1_PRO_P2l1_LIG{SUFFIX}16.rmsds', rng, 7)
+    os.remove(root/'P1'/f'P1r0_PRO_P1l0_LIG{SUFFIX}4.rmsds')
+    capsys.readouterr()
+    coalesce(tree, 'master', fmt)
+    assert '2 new or changed files, 2 to replace or remove' in capsys.readouterr().out
+    assert table(out) == fresh(tree, fmt)
+
+    # only an addition appends to a csv
+    write_rmsds(root/'P2'/f'P2r9_PRO_P2l9_LIG{SUFFIX}4.rmsds', rng, 3)
+    coalesce(tree, 'master', fmt)
+    assert table(out) == fresh(tree, fmt)
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet'])
+def test_crash_before_manifest(tree, fmt, monkeypatch):
+    # a run that dies after writing its rows but before saving the manifest does not leave them twice
+    tmp_path, root, _ = tree
+    rng = np.random.default_rng(2)
+    out = coalesce(tree, 'master', fmt)
+    write_rmsds(root/'P1'/f'P1r9_PRO_P1l9_LIG{SUFFIX}8.rmsds', rng, 4)
+    os.remove(root/'P2'/f'P2r2_PRO_P2l2_LIG{SUFFIX}16.rmsds')
+
+    def crash(*args):
+        raise KeyboardInterrupt
+    with monkeypatch.context() as m:
+        m.setattr(coalescer, 'save_manifest', crash)
+        with pytest.raises(KeyboardInterrupt):
+            coalesce(tree, 'master', fmt)
+    coalesce(tree, 'master', fmt)
+    assert table(out) == fresh(tree, fmt)
+
+
+def test_append_cut_back_to_manifest(tree, monkeypatch):
+    # an append whose manifest was never saved is cut off at the size the manifest has
+    tmp_path, root, _ = tree
+    out = coalesce(tree, 'master.csv')
+    write_rmsds(root/'P2'/f'P2r9_PRO_P2l9_LIG{SUFFIX}4.rmsds', np.random.default_rng(3), 5)
+    with monkeypatch.context() as m:
+        m.setattr(coalescer, 'save_manifest', lambda *args: None)
+        coalesce(tree, 'master.csv')
+    with open(out) as infile:
+        assert sum(1 for _ in infile) == len(fresh(tree, 'csv'))+1
+    coalesce(tree, 'master.csv')
+    assert table(out) == fresh(tree, 'csv')
+    with open(out) as infile:
+        assert sum(1 for _ in infile) == len(fresh(tree, 'csv'))+1
+
+
+def journal_line(out, status, elapsed, user, sys, maxrss_kb):
+    rec = {'out': out, 'status': status, 'returncode': 0 if status == 'done' else 1, 'elapsed': elapsed, 'cmd': f'gnina --out {out}',
+           'user': user, 'sys': sys, 'maxrss_kb': maxrss_kb}
+    return json.dumps(rec)+'\n'
+
+
+def test_journal_costs(tree):
+    tmp_path, root, _ = tree
+    rng = np.random.default_rng(4)
+    # the commands ran from another directory than the .rmsds files are read from
+    outputs = {(pocket, r, val): f'/scratch/run/{pocket}{pocket[:-1]}r{r}_PRO_{pocket[:-1]}l{r}_LIG{SUFFIX}{val}.sdf.gz'
+               for pocket in POCKETS for r in range(3) for val in VALUES}
+    last, lines = {}, []
+    for key, out in outputs.items():
+        # a failed first try rerun, the rerun's record is the one that counts
+        if key[1] == 1:
+            lines.append(journal_line(out, 'failed', 1000.0, 900.0, 1.0, 10))
+        status = 'failed' if key == ('P2/', 2, '8') else 'done'
+        t, cpu, mem = float(rng.uniform(10, 100)), float(rng.uniform(10, 300)), int(rng.integers(1000, 5000))
+        last[key] = (status, t, cpu, 0.5, mem)
+        lines.append(journal_line(out, status, t, cpu, 0.5, mem))
+    # outputs of other runs and a torn last line are skipped
+    lines.append(journal_line('/scratch/run/P3/P3r0_PRO_P3l0_LIG_exhaustiveness4.sdf.gz', 'done', 1.0, 1.0, 0.0, 1))
+    lines.append(journal_line('/scratch/run/P1/P1r0_PRO_P1l0_LIG_cnn_scoring4.sdf.gz', 'done', 1.0, 1.0, 0.0, 1))
+    half = len(lines)//2
+    (tmp_path/'a.journal').write_text(''.join(lines[:half]))
+    (tmp_path/'b.journal').write_text(''.join(lines[half:])+'{"out": "/scr')
+    master = coalesce(tree, 'master.csv', 'csv', '--journals', str(tmp_path/'a.journal'), str(tmp_path/'b.journal'))
+
+    costs = pd.read_csv(master+'.costs.csv')
+    assert len(costs) == len(outputs)
+    # every docking joins to the systems of the RMSD table
+    systems = pd.read_csv(master)[['tag', 'rec', 'lig']].drop_duplicates()
+    assert len(costs.merge(systems, on=['tag', 'rec', 'lig'])) == len(outputs)
+    assert (costs['status'] == 'failed').sum() == 1
+
+    for metric, col in (('wall', 1), ('cpu', 2)):
+        info = generate_RMSD_graphs.getBenchmarkInfo(master+'.costs.csv', metric)
+        assert info.index.tolist() == VALUES
+        for val in VALUES:
+            done = [v for (_, _, v2), v in last.items() if v2 == val and v[0] == 'done']
+            seconds = [v[col]+(v[3] if metric == 'cpu' else 0) for v in done]
+            assert info.loc[val, 'systems'] == len(done) == (5 if val == '8' else 6)
+            assert info.loc[val, 'mean'] == pytest.approx(np.mean(seconds))
+            assert info.loc[val, 'std'] == pytest.approx(np.std(seconds, ddof=1))
+            assert info.loc[val, 'maxrss_kb'] == max(v[4] for v in done)
@@ -0,0 +1,68 @@
+'''
+exclusions.py against filter_csv of MakeCrossDockCSVs.ipynb, which wrote the filtered copies of
+the master tables before it: the same rows are removed for every list and combination.
+'''
+
+import pandas as pd
+import pytest
+
+import coalescer
+from exclusions import apply_exclusions, exclusion_ids, keep_mask
+from topn import make_dict
+
+LISTS = {
+    'plain.txt': '1ABC\n2def\n\n3GHI  \n',
+    'index.txt': '# PDBbind style header\n4JKL  2.20  2012  0.40  Ki=400mM  // 4jkl.pdf (NLG)\n5MNO\n',
+    'lig.txt': '6PQR\n7stu\n',
+}
+
+
+def filter_csv(subset_file, remove_files, new_suffix='filtered'):
+    # MakeCrossDockCSVs.ipynb
+    subset_csv = pd.read_csv(subset_file, sep=',')
+    subset_csv['pdbid'] = subset_csv['rec'].apply(lambda x: x.split('/')[-1])
+    for filename in remove_files:
+        with open(filename) as remove_file:
+            remove_recs = remove_file.readlines()
+        remove_recs = [(rec.strip()).upper() for rec in remove_recs]
+        subset_csv = subset_csv[~subset_csv['pdbid'].isin(remove_recs)]
+        subset_csv = subset_csv[~subset_csv['lig'].isin(remove_recs)]
+    subset_csv.drop(['pdbid'], axis=1, inplace=True)
+    subset_name = f"{subset_file.split('.')[0]}_{new_suffix}.csv"
+    subset_csv.to_csv(subset_name, sep=',', index=False)
+    return subset_name
+
+
+@pytest.fixture
+def lists(tmp_path, monkeypatch):
+    for name, text in LISTS.items():
+        (tmp_path/name).write_text(text)
+    monkeypatch.chdir(tmp_path)
+    ids = ['1ABC', '1abc', '2DEF', '2def', '3GHI', '4JKL', '5MNO', '6PQR', '7STU', '7stu', '8VWX', '9YZA']
+    rows = []
+    for i, rec in enumerate(ids):
+        for j, lig in enumerate(ids[::-1]):
+            if (i+j) % 3 == 0:
+                rows.append(('4', f'{lig}:{lig}', 1.5, 0.5, 5.0, -7.0, f'P{i}/', f'data/P{i}/{rec}', lig))
+    pd.DataFrame(rows, columns=coalescer.SCORE_COLUMNS).to_csv(tmp_path/'master.csv', index=False)
+    return tmp_path
+
+
+@pytest.mark.parametrize('names', [['plain.txt'], ['index.txt'], ['lig.txt'], ['plain.txt', 'index.txt', 'lig.txt']])
+def test_same_rows_as_filter_csv(lists, names):
+    expected = pd.read_csv(filter_csv('master.csv', names))
+    table = pd.read_csv('master.csv')
+    ours = apply_exclusions(table, names).reset_index(drop=True)
+    pd.testing.assert_frame_equal(ours, expected)
+    assert 0 < len(ours) < len(table)
+    # categorical columns, as parquet/feather tables are read, filter the same
+    cat = table.astype({'rec': 'category', 'lig': 'category'})
+    assert (keep_mask(cat, names) == keep_mask(table, names)).all()
+    # and so do the csvs the notebooks turn into dictionaries
+    assert make_dict('master.csv', has_cnnscore=True, exclude=names) == make_dict(filter_csv('master.csv', names), has_cnnscore=True)
+
+
+def test_ids_are_whole_lines(lists):
+    assert exclusion_ids(['plain.txt']) == {'1ABC', '2DEF', '3GHI'}
+    # an index line is one id, as filter_csv read it, so it never matches a table id
+    assert '4JKL' not in exclusion_ids(['index.txt'])
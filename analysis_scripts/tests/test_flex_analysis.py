@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+
+from flex_analysis import POSE_COLUMNS, cognate_atoms, join_ligand_rmsds, ligand_table
+
+prody = pytest.importorskip('prody')
+
+NAMES = ['CB', 'CG', 'CD', 'OD1', 'NE2']
+
+
+def receptor(rng, chains, resnums, drop=0.1, repeat=3):
+    # prody receptor with NAMES side chains, some atoms missing, a few repeated (alternate locations) and insertion codes
+    rows = []
+    for chain in chains:
+        for resnum in resnums:
+            icode = 'A' if resnum % 7 == 0 else ''
+            rows += [(chain, resnum, icode, name) for name in NAMES if rng.random() > drop]
+    rows += [rows[i] for i in rng.choice(len(rows), repeat, replace=False)]
+    ag = prody.AtomGroup('rec')
+    ag.setCoords(rng.normal(size=(len(rows), 3)))
+    ag.setChids([r[0] for r in rows])
+    ag.setResnums([r[1] for r in rows])
+    ag.setIcodes([r[2] for r in rows])
+    ag.setNames([r[3] for r in rows])
+    return SimpleNamespace(atoms=ag, coords=ag.getCoords(), resindices=ag.getResindices())
+
+
+def alignment(rng, rec, ligrec, shift):
+    # matchChains style (rec, ligrec) index maps: one atom per residue, residues paired with an offset, some unmapped
+    rfirst = np.unique(rec.resindices, return_index=True)[1]
+    lfirst = np.unique(ligrec.resindices, return_index=True)[1]
+    n = min(len(rfirst), len(lfirst)-shift)
+    ridx, lidx = rfirst[:n].copy(), lfirst[shift:shift+n].copy()
+    lidx[rng.random(n) < 0.1] = -1
+    return SimpleNamespace(getIndices=lambda: ridx), SimpleNamespace(getIndices=lambda: lidx), None, None
+
+
+def dict_cognate_atoms(rec, ligrec, matches, flex_atoms):
+    # cognate_atoms as it was, one dict lookup per atom
+    ratoms, latoms = rec.atoms, ligrec.atoms
+    rec_lookup = {key: i for i, key in enumerate(zip(ratoms.getChids(), ratoms.getResnums(), ratoms.getIcodes(), ratoms.getNames()))}
+    rec_idx = np.array([rec_lookup.get(atom, -1) for atom in flex_atoms], dtype=np.int64)
+    lig_lookup = {key: i for i, key in enumerate(zip(ligrec.resindices, latoms.getNames()))}
+    names = [atom[3] for atom in flex_atoms]
+    found = rec_idx >= 0
+    best = np.full(len(flex_atoms), -1, dtype=np.int64)
+    for rmap, lrmap, _, _ in matches:
+        ridx = rmap.getIndices()
+        lidx = lrmap.getIndices()
+        ok = (ridx >= 0) & (ridx < len(rec.coords)) & (lidx >= 0) & (lidx < len(ligrec.coords))
+        res_map = np.full(rec.resindices.max()+1, -1, dtype=np.int64)
+        res_map[rec.resindices[ridx[ok]]] = ligrec.resindices[lidx[ok]]
+        cognate_res = np.where(found, res_map[rec.resindices[rec_idx]], -1)
+        target = np.array([lig_lookup.get((res, name), -1) if res >= 0 else -1 for res, name in zip(cognate_res, names)], dtype=np.int64)
+        if (target >= 0).sum() > (best >= 0).sum():
+            best = target
+    return rec_idx, best
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_cognate_atoms(seed):
+    rng = np.random.default_rng(seed)
+    rec = receptor(rng, 'AB', range(1, 40))
+    ligrec = receptor(rng, 'AB', range(1, 45))
+    matches = [alignment(rng, rec, ligrec, shift) for shift in (0, 2, 5)]
+    flex = [('A', r, 'A' if r % 7 == 0 else '', name) for r in (3, 7, 14, 21, 30) for name in NAMES]
+    flex += [('B', 12, '', 'CG'), ('C', 5, '', 'CB'), ('A', 8, 'A', 'CB')]  # missing chain and insertion code
+    rec_idx, cog_idx = cognate_atoms(rec, ligrec, matches, flex)
+    exp_rec, exp_cog = dict_cognate_atoms(rec, ligrec, matches, flex)
+    np.testing.assert_array_equal(rec_idx, exp_rec)
+    np.testing.assert_array_equal(cog_idx, exp_cog)
+    assert (cog_idx >= 0).sum() > 0 and (cog_idx < 0).sum() > 0
+
+
+def test_cognate_atoms_no_flex():
+    rng = np.random.default_rng(0)
+    rec = receptor(rng, 'A', range(1, 5))
+    rec_idx, cog_idx = cognate_atoms(rec, rec, [alignment(rng, rec, rec, 0)], [])
+    assert len(rec_idx) == len(cog_idx) == 0
+
+
+def test_join_keeps_flex_poses(tmp_path):
+    flex = pd.DataFrame([('1abc', '2def', i, np.nan, np.nan, np.nan, np.nan, 2, 9, 0.5, 0.7, 0.3) for i in range(3)]
+                        + [('1abc', '3ghi', i, np.nan, np.nan, np.nan, np.nan, 1, 4, 0.2, 0.2, 0.1) for i in range(2)], columns=POSE_COLUMNS)
+    # the table has poses of pairs that were not docked flexibly, and lacks the last pose of 1abc 3ghi
+    rows = [('flex', i, 1.0+i, 0.9, 6.0, -8.0, 'P1', 'data/1abc', 'data/2def') for i in range(3)]
+    rows += [('flex', 0, 4.0, 0.2, 4.0, -5.0, 'P1', 'data/1abc', 'data/3ghi')]
+    rows += [('flex', i, 0.5, 0.99, 7.0, -9.0, 'P2', 'data/4jkl', 'data/5mno') for i in range(9)]
+    columns = ['tag', 'molids', 'rmsd', 'cnnscore', 'cnnaffinity', 'minimizedAffinity', 'pocket', 'rec', 'lig']
+    pd.DataFrame(rows, columns=columns).to_csv(tmp_path/'master.csv', index=False)
+    # the same poses of a rigid run under another tag
+    rigid = [('rigid',)+row[1:2]+(row[2]+10,)+row[3:] for row in rows]
+    pd.DataFrame(rows+rigid, columns=columns).to_csv(tmp_path/'tags.csv', index=False)
+
+    for path, tag in (('master.csv', None), ('master.csv', 'flex'), ('tags.csv', 'flex')):
+        joined = join_ligand_rmsds(flex, ligand_table(str(tmp_path/path), tag))
+        assert len(joined) == len(flex)
+        assert list(joined.columns[:8]) == ['tag', 'rec', 'lig', 'pose', 'rmsd', 'cnnscore', 'cnnaffinity', 'minimizedAffinity']
+        assert list(zip(joined['lig'], joined['pose'])) == list(zip(flex['lig'], flex['pose']))
+        np.testing.assert_array_equal(joined['rmsd'], [1.0, 2.0, 3.0, 4.0, np.nan])
+        np.testing.assert_array_equal(joined['sidechain_rmsd'], flex['sidechain_rmsd'])
+    joined = join_ligand_rmsds(flex, ligand_table(str(tmp_path/'tags.csv'), 'rigid'))
+    np.testing.assert_array_equal(joined['rmsd'], [11.0, 12.0, 13.0, 14.0, np.nan])
+    with pytest.raises(ValueError, match='flex, rigid'):
+        ligand_table(str(tmp_path/'tags.csv'))
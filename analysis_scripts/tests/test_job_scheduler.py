@@ -0,0 +1,169 @@
+import json, os
+import numpy as np
+import pytest
+
+import job_scheduler
+from gnina_jobs import parse_command
+from job_scheduler import RuntimePredictor, box_volume, ligand_features, lpt_shards
+
+
+def test_lpt_shards():
+    times = [5, 1, 4, 2, 3, 3]
+    shards, loads = lpt_shards(times, 2)
+    assert sorted(i for shard in shards for i in shard) == list(range(len(times)))
+    assert loads == [sum(times[i] for i in shard) for shard in shards]
+    assert max(loads)-min(loads) <= 1
+    for shard in shards:
+        assert list(np.asarray(times)[shard]) == sorted(np.asarray(times)[shard], reverse=True)
+
+
+def test_lpt_more_shards_than_jobs():
+    shards, loads = lpt_shards([2, 1], 4)
+    assert sorted(map(len, shards)) == [0, 0, 1, 1]
+
+
+@pytest.mark.parametrize('nshards', [0, -2])
+def test_lpt_needs_a_shard(nshards):
+    with pytest.raises(ValueError):
+        lpt_shards([1, 2, 3], nshards)
+
+
+BENCHMARK = '''\
+,model,mean
+0,Vina,20.0
+1,Crossdock Default2018,22.0
+2,Crossdock Default2018 Ensemble,30.0
+3,Default Ensemble,25.0
+4,Default Ensemble Refine,45.0
+'''
+COEF = np.array([np.log(30.0), 1.2, 0.4, 0.25, 0.9])
+
+
+def write_mol(path, coords, bonds=()):
+    lines = [os.path.basename(path), '  test', '', f'{len(coords):3d}{len(bonds):3d}  0  0  0  0  0  0  0  0999 V2000']
+    lines += [f'{x:10.4f}{y:10.4f}{z:10.4f} C   0  0  0  0  0  0  0  0  0  0  0  0' for x, y, z in coords]
+    lines += [f'{a+1:3d}{b+1:3d}  1  0' for a, b in bonds]
+    with open(path, 'w') as outfile:
+        outfile.write('\n'.join(lines+['M  END', '$$$$'])+'\n')
+    return str(path)
+
+
+def ligand(path, ring, chain):
+    # a ring of ring atoms with a chain of chain atoms hanging off it: chain-1 rotatable bonds
+    n = ring+chain
+    bonds = [(k, (k+1) % ring) for k in range(ring)]+[(k-1 if k > ring else 0, k) for k in range(ring, n)]
+    return write_mol(path, [(k, 0, 0) for k in range(n)], bonds)
+
+
+def box(path, x, y, z):
+    return write_mol(path, [(0, 0, 0), (x, y, z)])
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    rng = np.random.default_rng(11)
+    out = []
+    for k in range(30):
+        ring, chain = int(rng.integers(3, 9)), int(rng.integers(1, 8))
+        lig = ligand(tmp_path/f'lig{k}.sdf', ring, chain)
+        autobox = box(tmp_path/f'box{k}.sdf', *rng.uniform(2, 30, 3))
+        exh = [4, 8, 16, 32][k % 4]
+        out.append(parse_command(f'gnina -r rec.pdb -l {lig} --autobox_ligand {autobox} --exhaustiveness {exh} '
+                                 f'--cnn_scoring none --out out{k}.sdf.gz'))
+    return out
+
+
+def predictor(tmp_path):
+    path = tmp_path/'gpu_models.csv'
+    path.write_text(BENCHMARK)
+    return RuntimePredictor([str(path)])
+
+
+def write_journal(path, recs):
+    with open(path, 'w') as outfile:
+        for rec in recs:
+            outfile.write(json.dumps(rec)+'\n')
+    return str(path)
+
+
+def test_ligand_features(tmp_path):
+    assert ligand_features(ligand(tmp_path/'a.sdf', 6, 4)) == (10, 3)
+    assert ligand_features(ligand(tmp_path/'b.sdf', 5, 1)) == (6, 0)
+    assert box_volume(box(tmp_path/'box.sdf', 2, 4, 6), 1) == pytest.approx(4*6*8)
+
+
+def test_calibrate_benchmark(tmp_path):
+    pred = predictor(tmp_path)
+    assert pred.coef[0] == pytest.approx(np.log(20.0))
+    costs = pred.model_cost['gpu']
+    assert costs['crossdock_default2018'] == pytest.approx(2.0)
+    assert costs['crossdock_default2018_3'] == pytest.approx((30-20-2)/4)
+    assert pred.refine_factor == pytest.approx({'gpu': 25/5, 'cpu': 1.0})
+    cpu = tmp_path/'nogpu_models.csv'
+    cpu.write_text(',model,mean\n0,Vina,40.0\n1,Crossdock Default2018,50.0\n')
+    pred.calibrate_benchmark(str(cpu), 'cpu')
+    # a cpu csv does not move the vina time and without refine rows takes the gpu factor
+    assert pred.coef[0] == pytest.approx(np.log(20.0))
+    assert pred.model_cost['cpu'] == {'crossdock_default2018': 10.0}
+    assert pred.refine_factor['cpu'] == pytest.approx(5.0)
+    tokens = ['gnina', '--cnn', 'crossdock_default2018', 'crossdock_default2018_1', '--cnn_scoring', 'refinement', '--exhaustiveness', '16']
+    assert pred.cnn_cost(tokens) == pytest.approx((2+2)*5*2)
+    assert pred.cnn_cost(tokens+['--no_gpu']) == pytest.approx((10+10)*5*2)
+
+
+def test_predict(tmp_path, jobs):
+    pred = predictor(tmp_path)
+    pred.set_reference(jobs)
+    feats = np.array([pred.job_features(job.tokens) for job in jobs])
+    ref = [np.log(feats[:, 0]).mean(), np.log1p(feats[:, 1]).mean(), np.log(feats[:, 2]).mean()]
+    np.testing.assert_allclose(pred.ref, ref)
+    h0, r0, v0 = np.exp(ref[0]), np.exp(ref[1])-1, np.exp(ref[2])
+    a, b, c, d = pred.coef[1:]
+    expected = 20*(feats[:, 0]/h0)**a*((1+feats[:, 1])/(1+r0))**b*(feats[:, 2]/v0)**c*(feats[:, 3]/8)**d
+    np.testing.assert_allclose(pred.predict(jobs), expected)
+    rescore = [parse_command(job.line.replace('--cnn_scoring none', '--cnn crossdock_default2018')) for job in jobs]
+    np.testing.assert_allclose(pred.predict(rescore), expected+2)
+
+
+def test_fit(tmp_path, jobs):
+    truth = predictor(tmp_path)
+    truth.set_reference(jobs)
+    truth.coef = COEF.copy()
+    # half of the runs used a CNN model, whose benchmark cost fit() takes off the elapsed time
+    runs = [parse_command(job.line.replace('--cnn_scoring none', '--cnn crossdock_default2018')) if k % 2 else job
+            for k, job in enumerate(jobs)]
+    recs = [{'out': job.out, 'status': 'done', 'elapsed': float(t), 'cmd': job.line} for job, t in zip(runs, truth.predict(runs))]
+    # failed runs, runs faster than their CNN cost and records of removed ligands are left out
+    noise = [dict(recs[0], status='failed', elapsed=1e6),
+             dict(recs[1], elapsed=1.0),
+             dict(recs[2], cmd=recs[2]['cmd'].replace('lig2.sdf', 'gone.sdf'), elapsed=1e6)]
+    journals = [write_journal(tmp_path/'a.journal', recs[:15]+noise[:2]),
+                write_journal(tmp_path/'b.journal', noise[2:]+recs[15:])]
+    with open(journals[1], 'a') as outfile:
+        outfile.write('{"out": "torn')
+
+    pred = predictor(tmp_path)
+    pred.set_reference(jobs)
+    assert pred.fit(journals) == len(jobs)
+    np.testing.assert_allclose(pred.coef, COEF)
+    np.testing.assert_allclose(pred.predict(jobs), truth.predict(jobs))
+
+    # too few records keeps the benchmark defaults
+    pred = predictor(tmp_path)
+    pred.set_reference(jobs)
+    before = pred.coef.copy()
+    assert pred.fit([write_journal(tmp_path/'c.journal', recs[:5])]) == 5
+    np.testing.assert_array_equal(pred.coef, before)
+
+
+def test_no_jobs(tmp_path, jobs):
+    pred = predictor(tmp_path)
+    pred.set_reference(jobs)
+    ref = pred.ref.copy()
+    pred.set_reference([])
+    np.testing.assert_array_equal(pred.ref, ref)
+    assert len(pred.predict([])) == 0
+    (tmp_path/'empty.txt').write_text('')
+    out = tmp_path/'ordered.txt'
+    job_scheduler.main(['-i', str(tmp_path/'empty.txt'), '-o', str(out), '--benchmarks', str(tmp_path/'gpu_models.csv')])
+    assert out.read_text() == ''
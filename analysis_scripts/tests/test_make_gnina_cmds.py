@@ -0,0 +1,127 @@
+'''
+make_gnina_cmds.py: the combinations of every --mode, and --dedupe/--previous/--registry reusing
+outputs through canonical commands.
+'''
+
+import os
+import pytest
+
+import make_gnina_cmds
+from gnina_jobs import canonical_command, parse_command, read_commands
+
+PAIRS = [('P1/1abc_PRO.pdb', 'P1/2def_LIG.sdf', 'P1/2def_LIG.sdf', 'P1/1abc_PRO_2def_LIG_'),
+         ('P2/3ghi_PRO.pdb', 'P2/4jkl_LIG.sdf', 'P2/4jkl_LIG.sdf', 'P2/3ghi_PRO_4jkl_LIG_')]
+
+
+@pytest.fixture
+def pairs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('pairs.txt', 'w') as outfile:
+        for pair in PAIRS:
+            outfile.write(' '.join(pair)+'\n')
+    return tmp_path
+
+
+def run(*argv):
+    make_gnina_cmds.main(['-i', 'pairs.txt']+list(argv))
+    output = argv[argv.index('-o')+1]
+    return [job.line for job in read_commands(output)]
+
+
+def configs(cmds):
+    # (option, value) pairs given to gnina after --out, per command
+    out = []
+    for line in cmds:
+        tokens = line.split()
+        rest = tokens[tokens.index('--out')+2:]
+        out.append(tuple(zip(rest[::2], rest[1::2])))
+    return out
+
+
+def test_oat_and_grid(pairs):
+    options = ['--exhaustiveness', '4', '16', '--num_modes', '9', '20', '30']
+    oat = run('-o', 'oat.txt', *options)
+    assert len(oat) == 5*len(PAIRS)
+    grid = run('-o', 'grid.txt', '--mode', 'grid', *options)
+    assert len(grid) == 2*3*len(PAIRS)
+    assert sorted(set(configs(grid))) == sorted((('--exhaustiveness', e), ('--num_modes', n)) for e in ('4', '16') for n in ('9', '20', '30'))
+    assert parse_command(grid[0]).out == 'P1/1abc_PRO_2def_LIG_default_ensemble_rescore_exhaustiveness4_num_modes9.sdf.gz'
+    # no options at all docks with gnina's defaults
+    defaults = run('-o', 'defaults.txt', '--mode', 'grid')
+    assert [parse_command(line).out for line in defaults] == [p[3]+'default_ensemble_rescore_defaults.sdf.gz' for p in PAIRS]
+
+
+@pytest.mark.parametrize('mode', ['lhs', 'random'])
+def test_sampling_reproducible(pairs, mode):
+    options = ['--exhaustiveness', '1', '2', '4', '8', '16', '--cnn_rotation', '0', '4', '8', '12', '16', '--num_modes', '9', '20']
+    first = run('-o', 'a.txt', '--mode', mode, '--samples', '5', *options)
+    again = run('-o', 'b.txt', '--mode', mode, '--samples', '5', *options)
+    other = run('-o', 'c.txt', '--mode', mode, '--samples', '5', '--sample_seed', '7', *options)
+    assert first == again
+    assert first != other
+    found = configs(first)[::len(PAIRS)]
+    assert 0 < len(found) <= 5
+    assert len(set(found)) == len(found)
+    for config in found:
+        assert [flag for flag, _ in config] == ['--exhaustiveness', '--cnn_rotation', '--num_modes']
+
+
+def test_lhs_strata(pairs):
+    # with as many samples as values every value of an option is used exactly once
+    values = ['1', '2', '4', '8', '16', '32']
+    cmds = run('-o', 'lhs.txt', '--mode', 'lhs', '--samples', '6', '--exhaustiveness', *values, '--cnn_rotation', '0', '2', '4', '6', '8', '10')
+    found = configs(cmds)[::len(PAIRS)]
+    assert sorted(dict(c)['--exhaustiveness'] for c in found) == sorted(values)
+    assert sorted(dict(c)['--cnn_rotation'] for c in found) == sorted(['0', '2', '4', '6', '8', '10'])
+
+
+def test_canonical_command():
+    base = 'gnina -r P1/rec.pdb -l P1/lig.sdf --autobox_ligand P1/lig.sdf --cnn_scoring rescore --cpu 1 --seed 420 --out a.sdf.gz --exhaustiveness 16 --cnn dense crossdock_default2018'
+    same = ['gnina --seed 420 --cnn crossdock_default2018 dense --exhaustiveness 16.0 --autobox_ligand ./P1/lig.sdf -l P1/../P1/lig.sdf '
+            '--receptor P1/rec.pdb --out b.sdf.gz --cpu 4',
+            base+' --num_modes 9 --autobox_add 4']  # gnina's defaults spelled out
+    different = [base.replace('--exhaustiveness 16', '--exhaustiveness 32'), base.replace('--seed 420', '--seed 1'),
+                 base.replace('dense crossdock', 'dense_1 crossdock'), base.replace('P1/rec.pdb', 'P2/rec.pdb')]
+    key = canonical_command(parse_command(base).tokens)
+    for line in same:
+        assert canonical_command(parse_command(line).tokens) == key
+    for line in different:
+        assert canonical_command(parse_command(line).tokens) != key
+
+
+def test_dedupe_previous(pairs):
+    first = run('-o', 'first.txt')
+    # exhaustiveness 8 is gnina's default, so those commands dock the same as first.txt
+    second = run('-o', 'second.txt', '--exhaustiveness', '8', '16', '--previous', 'first.txt')
+    assert len(second) == len(PAIRS)
+    assert all('--exhaustiveness 16' in line for line in second)
+    reused = [job.line for job in read_commands('second.txt.reused')]
+    assert len(reused) == len(PAIRS)
+    for line, target in zip(reused, first):
+        out, target = parse_command(line).out, parse_command(target).out
+        assert '--exhaustiveness 8' in line
+        assert os.path.islink(out)
+        assert os.path.normpath(os.path.join(os.path.dirname(out), os.readlink(out))) == os.path.normpath(target)
+
+
+def test_dedupe_within_file(pairs):
+    cmds = run('-o', 'cmds.txt', '--dedupe', '--exhaustiveness', '8', '--num_modes', '9', '20')
+    # exhaustiveness 8 and num_modes 9 are both gnina's defaults
+    assert len(cmds) == 2*len(PAIRS)
+    assert len(list(read_commands('cmds.txt.reused'))) == len(PAIRS)
+
+
+def test_registry(pairs):
+    assert len(run('-o', 'a.txt', '--registry', 'reg.jsonl', '--exhaustiveness', '16')) == len(PAIRS)
+    # the same job under another name is reused, the same command is run again
+    assert run('-o', 'b.txt', '--registry', 'reg.jsonl', '--exhaustiveness', '16.0', '32') == run('-o', 'c.txt', '--exhaustiveness', '32')
+    assert len(list(read_commands('b.txt.reused'))) == len(PAIRS)
+    assert run('-o', 'd.txt', '--registry', 'reg.jsonl', '--exhaustiveness', '16') == run('-o', 'e.txt', '--exhaustiveness', '16')
+    assert not list(read_commands('d.txt.reused'))
+
+
+def test_default_output_unchanged(pairs):
+    # without any dedupe option the command file is written as before and there is no .reused file
+    cmds = run('-o', 'plain.txt', '--exhaustiveness', '8', '8')
+    assert len(cmds) == 2*len(PAIRS)
+    assert not os.path.exists('plain.txt.reused')
@@ -0,0 +1,125 @@
+'''
+pocketdiff.calc_pocket_rmsd against the loop it replaced (prody selection, set lookups and
+prody.calcRMSD in a try/except) on ubiquitin and four altered copies of it, to the last bit.
+'''
+
+import os, shutil
+import numpy as np
+import pytest
+
+prody = pytest.importorskip('prody')
+pytest.importorskip('openbabel')
+
+import pocketdiff
+from pocketdiff import CUTOFFS, calc_pocket_rmsd, process_pair
+
+UBIQUITIN = os.path.join(os.path.dirname(prody.__file__), 'tests', 'datafiles', 'pdb1ubi.pdb')
+# the hydrophobic patch: Leu8, Ile44, Val70
+PATCH = 'resnum 8 44 70 and not name N C O CA'
+
+
+def baseline_pocket_rmsd(rec, lig, root):
+    # calc_pocket_rmsd and match_chains before the KD-tree version
+    from openbabel import pybel
+
+    rec = prody.parsePDB(os.path.join(root, rec))
+    ligrec = prody.parsePDB(os.path.join(root, lig.replace('LIG_aligned.sdf', 'PRO.pdb')))
+    c = np.array([a.coords for a in next(pybel.readfile('sdf', os.path.join(root, lig))).atoms])
+    nearby = rec.select('protein and same residue as within 3.5 of point', point=c)
+    matches = []
+    for cutoff in CUTOFFS:
+        m = prody.matchChains(rec, ligrec, subset='all', overlap=cutoff, seqid=cutoff, pwalign=True)
+        if m:
+            matches += m
+    minrmsd = np.inf
+    minbackrmsd = np.inf
+    for rmap, lrmap, _, _ in matches:
+        try:
+            closeatoms = set(nearby.getIndices())
+            lratoms = []
+            ratoms = []
+            for i, idx in enumerate(rmap.getIndices()):
+                if idx in closeatoms:
+                    lratoms.append(lrmap.getIndices()[i])
+                    ratoms.append(idx)
+            if len(lratoms) == 0:
+                continue
+            rmsd = prody.calcRMSD(rec[ratoms], ligrec[lratoms])
+            backrmsd = prody.calcRMSD(rec[ratoms] & rec.ca, ligrec[lratoms] & ligrec.ca)
+            if rmsd < minrmsd:
+                minrmsd = rmsd
+                minbackrmsd = backrmsd
+        except:
+            pass
+    return minrmsd, minbackrmsd
+
+
+def write_ligand(path, coords):
+    lines = [os.path.basename(path), '  test', '', f'{len(coords):3d}  0  0  0  0  0  0  0  0  0999 V2000']
+    lines += [f'{x:10.4f}{y:10.4f}{z:10.4f} C   0  0  0  0  0  0  0  0  0  0  0  0' for x, y, z in coords]
+    with open(path, 'w') as outfile:
+        outfile.write('\n'.join(lines+['M  END', '$$$$'])+'\n')
+
+
+@pytest.fixture(scope='module')
+def structures(tmp_path_factory):
+    root = tmp_path_factory.mktemp('pocketdiff')
+    rng = np.random.default_rng(2)
+    ubi = prody.parsePDB(UBIQUITIN)
+
+    jitter = ubi.copy()
+    jitter.setCoords(jitter.getCoords()+rng.normal(0, 0.3, jitter.getCoords().shape))
+    # a loop missing, so the chains only match in pieces
+    gap = ubi.select('not resnum 31 to 35').copy()
+    # point mutations in and next to the pocket, lowering the sequence identity
+    mutant = ubi.copy()
+    for resnum, name in ((8, 'ALA'), (42, 'LYS'), (70, 'ILE'), (12, 'SER')):
+        mutant.select(f'resnum {resnum}').setResnames(name)
+    # moved as a whole, with side chain atoms of pocket residues missing
+    moved = ubi.select('not (resnum 44 and name CD1) and not (resnum 70 and name CG2)').copy()
+    a = np.radians(10)
+    rot = np.array([[np.cos(a), -np.sin(a), 0], [np.sin(a), np.cos(a), 0], [0, 0, 1]])
+    moved.setCoords(moved.getCoords() @ rot.T+[0.8, -0.5, 0.3])
+
+    names = []
+    for code, atoms in (('1ubi', None), ('2jit', jitter), ('3gap', gap), ('4mut', mutant), ('5mov', moved)):
+        if atoms is None:
+            shutil.copy(UBIQUITIN, root/f'{code}_PRO.pdb')
+            atoms = ubi
+        else:
+            prody.writePDB(str(root/f'{code}_PRO.pdb'), atoms)
+        # a ligand over the patch, in the frame of its own receptor
+        write_ligand(root/f'{code}_LIG_aligned.sdf', atoms.select(PATCH).getCoords()+[0.0, 0.0, 1.5])
+        names.append(code)
+    return str(root), names
+
+
+def test_matches_baseline(structures):
+    root, names = structures
+    for rec in names:
+        for lig in names:
+            pair = (f'{rec}_PRO.pdb', f'{lig}_LIG_aligned.sdf')
+            expected = baseline_pocket_rmsd(*pair, root)
+            ours = calc_pocket_rmsd(*pair, root)
+            assert ours == expected, pair
+            if rec == lig:
+                assert ours == (0.0, 0.0)
+            elif lig == '5mov':
+                # the maps onto a receptor with atoms missing hold dummy atoms, which calcRMSD rejected
+                assert ours == (np.inf, np.inf)
+            else:
+                assert np.isfinite(ours).all()
+
+
+def test_early_stop(structures):
+    # every copy shares most of its sequence, so stopping at the first good cutoff finds the same match
+    root, names = structures
+    for rec in names[1:]:
+        pair = ('1ubi_PRO.pdb', f'{rec}_LIG_aligned.sdf')
+        assert calc_pocket_rmsd(*pair, root, early_stop=60) == calc_pocket_rmsd(*pair, root)
+
+
+def test_missing_structure(structures):
+    root, _ = structures
+    pocketdiff.load_receptor.cache_clear()
+    assert process_pair(('1ubi_PRO.pdb', '9xxx_LIG_aligned.sdf'), root) == ('1ubi_PRO.pdb', '9xxx_LIG_aligned.sdf', np.inf, np.inf)
@@ -0,0 +1,49 @@
+import glob, json, os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('matplotlib')
+from coalescer import SCORE_COLUMNS
+from render_figures import main
+
+
+@pytest.fixture
+def spec(tmp_path):
+    rng = np.random.default_rng(0)
+    rows = [(tag, '', rng.uniform(0, 5), 0.5, 5.0, -7.0, 'P/', f'R{s}', f'L{s}')
+            for tag in (4, 8) for s in range(6) for _ in range(int(rng.integers(1, 5)))]
+    pd.DataFrame(rows, columns=SCORE_COLUMNS).to_csv(tmp_path/'master.csv', index=False)
+    pd.DataFrame({'SumA': [50, 70, 80]}, index=[1, 2, 3]).to_csv(tmp_path/'summary.csv')
+    path = tmp_path/'spec.json'
+    path.write_text(json.dumps({
+        'cache': 'cache',
+        'defaults': {'num_unique': 6, 'compare_paths': ['master.csv']},
+        'figures': [{'figname': 'out/a', 'line_graph': True, 'bar_graph': True, 'compare_names': ['e4', 'e8']},
+                    {'figname': 'out/b', 'line_graph': True, 'compare_names': ['e4', 'e8', 'Summary'], 'summary_paths': ['summary.csv']}]}))
+    os.makedirs(tmp_path/'out')
+    return tmp_path
+
+
+def test_renders_only_what_changed(spec, capsys):
+    main([str(spec/'spec.json'), '-j', '2'])
+    out = capsys.readouterr().out
+    assert '2 of 2 figures to render, 1 TopN tables to compute' in out
+    for name in ('a_line', 'a_bar', 'b_line'):
+        assert (spec/'out'/f'{name}.png').exists()
+    # what the workers printed comes out of the main process, after each figure
+    assert f"rendered {spec/'out'/'b_line.png'}\ne4: 4\ne8: 8\nSummary: {spec/'summary.csv'}\n" in out
+
+    main([str(spec/'spec.json'), '-j', '2'])
+    assert '0 of 2 figures to render, 0 TopN tables to compute' in capsys.readouterr().out
+
+    # a deleted TopN table is computed again, and the figures using it are rendered again
+    for name in glob.glob(str(spec/'cache'/'topn-*.csv')):
+        os.remove(name)
+    main([str(spec/'spec.json'), '-j', '2'])
+    assert '2 of 2 figures to render, 1 TopN tables to compute' in capsys.readouterr().out
+    assert len(glob.glob(str(spec/'cache'/'topn-*.csv'))) == 1
+
+    (spec/'out'/'a_bar.png').unlink()
+    main([str(spec/'spec.json'), '-j', '2'])
+    assert '1 of 2 figures to render, 0 TopN tables to compute' in capsys.readouterr().out
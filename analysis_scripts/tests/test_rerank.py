@@ -0,0 +1,90 @@
+'''
+rerank.threshold_topn against filtering the table at every cutoff and computing TopN of what is
+left, as the thresh_cnnscore_*/thresh_cnnaffinity_* notebook cells did.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rerank import threshold_topn
+
+CUTS = np.linspace(0, 1, 11)
+RANKINGS = ['file', 'cnnaffinity', 'minimizedAffinity']
+MAX_N = 3
+
+
+@pytest.fixture(scope='module')
+def table():
+    rng = np.random.default_rng(5)
+    rows = []
+    for s in range(40):
+        pocket = f'P{s % 4}'
+        for k in range(int(rng.integers(1, 9))):
+            rows.append((pocket, f'R{s}', f'L{s}', rng.choice([0.5, 1.5, 2.0, 2.5, 4.0]),
+                         rng.choice(CUTS),  # scores tied with each other and with the cutoffs
+                         rng.choice([5.0, 5.5, 6.0, 6.5]), rng.choice([-9.0, -8.0, -7.0])))
+    df = pd.DataFrame(rows, columns=['pocket', 'rec', 'lig', 'rmsd', 'cnnscore', 'cnnaffinity', 'minimizedAffinity'])
+    df.loc[rng.random(len(df)) < 0.1, 'cnnscore'] = np.nan
+    return df.iloc[rng.permutation(len(df))].reset_index(drop=True)
+
+
+def ranked(df, ranking):
+    # poses of every system best first, ties in table order
+    if ranking == 'file':
+        return df
+    return df.sort_values(ranking, ascending=ranking == 'minimizedAffinity', kind='stable')
+
+
+def naive(df, ranking, mode, per_pocket, max_n=MAX_N):
+    '''
+    (cutoffs x max_n) TopN, left and systems left by filtering at every cutoff.
+    '''
+
+    systems = ['pocket', 'rec', 'lig']
+    good = np.full((len(CUTS), max_n), np.nan)
+    left = np.zeros(len(CUTS))
+    systems_left = np.zeros(len(CUTS))
+    nsys = len(df.groupby(systems))
+    for c, cut in enumerate(CUTS):
+        if mode == 'pose':
+            # the notebook's df[df.cnnscore > cut], which drops NaN scores too
+            kept = ranked(df[df['cnnscore'] > cut], ranking)
+            left[c] = len(kept)/len(df)*100
+        else:
+            top = ranked(df, ranking).groupby(systems, sort=False).head(1)
+            keys = top[top['cnnscore'] >= cut][systems]
+            kept = ranked(df, ranking).merge(keys, on=systems)
+            left[c] = len(keys)/nsys*100
+        if not len(kept):
+            continue
+        rank = kept.groupby(systems, sort=False).cumcount()
+        for n in range(max_n):
+            hit = (kept['rmsd'] < 2) & (rank <= n)
+            per_system = hit.groupby([kept[k] for k in systems]).any()
+            if per_pocket:
+                good[c, n] = per_system.groupby(level='pocket').mean().mean()*100
+            else:
+                good[c, n] = per_system.mean()*100
+        systems_left[c] = len(per_system)
+    return good, left, systems_left
+
+
+@pytest.mark.parametrize('mode', ['pose', 'system'])
+@pytest.mark.parametrize('per_pocket', [False, True])
+def test_matches_filtering(table, mode, per_pocket):
+    res = threshold_topn(table, RANKINGS, 'cnnscore', CUTS, MAX_N, mode, pocket_key='pocket' if per_pocket else None)
+    np.testing.assert_array_equal(res.thresholds, CUTS)
+    assert res.rankings == RANKINGS
+    for r, ranking in enumerate(RANKINGS):
+        good, left, systems_left = naive(table, ranking, mode, per_pocket)
+        np.testing.assert_allclose(res.good[r], good, rtol=1e-12)
+        np.testing.assert_allclose(res.left[r], left, rtol=1e-12)
+        np.testing.assert_array_equal(res.systems_left[r], systems_left)
+
+
+def test_unsorted_cutoffs(table):
+    # cutoffs come back sorted
+    res = threshold_topn(table, ['file'], 'cnnscore', CUTS[::-1], 2)
+    np.testing.assert_array_equal(res.thresholds, CUTS)
+    np.testing.assert_allclose(res.good[0], naive(table, 'file', 'pose', False, 2)[0], rtol=1e-12)
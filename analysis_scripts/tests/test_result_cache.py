@@ -0,0 +1,141 @@
+'''
+result_cache.py: what goes into a key, the gnina version lookup, and least recently used eviction.
+'''
+
+import os, stat
+import pytest
+
+import make_gnina_cmds
+import result_cache
+from gnina_jobs import parse_command
+from result_cache import ResultCache, file_digest, gnina_version, job_key, parse_size
+from run_gnina_cmds import select_cached
+
+VERSION = 'gnina v1.1 master:e4cba9d+   Built Jan 1 2024.'
+
+
+def stub_gnina(path, body):
+    path.write_text('#!/bin/sh\n'+body+'\n')
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    return str(path)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    (tmp_path/'rec.pdb').write_text('ATOM      1  CA  ALA A   1\n')
+    (tmp_path/'lig.sdf').write_text('lig\n')
+    return tmp_path
+
+
+def command(root, out='out.sdf.gz', extra=''):
+    return (f'gnina -r {root}/rec.pdb -l {root}/lig.sdf --autobox_ligand {root}/lig.sdf --cnn_scoring rescore '
+            f'--cpu 1 --seed 420 --out {root}/{out}{extra}')
+
+
+def key(line, version=VERSION, batch=None):
+    return job_key(parse_command(line).tokens, version, batch)
+
+
+def test_gnina_version(tmp_path):
+    exe = stub_gnina(tmp_path/'gnina', f'echo "{VERSION}"; echo second line')
+    assert gnina_version(exe) == VERSION
+    with pytest.raises(RuntimeError, match='--gnina_version'):
+        gnina_version(str(tmp_path/'missing'))
+    with pytest.raises(RuntimeError, match='exited with 3'):
+        gnina_version(stub_gnina(tmp_path/'broken', 'exit 3'))
+    with pytest.raises(RuntimeError, match='--gnina_version'):
+        gnina_version(stub_gnina(tmp_path/'silent', 'true'))
+
+
+def test_key_stable(inputs):
+    base = key(command(inputs))
+    # output name, threading, option order and spelled out defaults are not part of the job
+    assert key(command(inputs, 'other.sdf.gz')) == base
+    assert key(command(inputs).replace('--cpu 1', '--cpu 8')) == base
+    assert key(command(inputs, extra=' --exhaustiveness 8')) == base
+    reordered = f'gnina --seed 420 --autobox_ligand {inputs}/lig.sdf -l {inputs}/lig.sdf --receptor {inputs}/rec.pdb --out x.sdf.gz'
+    assert key(reordered) == base
+    # inputs are keyed by content, not by path
+    os.makedirs(inputs/'copy')
+    for name in ('rec.pdb', 'lig.sdf'):
+        (inputs/'copy'/name).write_bytes((inputs/name).read_bytes())
+    assert key(command(inputs/'copy')) == base
+
+
+def test_key_invalidated(inputs):
+    base = key(command(inputs))
+    assert key(command(inputs, extra=' --exhaustiveness 16')) != base
+    assert key(command(inputs).replace('--seed 420', '--seed 1')) != base
+    assert key(command(inputs), 'gnina v1.2') != base
+    assert key(command(inputs), batch={'members': ['a', 'b'], 'index': 0}) != base
+    assert key(command(inputs), batch={'members': ['a', 'b'], 'index': 1}) != key(command(inputs), batch={'members': ['a', 'b'], 'index': 0})
+    # a changed receptor is a new job even though the command is the same
+    st = os.stat(inputs/'rec.pdb')
+    (inputs/'rec.pdb').write_text('ATOM      1  CA  GLY A   1\n')
+    os.utime(inputs/'rec.pdb', ns=(st.st_atime_ns, st.st_mtime_ns+10**9))
+    assert key(command(inputs)) != base
+    assert file_digest(str(inputs/'missing.pdb')).startswith('missing:')
+
+
+def test_store_lookup_link(inputs):
+    cache = ResultCache(str(inputs/'cache'))
+    out = str(inputs/'out.sdf.gz')
+    with open(out, 'wb') as outfile:
+        outfile.write(b'poses')
+    k = key(command(inputs))
+    assert cache.lookup(k, out) is None
+    path = cache.store(k, out)
+    assert os.path.islink(out) and os.readlink(out) == path
+    assert cache.lookup(k, str(inputs/'elsewhere.sdf.gz')) == path
+    cache.link(path, str(inputs/'elsewhere.sdf.gz'))
+    with open(inputs/'elsewhere.sdf.gz', 'rb') as infile:
+        assert infile.read() == b'poses'
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path/'cache'), max_bytes=250)
+    paths = []
+    for i in range(4):
+        path = cache.object_path(f'{i:02d}'+'f'*62)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as outfile:
+            outfile.write(b'x'*100)
+        os.utime(path, (1000+i, 1000+i))
+        paths.append(path)
+    # using the oldest object makes it the most recent
+    assert cache.lookup(os.path.basename(paths[0])[:-len('.sdf.gz')], 'a.sdf.gz') == paths[0]
+    assert cache.evict() == (2, 200)
+    assert [os.path.exists(p) for p in paths] == [True, False, False, True]
+    assert cache.evict(1000) == (0, 0)
+    assert ResultCache(str(tmp_path/'cache')).evict() == (0, 0)  # no limit
+    assert cache.evict(0) == (2, 200)
+    assert cache.objects() == []
+
+
+def test_parse_size():
+    assert parse_size('500') == 500
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5g') == 3*2**29
+    assert parse_size('200GB') == 200*2**30
+    assert parse_size(None) is None
+
+
+def test_no_version_no_key(inputs, monkeypatch):
+    # without a runnable gnina the key is not made up, an explicit version is used as given
+    result_cache.gnina_version.cache_clear()
+    monkeypatch.setenv('PATH', str(inputs/'empty'))
+    jobs = [parse_command(command(inputs))]
+    cache = ResultCache(str(inputs/'cache'))
+    with pytest.raises(RuntimeError):
+        select_cached(jobs, {}, cache)
+    todo, keys, hits = select_cached(jobs, {}, cache, version=VERSION)
+    assert (todo, hits) == (jobs, 0)
+    assert keys == {jobs[0].out: key(command(inputs))}
+
+    monkeypatch.chdir(inputs)
+    (inputs/'pairs.txt').write_text('rec.pdb lig.sdf lig.sdf P_\n')
+    with pytest.raises(SystemExit):
+        make_gnina_cmds.main(['-i', 'pairs.txt', '-o', 'cmds.txt', '--cache', 'cache'])
+    assert not os.path.exists('cmds.txt')
+    make_gnina_cmds.main(['-i', 'pairs.txt', '-o', 'cmds.txt', '--cache', 'cache', '--gnina_version', VERSION])
+    assert len(open('cmds.txt').readlines()) == 1
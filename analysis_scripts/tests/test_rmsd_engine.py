@@ -0,0 +1,224 @@
+'''
+rmsd_engine against obrms. The obrms binary is run itself when it can be found (on the PATH or
+shipped with the openbabel wheel), called as obrms_calc.py used to: obrms <poses> <reference>.
+Without it, ob_rms below does what obrms does with Open Babel: processMol (delete hydrogens, make
+every bond a single non-aromatic ring bond and every atom a non-aromatic ring atom, so molecules
+match on connectivity alone), map the reference's molecule query onto every pose with
+OBIsomorphismMapper and take the minimum RMSD over the mappings without superposition. Both read
+the same 4 decimal coordinates, so they agree to TOL.
+'''
+
+import gzip, os, shutil, subprocess
+import numpy as np
+import pytest
+
+pybel = pytest.importorskip('openbabel.pybel')
+import openbabel
+from openbabel import openbabel as ob
+from rmsd_engine import RMSDCalculator, batch_rmsd
+from sdf_stream import records
+
+TOL = 1e-4  # Angstrom
+
+LIGANDS = {
+    'acetate': 'CC(=O)[O-]',  # the two oxygens are equivalent to obrms
+    'aminobenzoate': 'Nc1ccc(cc1)C(=O)[O-]',  # carboxylate and para phenyl flip
+    'benzoic_acid': 'OC(=O)c1ccccc1',
+    'biphenyl': 'c1ccc(cc1)-c1ccc(cc1)C(=O)O',
+    'tbutylbenzene': 'CC(C)(C)c1ccccc1',  # 12 automorphisms
+    'glutamate': '[NH3+][C@@H](CCC(=O)[O-])C(=O)[O-]',
+}
+
+OBRMS = shutil.which('obrms') or os.path.join(os.path.dirname(openbabel.__file__), 'bin', 'obrms')
+if not os.access(OBRMS, os.X_OK):
+    OBRMS = None
+
+
+def run_obrms(ref_path, pose_path):
+    # the obrms lines for every pose, the wheel's binary finds its plugins through the
+    # BABEL_LIBDIR that importing openbabel sets
+    out = subprocess.run([OBRMS, pose_path, ref_path], capture_output=True, text=True, check=True).stdout
+    return [line for line in out.splitlines() if line.startswith('RMSD ')]
+
+
+def process_mol(mol):
+    # processMol of obrms.cpp
+    mol.DeleteHydrogens()
+    for atom in ob.OBMolAtomIter(mol):
+        atom.SetAromatic(False)
+        atom.SetInRing()
+    for bond in ob.OBMolBondIter(mol):
+        bond.SetAromatic(False)
+        bond.SetBondOrder(1)
+        bond.SetInRing()
+    mol.SetHybridizationPerceived()
+    mol.SetRingAtomsAndBondsPerceived()
+    mol.SetAromaticPerceived()
+
+
+def ob_rms(ref_path, pose_path):
+    ref = next(pybel.readfile('sdf', ref_path))
+    process_mol(ref.OBMol)
+    mapper = ob.OBIsomorphismMapper.GetInstance(ob.CompileMoleculeQuery(ref.OBMol))
+    ref_xyz = np.array([a.coords for a in ref.atoms])
+    out = []
+    for pose in pybel.readfile('sdf', pose_path):
+        process_mol(pose.OBMol)
+        xyz = np.array([a.coords for a in pose.atoms])
+        maps = ob.vvpairUIntUInt()
+        mapper.MapAll(pose.OBMol, maps)
+        best = np.inf
+        for m in maps:
+            i, j = np.array(list(m)).T
+            best = min(best, np.sqrt(((ref_xyz[i]-xyz[j])**2).sum(axis=1).mean()))
+        out.append(best)
+    return np.array(out)
+
+
+def obrms(ref_path, pose_path):
+    # RMSD of every pose by obrms itself, or by ob_rms if the binary is not there
+    if OBRMS is None:
+        return ob_rms(ref_path, pose_path)
+    return np.array([float(line.rsplit(' ', 1)[1]) for line in run_obrms(ref_path, pose_path)])
+
+
+def automorphism_perms(mol):
+    # heavy atom permutations of the (hydrogen free) molecule from Open Babel, on connectivity
+    # alone like obrms
+    graph = ob.OBMol(mol.OBMol)
+    process_mol(graph)
+    maps = ob.vvpairUIntUInt()
+    ob.FindAutomorphisms(graph, maps)
+    perms = []
+    for m in maps:
+        perm = np.zeros(len(m), dtype=int)
+        for i, j in m:
+            perm[i] = j
+        perms.append(perm)
+    return perms
+
+
+def write_case(tmp_path, name, smiles, nposes=12, shuffle=False, swap=True, seed=0):
+    '''
+    Reference sdf and an sdf.gz of poses: the reference with noise, with symmetric atoms
+    swapped (swap), rotated and translated, and (shuffle) atoms written in another order.
+    '''
+
+    rng = np.random.default_rng(seed)
+    mol = pybel.readstring('smi', smiles)
+    mol.make3D()
+    mol.removeh()
+    ref_path = str(tmp_path/f'{name}_ref.sdf')
+    mol.title = name
+    mol.write('sdf', ref_path, overwrite=True)
+    xyz = np.array([a.coords for a in mol.atoms])
+    perms = automorphism_perms(mol) if swap else [np.arange(len(xyz))]
+    blocks = []
+    for k in range(nposes):
+        pose = pybel.Molecule(ob.OBMol(mol.OBMol))
+        new = xyz[perms[k % len(perms)]] if k % 3 else xyz.copy()
+        new = new+rng.normal(scale=0.3*(k % 4), size=new.shape)
+        if k % 5 == 4:  # a pose nowhere near the reference
+            theta = rng.uniform(0, np.pi)
+            rot = np.array([[np.cos(theta), -np.sin(theta), 0], [np.sin(theta), np.cos(theta), 0], [0, 0, 1]])
+            new = (new-new.mean(axis=0))@rot.T+new.mean(axis=0)+rng.normal(scale=2, size=3)
+        for atom, p in zip(pose.atoms, new):
+            atom.OBAtom.SetVector(*p)
+        if shuffle:
+            order = rng.permutation(len(new))
+            pose.OBMol.RenumberAtoms([int(i)+1 for i in order])
+        pose.title = f'{name}_{k}'
+        blocks.append(pose.write('sdf'))
+    pose_path = str(tmp_path/f'{name}_poses.sdf.gz')
+    with gzip.open(pose_path, 'wt') as outfile:
+        outfile.write(''.join(blocks))
+    return ref_path, pose_path
+
+
+@pytest.mark.parametrize('name', sorted(LIGANDS))
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_matches_obrms(tmp_path, name, shuffle):
+    ref_path, pose_path = write_case(tmp_path, name, LIGANDS[name], shuffle=shuffle)
+    calc = RMSDCalculator(ref_path)
+    ours = calc.rmsds(list(records(pose_path)))
+    np.testing.assert_allclose(ours, obrms(ref_path, pose_path), atol=TOL)
+
+
+@pytest.mark.skipif(OBRMS is None, reason='obrms binary not found')
+@pytest.mark.parametrize('name', sorted(LIGANDS))
+def test_mimic_matches_obrms(tmp_path, name):
+    ref_path, pose_path = write_case(tmp_path, name, LIGANDS[name], shuffle=True)
+    np.testing.assert_allclose(ob_rms(ref_path, pose_path), obrms(ref_path, pose_path), atol=TOL)
+
+
+def test_obrms_lines(tmp_path):
+    ref_path, pose_path = write_case(tmp_path, 'tbutylbenzene', LIGANDS['tbutylbenzene'])
+    lines = RMSDCalculator(ref_path).obrms_lines(list(records(pose_path)))
+    expected = obrms(ref_path, pose_path)
+    for k, (line, rmsd) in enumerate(zip(lines, expected)):
+        head, value = line.rsplit(' ', 1)
+        assert head == f'RMSD tbutylbenzene_{k}:tbutylbenzene'
+        assert abs(float(value)-rmsd) < TOL
+    if OBRMS is not None:
+        assert [line.rsplit(' ', 1)[0] for line in run_obrms(ref_path, pose_path)] == [line.rsplit(' ', 1)[0] for line in lines]
+
+
+def test_carboxylate_oxygens_swapped(tmp_path):
+    # obrms matches on connectivity only, so C=O and C-[O-] are exchanged
+    ref_path, _ = write_case(tmp_path, 'acetate', LIGANDS['acetate'], nposes=1)
+    calc = RMSDCalculator(ref_path)
+    assert len(calc.automorphisms) == 2
+    ref = next(records(ref_path))
+    oxygens = [i for i, e in enumerate(ref.elements) if e == 'O']
+    swapped = ref.coords.copy()
+    swapped[oxygens] = swapped[oxygens[::-1]]
+    pose_path = str(tmp_path/'swapped.sdf')
+    with open(ref_path) as infile, open(pose_path, 'w') as outfile:
+        lines = infile.read().split('\n')
+        for i, xyz in enumerate(swapped):
+            lines[4+i] = ''.join(f'{v:10.4f}' for v in xyz)+lines[4+i][30:]
+        outfile.write('\n'.join(lines))
+    assert calc.rmsds(list(records(pose_path)))[0] == pytest.approx(0, abs=TOL)
+    np.testing.assert_allclose(obrms(ref_path, pose_path), [0], atol=TOL)
+
+
+def test_limit_hit(tmp_path):
+    # with fewer mappings than automorphisms the RMSD can only be larger than obrms'
+    ref_path, pose_path = write_case(tmp_path, 'tbutylbenzene', LIGANDS['tbutylbenzene'])
+    mols = list(records(pose_path))
+    exact = obrms(ref_path, pose_path)
+    capped = RMSDCalculator(ref_path, limit=3)
+    assert len(capped.automorphisms) == 3
+    assert np.all(capped.rmsds(mols) >= exact-TOL)
+    np.testing.assert_allclose(RMSDCalculator(ref_path).rmsds(mols), exact, atol=TOL)
+
+
+def test_default_limit_hit(tmp_path):
+    # hexa-tert-butylbenzene has 12*6**6 automorphisms, more than the default limit of 100000
+    smiles = 'CC(C)(C)c1c(C(C)(C)C)c(C(C)(C)C)c(C(C)(C)C)c(C(C)(C)C)c1C(C)(C)C'
+    ref_path, pose_path = write_case(tmp_path, 'hexatbu', smiles, nposes=4, swap=False)
+    calc = RMSDCalculator(ref_path)
+    assert calc.automorphisms.shape == (100000, 30)
+    assert len(np.unique(calc.automorphisms, axis=0)) == 100000
+    mols = list(records(pose_path))
+    ours = calc.rmsds(mols)
+    # the minimum over exactly the enumerated mappings, across many batch_rmsd chunks
+    xyz = np.stack([m.coords for m in mols])
+    brute = [np.sqrt(((calc.coords[None]-x[calc.automorphisms])**2).sum(axis=2).mean(axis=1)).min() for x in xyz]
+    np.testing.assert_allclose(ours, brute, atol=1e-6)
+    assert np.all(ours >= nearest_atom_bound(ref_path, pose_path)-TOL)
+
+
+def nearest_atom_bound(ref_path, pose_path):
+    # nearest same-element atom for every reference atom, a lower bound of any mapping's RMSD
+    ref = next(records(ref_path))
+    out = []
+    for pose in records(pose_path):
+        d = ((ref.coords[:, None]-pose.coords[None])**2).sum(axis=2)
+        same = np.array(ref.elements)[:, None] == np.array(pose.elements)[None]
+        out.append(np.sqrt(np.where(same, d, np.inf).min(axis=1).mean()))
+    return np.array(out)
+
+
+def test_batch_rmsd_no_mapping():
+    assert np.all(np.isinf(batch_rmsd(np.zeros((2, 3)), np.zeros((4, 2, 3)), np.empty((0, 2), dtype=int))))
@@ -0,0 +1,138 @@
+'''
+run_gnina_cmds.py end to end with a stub gnina on PATH. The stub logs every output it is asked
+for, writes a one pose $$$$ terminated .sdf.gz, and fails (output with "fail" in its name) or
+hangs (output with "hang" in its name while $STUB_HANG is set) after writing a truncated output.
+'''
+
+import gzip, json, os, signal, stat, subprocess, sys, time
+import pytest
+
+from run_gnina_cmds import load_journal, output_complete
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run_gnina_cmds.py')
+
+STUB = r'''#!/bin/sh
+out=""
+while [ $# -gt 0 ]; do
+    if [ "$1" = "--out" ]; then out="$2"; shift; fi
+    shift
+done
+echo "$out" >> "$STUB_LOG"
+case "$(basename "$out")" in
+    *fail*) printf 'half a pose\n' | gzip > "$out"; echo "stub failure" >&2; exit 3;;
+    *hang*) if [ -n "$STUB_HANG" ]; then printf 'half a pose\n' | gzip > "$out"; sleep 600; fi;;
+esac
+printf 'pose\n  stub\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n> <minimizedAffinity>\n-7.0\n\n$$$$\n' | gzip > "$out"
+'''
+
+
+@pytest.fixture
+def sweep(tmp_path, monkeypatch):
+    if sys.platform == 'win32':
+        pytest.skip('needs a POSIX shell')
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    stub = bindir/'gnina'
+    stub.write_text(STUB)
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f'{bindir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('STUB_LOG', str(tmp_path/'calls.log'))
+    monkeypatch.delenv('STUB_HANG', raising=False)
+    return tmp_path
+
+
+def write_cmds(root, names):
+    cmds = root/'cmds.txt'
+    cmds.write_text(''.join(f'gnina -r rec.pdb -l lig.sdf --cpu 1 --out {root/name}.sdf.gz\n' for name in names))
+    return cmds
+
+
+def run(cmds, *extra, **kwargs):
+    return subprocess.run([sys.executable, SCRIPT, '-i', str(cmds), '-j', '2']+list(extra),
+                          capture_output=True, text=True, **kwargs)
+
+
+def calls(root):
+    path = root/'calls.log'
+    return [os.path.basename(line) for line in path.read_text().split()] if path.exists() else []
+
+
+def journal(cmds):
+    with open(str(cmds)+'.journal') as infile:
+        return [json.loads(line) for line in infile]
+
+
+def test_runs_and_journals(sweep):
+    cmds = write_cmds(sweep, ['a', 'b', 'c'])
+    proc = run(cmds)
+    assert proc.returncode == 0, proc.stderr
+    assert sorted(calls(sweep)) == ['a.partial.sdf.gz', 'b.partial.sdf.gz', 'c.partial.sdf.gz']
+    for name in 'abc':
+        assert output_complete(str(sweep/f'{name}.sdf.gz'))
+        assert not (sweep/f'{name}.partial.sdf.gz').exists()
+    recs = journal(cmds)
+    assert sorted(rec['out'] for rec in recs) == sorted(str(sweep/f'{n}.sdf.gz') for n in 'abc')
+    assert all(rec['status'] == 'done' and rec['returncode'] == 0 for rec in recs)
+    assert all('elapsed' in rec and 'maxrss_kb' in rec for rec in recs)
+
+
+def test_skips_complete_outputs(sweep):
+    cmds = write_cmds(sweep, ['a', 'b', 'c'])
+    assert run(cmds).returncode == 0
+    # a truncated output is run again, complete ones are not
+    with gzip.open(sweep/'b.sdf.gz', 'wt') as outfile:
+        outfile.write('pose\n  stub\n')
+    (sweep/'calls.log').unlink()
+    proc = run(cmds)
+    assert '1 of 3 commands to run' in proc.stdout
+    assert calls(sweep) == ['b.partial.sdf.gz']
+    assert output_complete(str(sweep/'b.sdf.gz'))
+
+
+def test_failure_cleans_partial(sweep):
+    cmds = write_cmds(sweep, ['ok', 'fail'])
+    proc = run(cmds)
+    assert '1 done, 1 failed' in proc.stdout
+    assert not (sweep/'fail.sdf.gz').exists()
+    assert not (sweep/'fail.partial.sdf.gz').exists()
+    rec = [r for r in journal(cmds) if r['out'].endswith('fail.sdf.gz')][0]
+    assert rec['status'] == 'failed' and rec['returncode'] == 3
+    assert 'stub failure' in rec['stderr']
+    # journaled failures are skipped unless retried
+    (sweep/'calls.log').unlink()
+    assert '0 of 2 commands to run' in run(cmds).stdout
+    assert calls(sweep) == []
+    run(cmds, '--retry_failed')
+    assert calls(sweep) == ['fail.partial.sdf.gz']
+
+
+def test_resume_after_kill(sweep):
+    cmds = write_cmds(sweep, ['a', 'hang', 'b', 'c'])
+    env = dict(os.environ, STUB_HANG='1')
+    proc = subprocess.Popen([sys.executable, SCRIPT, '-i', str(cmds), '-j', '2'], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        deadline = time.time()+60
+        while time.time() < deadline:
+            if len(load_journal(str(cmds)+'.journal')) == 3 and (sweep/'hang.partial.sdf.gz').exists():
+                break
+            time.sleep(0.1)
+        else:
+            pytest.fail('the other commands did not finish')
+    finally:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+    # the killed job left only its partial output, which does not count as finished
+    assert not (sweep/'hang.sdf.gz').exists()
+    assert (sweep/'hang.partial.sdf.gz').exists()
+    with open(str(cmds)+'.journal', 'a') as outfile:
+        outfile.write('{"out": "torn')  # a record cut short by the kill
+    (sweep/'calls.log').unlink()
+    proc = run(cmds)
+    assert proc.returncode == 0, proc.stderr
+    assert '1 of 4 commands to run' in proc.stdout
+    assert calls(sweep) == ['hang.partial.sdf.gz']
+    assert output_complete(str(sweep/'hang.sdf.gz'))
+    assert not (sweep/'hang.partial.sdf.gz').exists()
+    assert load_journal(str(cmds)+'.journal')[str(sweep/'hang.sdf.gz')]['status'] == 'done'
@@ -0,0 +1,122 @@
+'''
+sdf_index.py: the index against sdf_stream.py's reading of the same file, and --repack leaving the
+decompressed stream of the output untouched.
+'''
+
+import gzip, os
+import pytest
+
+import sdf_index
+from sdf_index import SDFIndex, build, load_or_build
+from sdf_stream import blocks, records
+
+ATOMS = [('C', (0.0, 0.0, 0.0)), ('C', (1.5, 0.0, 0.0)), ('O', (2.2, 1.3, 0.0))]
+
+
+def molblock(title, k):
+    lines = [title, '  test', '', f'{len(ATOMS):3d}  2  0  0  0  0  0  0  0  0999 V2000']
+    lines += [f'{x+k:10.4f}{y:10.4f}{z:10.4f} {el:<3} 0  0  0  0  0  0  0  0  0  0  0  0' for el, (x, y, z) in ATOMS]
+    lines += ['  1  2  1  0', '  2  3  2  0', 'M  END']
+    lines += ['> <minimizedAffinity>', f'{-7+k/10:.4f}', '']
+    if k % 2:
+        lines += ['> <CNNscore>', f'{k/20:.4f}', '']
+    return '\n'.join(lines)+'\n$$$$\n'
+
+
+# a trailing newline, and an unterminated record of 3 lines that is too short to be a pose
+TAILS = ['', '\n', 'stub\n  test\n\n']
+
+
+def write_poses(path, nposes, tail=''):
+    text = ''.join(molblock(f'pose_{k}', k) for k in range(nposes))+tail
+    with gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w') as outfile:
+        outfile.write(text)
+    return text.encode()
+
+
+def decompressed(path):
+    with gzip.open(path, 'rb') as infile:
+        return infile.read()
+
+
+@pytest.mark.parametrize('suffix', ['.sdf', '.sdf.gz'])
+@pytest.mark.parametrize('tail', TAILS)
+def test_blocks_match_sdf_stream(tmp_path, suffix, tail):
+    path = str(tmp_path/f'poses{suffix}')
+    write_poses(path, 11, tail)
+    index = build(path)
+    expected = list(blocks(path))
+    assert len(index) == len(expected) == 11
+    assert [index.block(k) for k in range(len(index))] == expected
+    assert index.members == [[0, 0]]
+    assert index.titles == [f'pose_{k}' for k in range(11)]
+    assert index.column('CNNscore') == [rec.tags.get('CNNscore', 'nan') for rec in records(path)]
+    assert (index.record(4).coords == list(records(path))[4].coords).all()
+
+
+@pytest.mark.parametrize('tail', TAILS)
+@pytest.mark.parametrize('per_member', [1, 3, 11, 20])
+def test_repack(tmp_path, tail, per_member):
+    path = str(tmp_path/'poses.sdf.gz')
+    text = write_poses(path, 11, tail)
+    expected = list(blocks(path))
+    index = build(path, True, per_member)
+    assert decompressed(path) == text
+    assert len(index.members) == -(-11//per_member)
+    assert [m[1] for m in index.members] == [index.offsets[i] for i in range(0, 11, per_member)]
+    assert [index.block(k) for k in range(len(index))] == expected
+    # every member is a gzip stream of its own, read from its checkpoint
+    with open(path, 'rb') as infile:
+        raw = infile.read()
+    for (start, offset), end in zip(index.members, [m[0] for m in index.members[1:]]+[len(raw)]):
+        part = gzip.decompress(raw[start:end])
+        assert part == text[offset:offset+len(part)]
+    assert SDFIndex.load(path).members == index.members
+
+
+def test_repack_skips_symlinks(tmp_path):
+    target = str(tmp_path/'cached.sdf.gz')
+    write_poses(target, 5)
+    with open(target, 'rb') as infile:
+        before = infile.read()
+    link = str(tmp_path/'poses.sdf.gz')
+    os.symlink(target, link)
+    index = build(link, True, 2)
+    assert index.members == [[0, 0]]
+    with open(target, 'rb') as infile:
+        assert infile.read() == before
+
+
+def test_stale_index_ignored(tmp_path):
+    path = str(tmp_path/'poses.sdf.gz')
+    write_poses(path, 4)
+    build(path)
+    assert SDFIndex.load(path) is not None
+    # a new mtime alone
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns+10**9))
+    assert SDFIndex.load(path) is None
+    build(path)
+    # a different size with the mtime put back
+    st = os.stat(path)
+    write_poses(path, 6)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert SDFIndex.load(path) is None
+    assert len(load_or_build(path)) == 6
+    assert len(SDFIndex.load(path)) == 6
+
+
+def test_old_version_ignored(tmp_path, monkeypatch):
+    path = str(tmp_path/'poses.sdf')
+    write_poses(path, 2)
+    build(path)
+    monkeypatch.setattr(sdf_index, 'VERSION', sdf_index.VERSION+1)
+    assert SDFIndex.load(path) is None
+
+
+def test_get(tmp_path, capsys):
+    path = str(tmp_path/'poses.sdf.gz')
+    write_poses(path, 9)
+    sdf_index.main(['build', '--repack', '--records_per_member', '4', path])
+    sdf_index.main(['get', path, '6', '1'])
+    assert capsys.readouterr().out == molblock('pose_6', 6)+molblock('pose_1', 1)
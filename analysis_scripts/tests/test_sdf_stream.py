@@ -0,0 +1,127 @@
+'''
+sdf_stream.py: V2000 atom and bond blocks, SD tags, gzipped input and the last record of a file
+that was not written to the end.
+'''
+
+import gzip
+import numpy as np
+import pytest
+
+from sdf_stream import blocks, parse_molblock, records, tag_values
+
+# ethanol with an explicit hydrogen, bond order fields written three ways: "  1", "1" in the
+# last column only and blank
+ETHANOL = '''\
+ethanol
+  gnina 1.1
+
+  4  3  0  0  0  0  0  0  0  0999 V2000
+   -1.2000    0.1000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    0.2000   -0.3000    0.0500 C   0  0  0  0  0  0  0  0  0  0  0  0
+    1.0000    0.8000   -0.1000 O   0  0  0  0  0  0  0  0  0  0  0  0
+    1.9000    0.5000   -0.1000 H   0  0  0  0  0  0  0  0  0  0  0  0
+  1  2  1  0
+  2  3
+  3  4  1
+M  END
+> <minimizedAffinity>
+-4.1200
+
+> <CNNscore>
+0.5321
+
+>  <comment>  (1)
+first line
+second line
+
+$$$$
+'''
+
+BENZENE = '''\
+benzene
+
+
+  6  6  0  0  0  0  0  0  0  0999 V2000
+'''+''.join(f'{np.cos(k*np.pi/3)*1.4:10.4f}{np.sin(k*np.pi/3)*1.4:10.4f}    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0\n' for k in range(6)) + \
+''.join(f'{k+1:3d}{(k+1) % 6+1:3d}  4  0\n' for k in range(6))+'''\
+M  END
+> <minimizedAffinity>
+-3.0000
+
+$$$$
+'''
+
+
+def write(path, text):
+    with gzip.open(path, 'wt') if str(path).endswith('.gz') else open(path, 'w') as outfile:
+        outfile.write(text)
+    return str(path)
+
+
+def test_v2000():
+    rec = parse_molblock(ETHANOL.splitlines()[:-1])
+    assert rec.title == 'ethanol'
+    assert rec.elements == ['C', 'C', 'O', 'H']
+    np.testing.assert_array_equal(rec.coords[1], [0.2, -0.3, 0.05])
+    assert rec.coords.shape == (4, 3)
+    assert rec.bonds == [(0, 1), (1, 2), (2, 3)]
+    assert rec.orders == [1, 1, 1]
+    rec = parse_molblock(BENZENE.splitlines()[:-1])
+    assert rec.bonds == [(k, (k+1) % 6) for k in range(6)]
+    assert rec.orders == [4]*6
+
+
+def test_blank_bond_order():
+    # the order field of the second bond is three spaces
+    lines = ETHANOL.splitlines()[:-1]
+    lines[9] = '  2  3     0'
+    assert parse_molblock(lines).orders == [1, 1, 1]
+
+
+def test_tags():
+    rec = parse_molblock(ETHANOL.splitlines()[:-1])
+    assert rec.tags == {'minimizedAffinity': '-4.1200', 'CNNscore': '0.5321', 'comment': 'first line\nsecond line'}
+    assert tag_values(rec, ['CNNscore', 'CNNaffinity', 'minimizedAffinity']) == ['0.5321', 'nan', '-4.1200']
+    assert tag_values(rec, ['CNNaffinity'], missing='') == ['']
+
+
+def test_v3000():
+    lines = ETHANOL.splitlines()[:-1]
+    lines[3] = '  0  0  0     0  0            999 V3000'
+    with pytest.raises(ValueError, match='V3000'):
+        parse_molblock(lines)
+
+
+@pytest.mark.parametrize('suffix', ['.sdf', '.sdf.gz'])
+def test_records(tmp_path, suffix):
+    path = write(tmp_path/f'poses{suffix}', ETHANOL+BENZENE+ETHANOL)
+    recs = list(records(path))
+    assert [rec.title for rec in recs] == ['ethanol', 'benzene', 'ethanol']
+    assert [len(rec.bonds) for rec in recs] == [3, 6, 3]
+    assert [tag_values(rec, ['minimizedAffinity'])[0] for rec in recs] == ['-4.1200', '-3.0000', '-4.1200']
+    assert [block[0] for block in blocks(path)] == ['ethanol', 'benzene', 'ethanol']
+
+
+@pytest.mark.parametrize('suffix', ['.sdf', '.sdf.gz'])
+def test_unterminated_last_record(tmp_path, suffix):
+    # a complete record without $$$$ is read, a few stray lines after the last $$$$ are not a record
+    path = write(tmp_path/f'poses{suffix}', ETHANOL+BENZENE[:-len('$$$$\n')])
+    assert [rec.title for rec in records(path)] == ['ethanol', 'benzene']
+    path = write(tmp_path/f'stub{suffix}', ETHANOL+'\n\n')
+    assert [rec.title for rec in records(path)] == ['ethanol']
+
+
+@pytest.mark.parametrize('suffix', ['.sdf', '.sdf.gz'])
+@pytest.mark.parametrize('keep', [6, 12, 16])
+def test_truncated_last_record(tmp_path, suffix, keep):
+    # cut off inside the atom block, inside the bond block and right after it
+    text = ETHANOL+''.join(line+'\n' for line in BENZENE.splitlines()[:keep])
+    path = write(tmp_path/f'poses{suffix}', text)
+    it = records(path)
+    assert next(it).title == 'ethanol'
+    if keep < 4+6+6:
+        with pytest.raises(ValueError, match='truncated'):
+            next(it)
+    else:
+        rec = next(it)
+        assert rec.bonds == [(k, (k+1) % 6) for k in range(6)] and rec.tags == {}
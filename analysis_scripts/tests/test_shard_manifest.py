@@ -0,0 +1,103 @@
+'''
+shard_manifest.py local (plan, run two shards, merge) against the unsharded pipeline: obrms_calc.py
+on every pocket and coalescer.py over the same tree.
+'''
+
+import csv, gzip, json, os, subprocess, sys
+import numpy as np
+import pytest
+
+import obrms_calc
+import shard_manifest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POCKETS = ['P1/', 'P2/', 'P3/']
+VALUES = ['4', '8']
+# heavy atoms of propanoic acid
+ATOMS = [('C', (0.0, 0.0, 0.0)), ('C', (1.5, 0.0, 0.0)), ('C', (2.2, 1.3, 0.0)), ('O', (3.4, 1.4, 0.0)), ('O', (1.5, 2.4, 0.0))]
+BONDS = [(1, 2, 1), (2, 3, 1), (3, 4, 1), (3, 5, 2)]
+
+
+def molblock(title, xyz, tags=()):
+    lines = [title, '  test', '', f'{len(xyz):3d}{len(BONDS):3d}  0  0  0  0  0  0  0  0999 V2000']
+    lines += [f'{x:10.4f}{y:10.4f}{z:10.4f} {el:<3} 0  0  0  0  0  0  0  0  0  0  0  0' for (el, _), (x, y, z) in zip(ATOMS, xyz)]
+    lines += [f'{a:3d}{b:3d}{o:3d}  0' for a, b, o in BONDS]
+    lines.append('M  END')
+    for name, value in tags:
+        lines += [f'> <{name}>', f'{value:.4f}', '']
+    return '\n'.join(lines)+'\n$$$$\n'
+
+
+@pytest.fixture
+def tree(tmp_path):
+    rng = np.random.default_rng(0)
+    ref = np.array([xyz for _, xyz in ATOMS])
+    root = tmp_path/'data'
+    lines = []
+    for p, pocket in enumerate(POCKETS):
+        os.makedirs(root/pocket)
+        for r in range(3):
+            rec, lig = f'{p}r{r}', f'{p}l{r}'
+            ligfile = root/pocket/f'{lig}_LIG.sdf'
+            ligfile.write_text(molblock(lig, ref))
+            for val in VALUES:
+                out = root/pocket/f'{rec}_PRO_{lig}_LIG_default_ensemble_exhaustiveness{val}.sdf.gz'
+                nposes = int(rng.integers(1, 12))  # uneven outputs for the shards to balance
+                with gzip.open(out, 'wt') as outfile:
+                    for k in range(nposes):
+                        xyz = ref+rng.normal(scale=k*0.4, size=ref.shape)
+                        tags = (('CNNscore', rng.random()), ('CNNaffinity', 5+rng.random()), ('minimizedAffinity', -7+rng.random()))
+                        outfile.write(molblock(f'{lig}_{k}', xyz, tags))
+                lines.append(f'gnina -r {root/pocket}/{rec}_PRO.pdb -l {ligfile} --autobox_ligand {ligfile} '
+                             f'--cpu 1 --seed 420 --exhaustiveness {val} --out {out}\n')
+    cmds = tmp_path/'cmds.txt'
+    cmds.write_text(''.join(lines))
+    dirlist = tmp_path/'dirs.txt'
+    dirlist.write_text(''.join(pocket+'\n' for pocket in POCKETS))
+    return tmp_path, root, cmds, dirlist
+
+
+def read(path):
+    with open(path, newline='') as infile:
+        reader = csv.reader(infile)
+        return next(reader), list(reader)
+
+
+def test_local_matches_unsharded(tree):
+    tmp_path, root, cmds, dirlist = tree
+    common = ['-r', str(root), '-d', str(dirlist), '-s', '_ensemble_exhaustiveness', '-v']+VALUES
+
+    manifest = str(tmp_path/'manifest.json')
+    shard_manifest.main(['plan', '-i', str(cmds), '-o', manifest, '--getscores', '--shards', '2']+common)
+    with open(manifest) as infile:
+        units = json.load(infile)['units']
+    assert len(units) == len(POCKETS)*3*len(VALUES)
+    assert {u['shard'] for u in units} == {0, 1}
+    shard_manifest.main(['local', '-m', manifest, '-j', '2', '-o', str(tmp_path/'sharded.csv')])
+    sharded = read(tmp_path/'sharded.csv')
+
+    for f in root.glob('*/*.rmsds'):
+        f.unlink()
+    for pocket in POCKETS:
+        obrms_calc.main(['-i', str(cmds), '-d', pocket, '--getscores'])
+    proc = subprocess.run([sys.executable, os.path.join(HERE, 'coalescer.py'), '-o', str(tmp_path/'unsharded.csv'), '--getscores']+common,
+                          capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    unsharded = read(tmp_path/'unsharded.csv')
+
+    assert sharded[0] == unsharded[0]
+    assert len(sharded[1]) == len(unsharded[1]) > 0
+    # the same rows, and grouped by pocket then value in both (coalescer.py lists files within a pocket in glob order)
+    assert sorted(sharded[1]) == sorted(unsharded[1])
+    pocket, tag = sharded[0].index('pocket'), sharded[0].index('tag')
+    assert [(r[pocket], r[tag]) for r in sharded[1]] == [(r[pocket], r[tag]) for r in unsharded[1]]
+
+
+@pytest.mark.parametrize('shards', ['0', '-1'])
+def test_plan_rejects_shards(tree, shards, capsys):
+    tmp_path, root, cmds, dirlist = tree
+    with pytest.raises(SystemExit):
+        shard_manifest.main(['plan', '-i', str(cmds), '-o', str(tmp_path/'m.json'), '-r', str(root), '-d', str(dirlist),
+                             '-s', '_ensemble_exhaustiveness', '--shards', shards])
+    assert '--shards must be at least 1' in capsys.readouterr().err
+    assert not (tmp_path/'m.json').exists()
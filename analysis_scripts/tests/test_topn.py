@@ -0,0 +1,252 @@
+'''
+topn.py and its callers against the TopN code they replaced: getPlottingDataFrame of
+generate_RMSD_graphs.py and of MakeRedockCSVs.ipynb, getTopN of Calculate_RMSD_stats.ipynb
+and topN/make_dict of MakeCrossDockCSVs.ipynb.
+
+The dictionary helpers below are the notebook code as it was. The frame based ones are the
+original loops with grouped.nth(r) written as the rows of cumcount() == r indexed by system,
+which is what nth returned before pandas 2 changed it to keep the original row index.
+
+The master table has several tags, poses in no particular order, systems with fewer poses
+than others and RMSDs tied with each other and exactly on the 1/2/3 thresholds.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from coalescer import SCORE_COLUMNS
+import generate_RMSD_graphs
+from topn import getTopN, make_dict, topN, topn_table
+
+TAGS = ['16', '4', '8']
+NSYS = 12
+GOODS = ['good1', 'good2', 'good3']
+
+
+@pytest.fixture(scope='module')
+def master(tmp_path_factory):
+    rng = np.random.default_rng(3)
+    values = [0.4, 1.0, 1.0, 1.7, 2.0, 2.0, 2.9, 3.0, 4.5, 6.0]  # ties, and values on the thresholds
+    rows = []
+    for tag in TAGS:
+        for s in range(NSYS):
+            nposes = 1 if s == 0 else int(rng.integers(2, 8))  # 7 poses at most, fewer than max_N=9
+            rmsds = [6.0]*nposes if s == 1 else rng.choice(values, nposes)  # a system with no good pose
+            for k, rmsd in enumerate(rmsds):
+                rows.append([tag, k, rmsd, 0.5, 5.0, -7.0, f'P{s % 3}', f'R{s}', f'L{s}'])
+    df = pd.DataFrame(rows, columns=SCORE_COLUMNS)
+    df = df.iloc[rng.permutation(len(df))]  # tags and systems interleaved, poses rank in file order
+    path = tmp_path_factory.mktemp('topn')/'master.csv'
+    df.to_csv(path, index=False)
+    return str(path)
+
+
+def nth(grouped_df, key, r):
+    rank = grouped_df.groupby(key, sort=False).cumcount()
+    return grouped_df[rank == r].set_index(key)
+
+
+def legacy_plotting_frames(path, unique):
+    # generate_RMSD_graphs.getPlottingDataFrame before topn.py
+    initial_df = pd.read_csv(path, usecols=[0, 2, 7])
+    initial_df.columns = ['tag', 'rmsd', 'rec']
+    initial_df['good2'] = (initial_df['rmsd'] < 2)
+    initial_df['good1'] = (initial_df['rmsd'] < 1)
+    initial_df['good3'] = (initial_df['rmsd'] < 3)
+    tags = initial_df['tag'].unique()
+    tags.sort()
+    new_datafs = []
+    for tag in tags:
+        df_tagonly = initial_df[initial_df['tag'] == tag]
+        assert len(df_tagonly['rec'].unique()) == unique
+        idx = nth(df_tagonly, 'rec', 0).index
+        maxrange = df_tagonly.groupby('rec').size().max()
+        combin_top_df = pd.DataFrame(None, index=list(range(1, maxrange+1)), columns=GOODS)
+        top_bools = nth(df_tagonly, 'rec', 0)[GOODS]
+        combin_top_df.loc[1] = [top_bools[g].mean()*100 for g in GOODS]
+        for r in range(1, maxrange):
+            cur_row = nth(df_tagonly, 'rec', r)[GOODS].reindex(idx, fill_value=False)
+            top_bools = cur_row | top_bools
+            combin_top_df.loc[r+1] = [top_bools[g].mean()*100 for g in GOODS]
+        new_datafs.append(combin_top_df)
+    return tags, new_datafs
+
+
+def legacy_notebook_frame(path, unique, exclusive_tag=None, rmsd_good=2, max_N=9):
+    # getPlottingDataFrame of MakeRedockCSVs.ipynb before topn.py
+    initial_df = pd.read_csv(path, usecols=[0, 2, 7])
+    initial_df.columns = ['tag', 'rmsd', 'rec']
+    initial_df['good'] = (initial_df['rmsd'] < rmsd_good)
+    tags = initial_df['tag'].unique()
+    tags.sort()
+    final_dataframe = pd.DataFrame(index=list(range(1, max_N+1)), columns=tags)
+    for tag in tags:
+        if exclusive_tag is not None and tag != exclusive_tag:
+            continue
+        df_tagonly = initial_df[initial_df['tag'] == tag]
+        assert len(df_tagonly['rec'].unique()) == unique
+        idx = nth(df_tagonly, 'rec', 0).index
+        combin_top_df = pd.DataFrame(None, index=list(range(1, max_N+1)), columns=['good'])
+        top_bools = nth(df_tagonly, 'rec', 0)[['good']]
+        combin_top_df.loc[1] = [top_bools['good'].mean()*100]
+        for r in range(1, 9):
+            cur_row = nth(df_tagonly, 'rec', r)[['good']].reindex(idx, fill_value=False)
+            top_bools = cur_row | top_bools
+            combin_top_df.loc[r+1] = [top_bools['good'].mean()*100]
+        final_dataframe[tag] = combin_top_df['good']
+    return final_dataframe
+
+
+def legacy_getTopN(n, filename, keys=['pocket', 'rec', 'lig'], accumulate=True):
+    # getTopN of Calculate_RMSD_stats.ipynb before topn.py; accumulate=False ors the rows instead of adding them
+    smina = pd.read_csv(filename)
+    for g, t in zip(GOODS, (1, 2, 3)):
+        smina[g] = smina['rmsd'] < t
+    smina_top = pd.DataFrame(index=range(1, n+1), columns=GOODS)
+    smina_last = nth(smina, keys, 0)[GOODS].astype(int)
+    smina_top.loc[1] = [smina_last[g].mean() for g in GOODS]
+    idx = smina_last.index
+    for i in range(1, n):
+        gcur_row = nth(smina, keys, i)[GOODS].reindex(idx, fill_value=False).astype(int)
+        smina_last = smina_last+gcur_row if accumulate else smina_last | gcur_row
+        smina_top.loc[i+1] = [smina_last[g].mean() for g in GOODS]
+    return smina_top
+
+
+def legacy_topN(n, dic, thresh, redkeys=None, perpocket=False):
+    # topN of MakeCrossDockCSVs.ipynb
+    has_stuff = []
+    counter = 0
+    if perpocket:
+        for key, data in dic.items():
+            kstuff = []
+            kcount = 0
+            for key2, data2 in data.items():
+                if redkeys and key2 not in redkeys:
+                    continue
+                counter += 1
+                kcount += 1
+                if n < len(data2):
+                    lookat = n
+                else:
+                    lookat = len(data2)
+                for rmsd in data2[:lookat]:
+                    if rmsd < thresh:
+                        kstuff.append(True)
+                        break
+            has_stuff.append(np.sum(kstuff)/float(kcount))
+        return np.mean(has_stuff)
+    else:
+        for key, data in dic.items():
+            for key2, data2 in data.items():
+                if redkeys and key2 not in redkeys:
+                    continue
+                counter += 1
+                if n < len(data2):
+                    lookat = n
+                else:
+                    lookat = len(data2)
+                for rmsd in data2[:lookat]:
+                    if rmsd < thresh:
+                        has_stuff.append(True)
+                        break
+        return np.sum(has_stuff)/float(counter)
+
+
+def legacy_make_dict(filename, is_sweep=False, has_cnnscore=False, tag_prefix=None):
+    # make_dict of MakeCrossDockCSVs.ipynb
+    datadic = {}
+    with open(filename) as infile:
+        for i, line in enumerate(infile):
+            if i == 0:
+                continue
+            items = line.rstrip().split(',')
+            if has_cnnscore:
+                pocket = items[6]
+                key = items[7]+':'+items[8]
+            else:
+                pocket = items[3]
+                key = items[4]+':'+items[5]
+            rmsd = float(items[2])
+            if is_sweep:
+                if tag_prefix:
+                    check = items[0].split(tag_prefix)[-1]
+                else:
+                    check = items[0]
+                if '_' in check:
+                    checkval = check.split('_')[0]
+                    if checkval == '' or checkval == 'rescore':
+                        tag = '0'
+                    else:
+                        tag = checkval
+                else:
+                    tag = float(items[0])
+                if tag not in datadic:
+                    datadic[tag] = dict()
+                if pocket in datadic[tag] and key in datadic[tag][pocket]:
+                    datadic[tag][pocket][key].append(rmsd)
+                elif pocket in datadic[tag] and key not in datadic[tag][pocket]:
+                    datadic[tag][pocket][key] = [rmsd]
+                else:
+                    datadic[tag][pocket] = {key: [rmsd]}
+            else:
+                if pocket in datadic and key in datadic[pocket]:
+                    datadic[pocket][key].append(rmsd)
+                elif pocket in datadic and key not in datadic[pocket]:
+                    datadic[pocket][key] = [rmsd]
+                else:
+                    datadic[pocket] = {key: [rmsd]}
+    return datadic
+
+
+@pytest.mark.parametrize('chunksize', [None, 7])
+def test_plotting_frames(master, chunksize):
+    tags, expected = legacy_plotting_frames(master, NSYS)
+    frames, ranges = generate_RMSD_graphs.getPlottingDataFrame(
+        master, ['a', 'b', 'c'], ['tag', 'rmsd', 'rec'], 'infer', ',', [0, 2, 7], ['rec', 'tag'], NSYS, chunksize=chunksize)
+    assert [f.attrs['tag'] for f in frames] == list(tags) == [4, 8, 16]
+    for frame, rang, exp in zip(frames, ranges, expected):
+        assert rang == list(exp.index)
+        pd.testing.assert_frame_equal(frame, exp.astype(float), check_index_type=False)
+
+
+def test_plotting_frames_system_count(master):
+    with pytest.raises(AssertionError, match='should have 11'):
+        generate_RMSD_graphs.getPlottingDataFrame(master, ['a'], ['tag', 'rmsd', 'rec'], 'infer', ',', [0, 2, 7], ['rec', 'tag'], NSYS-1)
+
+
+@pytest.mark.parametrize('exclusive_tag', [None, 8])
+@pytest.mark.parametrize('rmsd_good', [1, 2, 3])
+def test_notebook_plotting_frame(master, exclusive_tag, rmsd_good):
+    expected = legacy_notebook_frame(master, NSYS, exclusive_tag, rmsd_good)
+    ours = topn_table(master, ['tag', 'rmsd', 'rec'], 'infer', ',', [0, 2, 7], ['rec', 'tag'], NSYS, exclusive_tag, rmsd_good)
+    pd.testing.assert_frame_equal(ours.astype(float), expected.astype(float))
+
+
+def test_getTopN(master):
+    ours = getTopN(9, master)
+    # the fraction of systems with a good pose in the top N, the notebook's frame with its rows or'ed
+    pd.testing.assert_frame_equal(ours, legacy_getTopN(9, master, accumulate=False).astype(float), check_index_type=False)
+    # the notebook added the rows up, giving the mean number of good poses in the top N: the same at
+    # N=1 and never less than the fraction after that
+    counts = legacy_getTopN(9, master).astype(float)
+    np.testing.assert_allclose(ours.loc[1], counts.loc[1])
+    assert (counts.to_numpy() >= ours.to_numpy()-1e-12).all()
+    assert (counts.to_numpy() > ours.to_numpy()+1e-12).any()
+
+
+@pytest.mark.parametrize('is_sweep', [False, True])
+def test_make_dict(master, is_sweep):
+    assert make_dict(master, is_sweep, True) == legacy_make_dict(master, is_sweep, True)
+
+
+@pytest.mark.parametrize('perpocket', [False, True])
+@pytest.mark.parametrize('thresh', [1, 2, 3])
+def test_topN(master, perpocket, thresh):
+    dic = legacy_make_dict(master, True, True)
+    redkeys = [f'R{s}:L{s}' for s in range(0, NSYS, 2)]
+    for tag in dic:
+        for n in range(1, 10):
+            for keys in (None, redkeys):
+                assert topN(n, dic[tag], thresh, keys, perpocket) == pytest.approx(legacy_topN(n, dic[tag], thresh, keys, perpocket))
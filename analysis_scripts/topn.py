@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+'''
+Vectorized TopN engine.
+
+TopN is the percentage of systems that have a pose under an RMSD threshold among their first N poses.
+Instead of building a frame per pose rank, every pose gets its rank within its system from one
+groupby-cumcount, the first rank under each threshold is reduced per (tag, system), and one bincount
+over (tag, rank, threshold) followed by a cumulative sum over rank gives the TopN curves of every tag
+and threshold at once, as a (tags x N x thresholds) array.
+
+stream_topn gives the same curves from a table read in chunks, keeping only the first rank under each
+threshold of every (tag, system) in compact integer arrays.
+
+bootstrap_topn resamples systems for confidence intervals: a (systems x N) success matrix is built once,
+every replicate is a row of resampling counts, and all replicate curves come out of one matrix product.
+
+The helpers at the bottom back getPlottingDataFrame/topN/getTopN/make_dict in the notebooks.
+'''
+
+from collections import namedtuple
+import numpy as np
+
+THRESHOLDS = (1, 2, 3)
+
+TopNResult = namedtuple('TopNResult', ['tags', 'topn', 'nsystems', 'maxposes', 'thresholds'])
+BootstrapResult = namedtuple('BootstrapResult', ['tags', 'topn', 'nsystems', 'maxposes', 'thresholds',
+                                                 'lower', 'upper', 'replicates', 'ci'])
+
+
+def first_good_ranks(rmsd, codes, rank, thresholds=THRESHOLDS, ngroups=None):
+    '''
+    First pose rank (0-based) under each threshold for every group.
+
+    rmsd, codes (group of each pose) and rank (rank of each pose in its group) are flat arrays.
+    Returns an int array of shape (groups, thresholds); groups that never get under a
+    threshold hold the largest int64, past any N.
+    '''
+
+    rmsd = np.asarray(rmsd, dtype=float)
+    if ngroups is None:
+        ngroups = int(codes.max())+1 if len(codes) else 0
+    miss = np.iinfo(np.int64).max
+    first = np.full((ngroups, len(thresholds)), miss, dtype=np.int64)
+    for k, thresh in enumerate(thresholds):
+        good = rmsd < thresh
+        np.minimum.at(first[:, k], codes[good], rank[good])
+    return first
+
+
+def topn_from_ranks(first, group_tag, ntags, max_n):
+    '''
+    TopN percentages from first_good_ranks, shape (tags, max_n, thresholds).
+
+    group_tag is the tag index of every group.
+    '''
+
+    ngroups, nthresh = first.shape
+    clipped = np.minimum(first, max_n)  # anything at or past max_n is a miss
+    idx = (group_tag[:, None]*(max_n+1)+clipped)*nthresh+np.arange(nthresh)
+    counts = np.bincount(idx.ravel(), minlength=ntags*(max_n+1)*nthresh).reshape(ntags, max_n+1, nthresh)
+    nsystems = np.bincount(group_tag, minlength=ntags)
+    hits = counts[:, :max_n, :].cumsum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return hits/nsystems[:, None, None]*100
+
+
+def _rank_poses(df, system_key, tag_key):
+    '''
+    Tag codes, tags, system codes, (tag, system) group codes and pose ranks of every row of df.
+    '''
+
+    import pandas as pd
+
+    sys_keys = [system_key] if isinstance(system_key, str) else list(system_key)
+    if tag_key is None:
+        tag_codes = np.zeros(len(df), dtype=np.int64)
+        tags = np.array([None])
+    else:
+        tag_codes, tags = pd.factorize(df[tag_key], sort=True)
+        tags = np.asarray(tags)
+    keys = pd.DataFrame({i: df[k].to_numpy() for i, k in enumerate(sys_keys)})
+    sys_codes = keys.groupby(list(range(len(sys_keys))), sort=False).ngroup().to_numpy()
+    grouped = pd.DataFrame({0: tag_codes, 1: sys_codes}).groupby([0, 1], sort=False)
+    return tag_codes, tags, sys_codes, grouped.ngroup().to_numpy(), grouped.cumcount().to_numpy()
+
+
+def _group_index(codes, values, ngroups):
+    out = np.zeros(ngroups, dtype=np.int64)
+    out[codes] = values
+    return out
+
+
+def compute_topn(df, system_key='rec', tag_key='tag', thresholds=THRESHOLDS, max_n=None, rmsd_key='rmsd'):
+    '''
+    TopN curves of every tag in a coalesced table.
+
+    Poses of a system are ranked in the order they appear in df. tag_key may be None to treat the
+    whole table as one tag, and system_key may be a list of columns.
+
+    Returns a TopNResult with the sorted tags, the (tags x N x thresholds) TopN array, the number
+    of systems and the largest number of poses per system of every tag. N defaults to the most
+    poses of any system.
+    '''
+
+    tag_codes, tags, _, codes, rank = _rank_poses(df, system_key, tag_key)
+    ngroups = int(codes.max())+1 if len(codes) else 0
+    group_tag = _group_index(codes, tag_codes, ngroups)
+    sizes = np.bincount(codes, minlength=ngroups)
+    maxposes = np.zeros(len(tags), dtype=np.int64)
+    np.maximum.at(maxposes, group_tag, sizes)
+    if max_n is None:
+        max_n = int(maxposes.max()) if len(maxposes) else 0
+
+    first = first_good_ranks(df[rmsd_key].to_numpy(), codes, rank, thresholds, ngroups)
+    topn = topn_from_ranks(first, group_tag, len(tags), max_n)
+    return TopNResult(tags, topn, np.bincount(group_tag, minlength=len(tags)), maxposes, tuple(thresholds))
+
+
+def _grow(arr, size, fill):
+    # arr with room for at least size entries along axis 0, doubling so appends stay cheap
+    if size <= len(arr):
+        return arr
+    out = np.full((max(size, 2*len(arr)),)+arr.shape[1:], fill, dtype=arr.dtype)
+    out[:len(arr)] = arr
+    return out
+
+
+def stream_topn(chunks, system_key='rec', tag_key='tag', thresholds=THRESHOLDS, max_n=None, rmsd_key='rmsd'):
+    '''
+    compute_topn over a table given as an iterable of DataFrames (e.g. coalescer.iter_master), for
+    master tables that do not fit in memory.
+
+    Only the pose count and the first rank under each threshold of every (tag, system) are kept, as
+    int32 arrays, so memory grows with tags x systems and not with the number of poses. Poses are
+    ranked in the order they come, across chunks, and the result is the same as compute_topn's on
+    the concatenated table.
+    '''
+
+    import pandas as pd
+
+    sys_keys = [system_key] if isinstance(system_key, str) else list(system_key)
+    nthresh = len(thresholds)
+    miss = np.iinfo(np.int32).max
+    groups = {}
+    tag_index = {}
+    group_tag = np.zeros(0, dtype=np.int64)
+    count = np.zeros(0, dtype=np.int32)
+    first = np.zeros((0, nthresh), dtype=np.int32)
+    for df in chunks:
+        if not len(df):
+            continue
+        keys = [df[k].to_numpy() for k in sys_keys]
+        keys.insert(0, np.zeros(len(df), dtype=np.int64) if tag_key is None else df[tag_key].to_numpy())
+        local, uniques = pd.factorize(pd.MultiIndex.from_arrays(keys))
+        # map this chunk's (tag, system) groups onto the ones seen so far
+        glob = np.empty(len(uniques), dtype=np.int64)
+        for i, key in enumerate(uniques):
+            code = groups.get(key)
+            if code is None:
+                code = groups[key] = len(groups)
+                group_tag = _grow(group_tag, code+1, 0)
+                group_tag[code] = tag_index.setdefault(key[0], len(tag_index))
+            glob[i] = code
+        count = _grow(count, len(groups), 0)
+        first = _grow(first, len(groups), miss)
+        valid = local >= 0
+        codes = glob[local[valid]]
+        rank = pd.Series(local[valid]).groupby(local[valid], sort=False).cumcount().to_numpy()+count[codes]
+        rmsd = df[rmsd_key].to_numpy(dtype=float)[valid]
+        for k, thresh in enumerate(thresholds):
+            good = rmsd < thresh
+            np.minimum.at(first[:, k], codes[good], rank[good].astype(np.int32))
+        count += np.bincount(codes, minlength=len(count)).astype(np.int32)
+
+    ngroups = len(groups)
+    names = list(tag_index)
+    order = sorted(range(len(names)), key=lambda t: names[t])
+    remap = np.empty(len(names), dtype=np.int64)
+    remap[order] = np.arange(len(names))
+    group_tag = remap[group_tag[:ngroups]]
+    tags = np.array([None]) if tag_key is None else np.asarray([names[t] for t in order])
+    maxposes = np.zeros(len(tags), dtype=np.int64)
+    np.maximum.at(maxposes, group_tag, count[:ngroups])
+    if max_n is None:
+        max_n = int(maxposes.max()) if len(maxposes) else 0
+    topn = topn_from_ranks(np.minimum(first[:ngroups], max_n), group_tag, len(tags), max_n)
+    return TopNResult(tags, topn, np.bincount(group_tag, minlength=len(tags)), maxposes, tuple(thresholds))
+
+
+def resample_counts(strata, nboot, rng, per_stratum=None, replace=True):
+    '''
+    (nboot x systems) matrix of how often each system is drawn in each replicate.
+
+    strata is the stratum code of every system; each replicate draws per_stratum systems (default the
+    stratum size, capped at it without replacement) from every stratum. All draws are one random array.
+    '''
+
+    strata = np.asarray(strata)
+    nsys = len(strata)
+    order = np.argsort(strata, kind='stable')
+    sizes = np.bincount(strata)
+    starts = np.cumsum(sizes)-sizes
+    take = sizes if per_stratum is None else np.full_like(sizes, per_stratum)
+    if not replace:
+        take = np.minimum(take, sizes)
+    # stratum and offset (within the stratum's block of order) of every draw of a replicate
+    draw_stratum = np.repeat(np.arange(len(sizes)), take)
+    rows = np.arange(nboot)[:, None]*nsys
+
+    if replace:
+        u = rng.random((nboot, len(draw_stratum)))
+        picked = order[starts[draw_stratum]+(u*sizes[draw_stratum]).astype(np.int64)]
+    else:
+        # sort the systems of each stratum by a random key, and keep the first take of each block
+        keys = rng.random((nboot, nsys))+strata[order]
+        shuffled = order[np.argsort(keys, axis=1)]
+        offset = np.arange(len(draw_stratum))-np.repeat(np.cumsum(take)-take, take)
+        picked = shuffled[:, starts[draw_stratum]+offset]
+    return np.bincount((picked+rows).ravel(), minlength=nboot*nsys).reshape(nboot, nsys)
+
+
+def bootstrap_topn(df, system_key='rec', tag_key='tag', thresholds=THRESHOLDS, max_n=None, rmsd_key='rmsd',
+                   nboot=1000, strata_key=None, per_stratum=None, replace=True, ci=95, seed=42, chunk=256):
+    '''
+    TopN curves of every tag with bootstrap confidence intervals.
+
+    Systems are resampled (within each strata_key value, e.g. pocket, if given) and the same draws are
+    used for every tag, so differences between tags are paired. A system missing from a tag is left out
+    of that tag's denominator. per_stratum and replace=False give the subsampling of the notebooks'
+    select_randkeys instead of a bootstrap.
+
+    Returns a BootstrapResult: the fields of compute_topn, the lower and upper ci% percentile curves
+    and the (nboot x tags x N x thresholds) replicates.
+    '''
+
+    tag_codes, tags, sys_codes, codes, rank = _rank_poses(df, system_key, tag_key)
+    ngroups = int(codes.max())+1 if len(codes) else 0
+    nsys = int(sys_codes.max())+1 if len(sys_codes) else 0
+    group_tag = _group_index(codes, tag_codes, ngroups)
+    group_sys = _group_index(codes, sys_codes, ngroups)
+    sizes = np.bincount(codes, minlength=ngroups)
+    maxposes = np.zeros(len(tags), dtype=np.int64)
+    np.maximum.at(maxposes, group_tag, sizes)
+    if max_n is None:
+        max_n = int(maxposes.max()) if len(maxposes) else 0
+    ntags, nthresh = len(tags), len(thresholds)
+
+    # success[s, t, n, k]: system s has a pose under threshold k in the top n+1 of tag t
+    first = first_good_ranks(df[rmsd_key].to_numpy(), codes, rank, thresholds, ngroups)
+    success = np.zeros((nsys, ntags, max_n, nthresh))
+    success[group_sys, group_tag] = first[:, None, :] <= np.arange(max_n)[:, None]
+    present = np.zeros((nsys, ntags))
+    present[group_sys, group_tag] = 1
+    success = success.reshape(nsys, -1)
+
+    if strata_key is None:
+        strata = np.zeros(nsys, dtype=np.int64)
+    else:
+        import pandas as pd
+        strata = pd.factorize(_group_index(sys_codes, pd.factorize(df[strata_key])[0], nsys))[0]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        topn = success.sum(axis=0).reshape(ntags, max_n, nthresh)/present.sum(axis=0)[:, None, None]*100
+        rng = np.random.default_rng(seed)
+        replicates = np.empty((nboot, ntags, max_n, nthresh))
+        for start in range(0, nboot, chunk):
+            counts = resample_counts(strata, min(chunk, nboot-start), rng, per_stratum, replace).astype(float)
+            hits = (counts @ success).reshape(len(counts), ntags, max_n, nthresh)
+            replicates[start:start+len(counts)] = hits/(counts @ present)[:, :, None, None]*100
+    alpha = (100-ci)/2
+    lower, upper = np.nanpercentile(replicates, [alpha, 100-alpha], axis=0) if nboot else (topn, topn)
+    return BootstrapResult(tags, topn, present.sum(axis=0).astype(np.int64), maxposes, tuple(thresholds),
+                           lower, upper, replicates, ci)
+
+
+def compare_tags(result, a, b):
+    '''
+    Paired bootstrap comparison of tag indices a and b of a BootstrapResult.
+
+    Returns the (N x thresholds) difference a-b of the TopN, its ci% interval and the two-sided
+    bootstrap p-value of the difference being zero.
+    '''
+
+    diff = result.replicates[:, a]-result.replicates[:, b]
+    alpha = (100-result.ci)/2
+    lower, upper = np.nanpercentile(diff, [alpha, 100-alpha], axis=0)
+    pvalue = np.minimum(1, 2*np.minimum((diff <= 0).mean(axis=0), (diff >= 0).mean(axis=0)))
+    return result.topn[a]-result.topn[b], lower, upper, pvalue
+
+
+def topn_frames(result, names=None):
+    '''
+    One DataFrame per tag (index 1..poses of that tag, columns good<threshold>), the layout
+    getPlottingDataFrame has always returned, with the tag in frame.attrs['tag']. A BootstrapResult
+    adds good<threshold>_lower/_upper columns.
+    '''
+
+    import pandas as pd
+
+    columns = [f'good{t:g}' for t in result.thresholds]
+    frames = []
+    for t in range(len(result.tags) if names is None else min(len(names), len(result.tags))):
+        rang = list(range(1, int(result.maxposes[t])+1))
+        frame = pd.DataFrame(result.topn[t, :len(rang)], index=rang, columns=columns)
+        if isinstance(result, BootstrapResult):
+            for k, col in enumerate(columns):
+                frame[col+'_lower'] = result.lower[t, :len(rang), k]
+                frame[col+'_upper'] = result.upper[t, :len(rang), k]
+        frame.attrs['tag'] = result.tags[t]
+        frames.append(frame)
+    return frames
+
+
+def read_table(path, col_names, header, delim, usecols, exclude=None, chunksize=None):
+    '''
+    The usecols columns of a csv, named col_names, without the rows of the exclusion lists in
+    exclude (exclusions.py). A file with a header is checked on all of its rec/lig columns, not
+    only the used ones. Like pd.read_csv, gives an iterator of frames if chunksize is set.
+    '''
+
+    import pandas as pd
+    from exclusions import keep_mask
+
+    full = bool(exclude) and header is not None
+    reader = pd.read_csv(path, header=header, sep=delim, usecols=None if full else usecols, chunksize=chunksize)
+
+    def select(df):
+        if full:
+            df = df[keep_mask(df, exclude)].iloc[:, sorted(usecols)]
+        df = df.set_axis(col_names, axis=1)
+        if exclude and not full:
+            df = df[keep_mask(df, exclude)]
+        return df
+
+    return (select(chunk) for chunk in reader) if chunksize else select(reader)
+
+
+def topn_table(path, col_names, header, delim, usecols, key, unique, exclusive_tag=None, rmsd_good=2, max_N=9, exclude=None):
+    '''
+    Notebook getPlottingDataFrame: DataFrame indexed 1..max_N with a column of TopN (<rmsd_good) per tag.
+
+    If exclusive_tag is given only that tag is filled in (the other columns are left empty).
+    exclude names exclusion lists (exclusions.py) whose rec/lig ids are left out.
+    '''
+
+    import pandas as pd
+
+    initial_df = read_table(path, col_names, header, delim, usecols, exclude)
+    result = compute_topn(initial_df, key[0], key[1], (rmsd_good,), max_N)
+    final_dataframe = pd.DataFrame(index=list(range(1, max_N+1)), columns=result.tags)
+    for t, tag in enumerate(result.tags):
+        if exclusive_tag is not None and tag != exclusive_tag:
+            continue
+        assert result.nsystems[t] == unique, f"Doesn't have the right number of systems, should have {unique}, but has {result.nsystems[t]}"
+        final_dataframe[tag] = result.topn[t, :, 0]
+    return final_dataframe
+
+
+def getTopN(n, filename, keys=['pocket', 'rec', 'lig'], redkeys=['rec', 'lig'], nred=None, exclude=None):
+    '''
+    Notebook getTopN: fraction of systems (grouped by keys) with a pose <1, <2 and <3 RMSD in the top 1..n.
+
+    If nred is given, at most nred random systems rows per pocket are used. exclude as for topn_table.
+    '''
+
+    import pandas as pd
+    from exclusions import apply_exclusions
+
+    smina = apply_exclusions(pd.read_csv(filename), exclude)
+    if nred:
+        smina = smina.sample(frac=1).groupby('pocket').head(nred)
+    result = compute_topn(smina, keys, None, THRESHOLDS, n)
+    return pd.DataFrame(result.topn[0]/100, index=range(1, n+1), columns=['good1', 'good2', 'good3'])
+
+
+def make_dict(filename, is_sweep=False, has_cnnscore=False, tag_prefix=None, exclude=None):
+    '''
+    Notebook make_dict: dictionary of pocket -> rec:lig -> [rmsds] from a coalesced csv,
+    or tag -> pocket -> rec:lig -> [rmsds] if is_sweep.
+
+    has_cnnscore is for csvs made with --getscores. Sweep tags are the value before the first '_'
+    of the tag (after tag_prefix), with '' and 'rescore' mapped to '0'; tags without '_' are floats.
+    exclude as for topn_table.
+    '''
+
+    excluded = {}
+    if exclude:
+        from exclusions import exclusion_ids
+        ids = exclusion_ids(exclude)
+    datadic = {}
+    with open(filename) as infile:
+        next(infile, None)
+        for line in infile:
+            items = line.rstrip().split(',')
+            if has_cnnscore:
+                pocket = items[6]
+                key = items[7]+':'+items[8]
+            else:
+                pocket = items[3]
+                key = items[4]+':'+items[5]
+            if exclude:
+                if key not in excluded:
+                    rec, lig = key.split(':', 1)
+                    excluded[key] = rec.split('/')[-1] in ids or lig in ids
+                if excluded[key]:
+                    continue
+            rmsd = float(items[2])
+
+            dic = datadic
+            if is_sweep:
+                check = items[0].split(tag_prefix)[-1] if tag_prefix else items[0]
+                if '_' in check:
+                    tag = check.split('_')[0]
+                    if tag in ('', 'rescore'):
+                        tag = '0'
+                else:
+                    tag = float(items[0])
+                dic = datadic.setdefault(tag, {})
+            dic.setdefault(pocket, {}).setdefault(key, []).append(rmsd)
+    return datadic
+
+
+def dict_curve(dic, thresh, max_n, redkeys=None, perpocket=False):
+    '''
+    TopN fractions for N=1..max_n from a make_dict dictionary (pocket -> key -> [rmsds]).
+
+    If redkeys is given only those keys are used. If perpocket the fraction is computed
+    per pocket and the pockets are averaged.
+    '''
+
+    pocket_first = []
+    for data in dic.values():
+        first = []
+        for key2, data2 in data.items():
+            if redkeys and key2 not in redkeys:
+                continue
+            good = np.flatnonzero(np.asarray(data2, dtype=float) < thresh)
+            first.append(good[0] if len(good) else max_n)
+        pocket_first.append(np.asarray(first, dtype=np.int64))
+
+    ns = np.arange(1, max_n+1)
+    if perpocket:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            per = np.array([(first[:, None] < ns).sum(axis=0)/float(len(first)) for first in pocket_first])
+        return np.array([np.mean(col) for col in per.T])
+    first = np.concatenate(pocket_first) if pocket_first else np.empty(0, dtype=np.int64)
+    return (first[:, None] < ns).sum(axis=0)/float(len(first))
+
+
+def topN(n, dic, thresh, redkeys=None, perpocket=False):
+    '''
+    Notebook topN: the TopN fraction for a single n from a make_dict dictionary, see dict_curve.
+    '''
+
+    return dict_curve(dic, thresh, n, redkeys, perpocket)[n-1]